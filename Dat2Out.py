@@ -11,6 +11,8 @@ import os
 import logging
 import numpy as np
 
+from readwrite import read_curve
+
 
 class Dat2Out():
     """A dat file and a P(r) dat file from Scatter convert to an out file
@@ -88,33 +90,12 @@ class Dat2Out():
 
     def parseDatPr(self):
         if self.dat_pr_file:
-            with open(self.dat_pr_file, 'r') as f:
-                d = f.readlines()
-            for line in d:
-                line = line.split()
-                try:
-                    r = float(line[0])
-                    p = float(line[1])
-                    e = float(line[2])
-                    self.pr_array.append( (r,p,e) )
-                except:
-                    pass
+            self.pr_array.extend([tuple(row) for row in read_curve(self.dat_pr_file, 3, ()).tolist()])
             self.logger.info('Parsed Pr data with '+str(len(self.pr_array))+' points')
 
     def parseDatData(self):
         if self.dat_data_file:
-            with open(self.dat_data_file, 'r') as f:
-                d = f.readlines()
-            for line in d:
-                line = line.split()
-                try:
-                    q = float(line[0])
-                    iobs = float(line[1])
-                    e = float(line[2])
-                    icalc = float(line[3])
-                    self.dat_array.append( (q,iobs,e,icalc) )
-                except:
-                    pass
+            self.dat_array.extend([tuple(row) for row in read_curve(self.dat_data_file, 4, ()).tolist()])
             self.logger.info('Parsed dat data with '+str(len(self.dat_array))+' points')
 
     def formatOutput(self):
@@ -1,4 +1,4 @@
-#!/usr/local/bin/python
+#!/usr/local/bin/python3
 '''
 Created on Aug 24, 2015
 
@@ -15,6 +15,8 @@ from optparse import OptionGroup
 from rpy2.robjects.packages import importr
 from subprocess import check_output
 
+from readwrite import PDB, kabsch, read_curve
+
 if len(sys.argv) < 2:
     sys.argv.append('-h')
     
@@ -62,30 +64,36 @@ class NMASaxs():
         trj = bio3d.mktrj(modes, mode=self._options['mode'], mag=self._options['magnitude'], step=self._options['step'], file=self.output)
         self.logger.info('Trajecory models concatenated into file: '+self.output)
         #PARSE TRJ OUTPUT PDB FILE
-        pdbdata = open(self.output, 'r').readlines()
-        all_models = {}
-        model_number = 0
-        for line in pdbdata:
-            if line[0:5] == "MODEL":
-                model_number += 1
-                all_models[model_number] = []
-            if line[0:4] == "ATOM":
-                all_models[model_number].append(line)
-        self.logger.info('Trajectory parsed into '+str(len(all_models.keys()))+' redundant models')
+        with open(self.output, 'rb') as trajectory:
+            number_of_models = sum(1 for line in trajectory if line[0:5] == b'MODEL')
+        self.logger.info('Trajectory has '+str(number_of_models)+' redundant models')
+        window = (number_of_models-2)//4
+        keep = {1: 0}
+        for newno, modelno in enumerate(range(2,window+2), 1):
+            keep[modelno] = newno
+        for newno, modelno in enumerate(range((2*window)+3, (3*window)+3), 1):
+            keep[modelno] = -newno
         self.unique_models = {}
-        self.unique_models[0] = all_models[1]
-        window = (len(all_models.keys())-2)/4
-        first_window = range(2,window+2)
-        newno = 1
-        for modelno in first_window:
-            self.unique_models[newno] = all_models[modelno]
-            newno += 1
-        second_window = range((2*window)+3, (3*window)+3)
-        newno = -1
-        for modelno in second_window:
-            self.unique_models[newno] = all_models[modelno]
-            newno -= 1
+        self.model_chi = {}
+        self.trajectory = PDB(self.output)
+        for modelno, coords in self.trajectory.iter_models():
+            if modelno in keep:
+                self.unique_models[keep[modelno]] = coords
+        self.bfactors = self.trajectory.atoms['bfactor'].copy()
         self.logger.info(str(len(self.unique_models))+' unique models')
+        modelnos = sorted(self.unique_models.keys())
+        rotations, translations, rmsd = kabsch(self.unique_models[0], numpy.array([self.unique_models[modelno] for modelno in modelnos]))
+        for modelno, model_rmsd in zip(modelnos, rmsd.tolist()):
+            self.logger.info('Model '+str(modelno)+' is {0:.2f} Angstroms RMSD from the starting structure'.format(model_rmsd))
+
+    def ModelAtoms(self, modelno):
+        '''Return the ATOM lines of a unique model, with the chi in the bfactor column once it is known'''
+        self.trajectory.setCoordinates(self.unique_models[modelno])
+        if modelno in self.model_chi:
+            self.trajectory.atoms['bfactor'] = self.model_chi[modelno]
+        else:
+            self.trajectory.atoms['bfactor'] = self.bfactors
+        return self.trajectory.return_file(justatoms=True)
         
 
     def CrysolOnSingles(self):
@@ -95,11 +103,11 @@ class NMASaxs():
             for modelno in sorted(self.unique_models.keys()):
                 outfile_name = 'MODEL_'+str(modelno).zfill(3)+'.pdb'
                 with open(outfile_name, 'w') as outfile:
-                    outfile.write('\n'.join(map(str.strip, self.unique_models[modelno])))
+                    outfile.write(self.ModelAtoms(modelno))
 
                 command = 'crysol '+str(outfile_name)+' '+str(self._options['datfile'])
                 self.logger.info('Running: '+command)
-                output = check_output(command, shell=True)
+                output = check_output(command, shell=True).decode()
                 output = output.split('\n')
 
                 try:
@@ -109,60 +117,41 @@ class NMASaxs():
                     self.logger.error('Could not resolve chi as an integer, defaulting to 50')
                     chi_string = "%.2f".rjust(5) % 50.0
                 self.logger.info(str(modelno)+': '+chi_string)
-                replacement_list = []
-                for line in self.unique_models[modelno]:
-                    replacement_list.append(line[0:60]+chi_string+line[66:])
-                self.unique_models[modelno] = replacement_list
+                self.model_chi[modelno] = float(chi_string)
 
     def CrysolOnMultiples(self):
         if not self._options['individual']:
             self.logger.info('Running Crysol and averaging all models')
 
             ###Parse the input dat file
-            datfile = open(self._options['datfile'], 'r').readlines()
-            self.datdict = {'Q': [], 'I': [], 'E': []}
-            for line in datfile:
-                line = line.split()
-                try:
-                    self.datdict['Q'].append(float(line[0]))
-                    self.datdict['I'].append(float(line[1]))
-                    self.datdict['E'].append(float(line[2]))
-                except:
-                    pass
+            self.datdict = dict(zip(['Q', 'I', 'E'], read_curve(self._options['datfile'], 3, ()).T.tolist()))
+            qindex = {}
+            for index, q in enumerate(self.datdict['Q']):
+                qindex.setdefault(q, index)
             ###Run Crysol on all the individuals and parse the outputs
             self.unique_dats = {}
             for modelno in sorted(self.unique_models.keys()):
                 outfile_name = 'MODEL_'+str(modelno).zfill(3)+'.pdb'
                 with open(outfile_name, 'w') as outfile:
-                    outfile.write('\n'.join(map(str.strip, self.unique_models[modelno])))
+                    outfile.write(self.ModelAtoms(modelno))
     
                 command = 'crysol '+str(outfile_name)+' '+str(self._options['datfile'])
                 self.logger.info('Running: '+command)
-                output = check_output(command, shell=True)
+                output = check_output(command, shell=True).decode()
                 output = output.split('\n')
                 fitfile_name = [ line.split()[-1].rstrip() for line in output if re.match(re.compile('.*saved to file.*'), line) ][-1]
-                fitdata = open(fitfile_name, 'r').readlines()
-                qs = []
-                obss = []
-                mods = []
-                self.unique_dats[outfile_name] = {'Q': [], 'OBS': [], 'MOD': [], 'ERR': []} 
-                for line in fitdata:
-                    line = line.split()
-                    try:
-                        if float(line[0]) in self.datdict['Q']:
-                            index = self.datdict['Q'].index(float(line[0]))
-                            self.unique_dats[outfile_name]['Q'].append(float(line[0]))
-                            self.unique_dats[outfile_name]['OBS'].append(float(line[1]))
-                            self.unique_dats[outfile_name]['MOD'].append(float(line[2]))
-                            self.unique_dats[outfile_name]['ERR'].append(self.datdict['E'][index])
-                    except:
-                        pass
+                fitdata = read_curve(fitfile_name, 3, ())
+                ###only keep the points that are in the dat file, with their errors
+                matched = [(row, qindex[q]) for row, q in enumerate(fitdata[:,0].tolist()) if q in qindex]
+                rows = [row for row, index in matched]
+                self.unique_dats[outfile_name] = {'Q': fitdata[rows,0].tolist(), 'OBS': fitdata[rows,1].tolist(), 'MOD': fitdata[rows,2].tolist(),
+                                                  'ERR': [self.datdict['E'][index] for row, index in matched]}
                 self.logger.info('Parsed '+fitfile_name+' with '+str(len(self.unique_dats[outfile_name]['Q']))+' points')
     
             ###Average them all together
             self.averaged_dat = {'Q': [], 'OBS': [], 'MOD': [], 'ERR': []}
-            for q in self.unique_dats[self.unique_dats.keys()[0]]['Q']:
-                index = self.unique_dats[self.unique_dats.keys()[0]]['Q'].index(q)
+            for q in self.unique_dats[list(self.unique_dats.keys())[0]]['Q']:
+                index = self.unique_dats[list(self.unique_dats.keys())[0]]['Q'].index(q)
                 total_obs = []
                 total_mod = []
                 total_err = []
@@ -192,7 +181,7 @@ class NMASaxs():
                 total += ( ( self.averaged_dat['OBS'][index] - scalefactor * self.averaged_dat['MOD'][index] ) / self.averaged_dat['ERR'][index] )
             final_chi = ( total )**2 / len(self.averaged_dat['Q'] )
             self.logger.info('Chi score for average is '+str(final_chi))
-            print self.averaged_dat
+            print(self.averaged_dat)
 
 
                                          
@@ -214,8 +203,7 @@ class NMASaxs():
             with open(self._options['outfile'], 'w') as outfile:
                 for modelno in sorted(self.unique_models.keys()):
                     outfile.write('MODEL'+str(modelno).rjust(9)+'\n')
-                    for line in self.unique_models[modelno]:
-                        outfile.write(line)
+                    outfile.write(self.ModelAtoms(modelno))
                     outfile.write('ENDMDL\n')
 
     def OutputMultipleFiles(self):
@@ -223,8 +211,7 @@ class NMASaxs():
             self.logger.info('Outputting all models to multiple, single-model files')
             for modelno in sorted(self.unique_models.keys()):
                 with open('MODEL_'+str(modelno).zfill(3)+'.pdb', 'w') as outfile:
-                    for line in self.unique_models[modelno]:
-                        outfile.write(line)
+                    outfile.write(self.ModelAtoms(modelno))
                     outfile.write('END\n')
                               
 if __name__ == '__main__':
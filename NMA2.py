@@ -15,6 +15,8 @@ from optparse import OptionGroup
 from rpy2.robjects.packages import importr
 from subprocess import check_output
 
+from readwrite import PDB
+
 if len(sys.argv) < 2:
     sys.argv.append('-h')
     
@@ -53,6 +55,7 @@ class NMASaxs():
         self.mode = 7
         self.filelist_before = os.listdir(os.getcwd())
         self.unique_models = {}
+        self.trajectory = None
         
     def SetInputPDB(self, input=False):
         if os.path.isfile(input) and input[-4:] == '.pdb':
@@ -129,35 +132,30 @@ class NMASaxs():
 
     def SplitOutputModel(self):
         #PARSE TRJ OUTPUT PDB FILE
-        try:
-            pdbdata = open(self.output, 'r').readlines()
-        except:
+        if not os.path.isfile(self.output):
             self.logger.error('Could not find the output file')
             return False
-        all_models = {}
-        model_number = 0
-        for line in pdbdata:
-            if line[0:5] == "MODEL":
-                model_number += 1
-                all_models[model_number] = []
-            if line[0:4] == "ATOM":
-                all_models[model_number].append(line)
-        self.logger.info('Trajectory parsed into '+str(len(all_models.keys()))+' redundant models')
-        self.unique_models[0] = all_models[1]
-        window = int(round((len(all_models.keys())-2)/4))
-        first_window = range(2,window+2)
-        newno = 1
-        for modelno in first_window:
-            self.unique_models[newno] = all_models[modelno]
-            newno += 1
-        second_window = range((2*window)+3, (3*window)+3)
-        newno = -1
-        for modelno in second_window:
-            self.unique_models[newno] = all_models[modelno]
-            newno -= 1
+        with open(self.output, 'rb') as trajectory:
+            number_of_models = sum(1 for line in trajectory if line[0:5] == b'MODEL')
+        self.logger.info('Trajectory has '+str(number_of_models)+' redundant models')
+        window = int(round((number_of_models-2)/4))
+        keep = {1: 0}
+        for newno, modelno in enumerate(range(2,window+2), 1):
+            keep[modelno] = newno
+        for newno, modelno in enumerate(range((2*window)+3, (3*window)+3), 1):
+            keep[modelno] = -newno
+        self.trajectory = PDB(self.output)
+        for modelno, coords in self.trajectory.iter_models():
+            if modelno in keep:
+                self.unique_models[keep[modelno]] = coords
         self.logger.info(str(len(self.unique_models))+' unique models')
         return True
 
+    def ModelAtoms(self, modelno):
+        '''Return the ATOM lines of one of the unique models as a string'''
+        self.trajectory.setCoordinates(self.unique_models[modelno])
+        return self.trajectory.return_file(justatoms=True)
+
     def RemoveTempFiles(self):
         self.logger.info('Deleting temporary files')
         filelist_after = os.listdir(os.getcwd())
@@ -174,8 +172,7 @@ class NMASaxs():
         print(output_prefix)
         for modelno in sorted(self.unique_models.keys()):
             with open(output_prefix+str(modelno).zfill(3)+'.pdb', 'w') as outfile:
-                for line in self.unique_models[modelno]:
-                    outfile.write(line)
+                outfile.write(self.ModelAtoms(modelno))
                 outfile.write('END\n')
 
 
@@ -184,8 +181,7 @@ class NMASaxs():
         with open(self.output, 'w') as outfile:
             for modelno in sorted(self.unique_models.keys()):
                 outfile.write('MODEL'+str(modelno).rjust(9)+'\n')
-                for line in self.unique_models[modelno]:
-                    outfile.write(line)
+                outfile.write(self.ModelAtoms(modelno))
                 outfile.write('ENDMDL\n')
             outfile.write('END\n')
                     
@@ -0,0 +1,190 @@
+#!/opt/anaconda3/bin/python
+'''
+Created on Oct 18, 2026
+
+'''
+
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+from optparse import OptionParser
+from optparse import OptionGroup
+from time import time as time
+
+import numpy
+
+from readwrite import PDB
+
+class PdbBenchmark(object):
+    """Time the pdb and mmCIF parsers on synthetic structures of increasing size
+
+    Writes a synthetic file in each requested format for each number
+    of atoms into a scratch directory, times readwrite.PDB.parse_file
+    on it and reports the time per atom and the scaling exponent from
+    a log-log fit of time against size. A linear parser should give an
+    exponent close to 1.
+
+    """
+
+    '''
+    Constructor
+    '''
+    __version__ = '1.0'
+    def __init__(self, sizes=(1000, 10000, 100000, 1000000), repeats=3, formats=('pdb',)):
+        ###start a log file
+        self.logger = logging.getLogger('PdbBenchmark')
+        self.logger.setLevel(logging.INFO)
+        if len(self.logger.handlers) == 0:
+            formatter = logging.Formatter('%(asctime)s: %(levelname)s: %(module)s: %(message)s',"[%Y-%m-%d %H:%M:%S]")
+            streamhandler = logging.StreamHandler()
+            streamhandler.setFormatter(formatter)
+            self.logger.addHandler(streamhandler)
+        self.logger.info('Starting a new PdbBenchmark job')
+
+        self.sizes = list(sizes)
+        self.repeats = repeats
+        self.formats = list(formats)
+        self.results = []
+
+    def set_sizes(self, sizes='1000,10000,100000,1000000'):
+        '''Set the atom counts to benchmark from a comma delimited string'''
+        try:
+            self.sizes = [int(size) for size in str(sizes).split(',')]
+            self.logger.info('Will benchmark '+', '.join([str(size) for size in self.sizes])+' atoms')
+        except:
+            self.logger.error('Sizes should be a comma delimited list of integers i.e. 1000,10000')
+
+    def set_repeats(self, repeats=3):
+        '''Set how many times each file is parsed, the best time is kept'''
+        try:
+            self.repeats = max(1, int(repeats))
+        except:
+            self.logger.error('Repeats must be an integer')
+
+    def set_formats(self, formats='pdb'):
+        '''Set the file formats to benchmark from a comma delimited string of pdb and cif'''
+        formats = [fmt.strip().lower() for fmt in str(formats).split(',')]
+        if all([fmt in ['pdb', 'cif'] for fmt in formats]):
+            self.formats = formats
+            self.logger.info('Will benchmark '+', '.join(self.formats)+' files')
+        else:
+            self.logger.error('Formats should be a comma delimited list of pdb and cif')
+
+    def set_log_level(self, level=logging.INFO):
+        if level in logging._levelToName.keys():
+            self.logger.setLevel(level)
+            self.logger.info(f'Set log level to: {logging._levelToName[level]}')
+        else:
+            self.logger.error(f'Could not set log level to: {level}')
+
+    def WriteSyntheticPdb(self, filename, atoms):
+        '''Write a pdb file with the given number of atoms in residues of five atoms and chains of 9999 residues'''
+        names = [' N  ', ' CA ', ' C  ', ' O  ', ' CB ']
+        residues = ['ALA', 'GLY', 'LEU', 'SER', 'TRP', 'TYR']
+        chains = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+        rng = random.Random(atoms)
+        coords = numpy.random.default_rng(atoms).uniform(-999, 999, (atoms, 3))
+        with open(filename, 'w') as outfile:
+            outfile.write('HEADER    SYNTHETIC BENCHMARK STRUCTURE\n')
+            for i in range(atoms):
+                residue_count = i // 5
+                chain = chains[(residue_count // 9999) % len(chains)]
+                if i % 5 == 0:
+                    residue = rng.choice(residues)
+                outfile.write('ATOM  %5d %4s %3s %1s%4d    %8.3f%8.3f%8.3f%6.2f%6.2f          %2s  \n' % (
+                    (i % 99999) + 1, names[i % 5], residue, chain, (residue_count % 9999) + 1,
+                    coords[i, 0], coords[i, 1], coords[i, 2], 1.0, 20.0, names[i % 5].strip()[0]))
+            outfile.write('END\n')
+
+    def WriteSyntheticCif(self, filename, atoms):
+        '''Write an mmCIF file with the given number of atoms, without the pdb limits on serial numbers and chains'''
+        names = ['N', 'CA', 'C', 'O', 'CB']
+        residues = ['ALA', 'GLY', 'LEU', 'SER', 'TRP', 'TYR']
+        rng = random.Random(atoms)
+        coords = numpy.random.default_rng(atoms).uniform(-999, 999, (atoms, 3))
+        items = ['group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_alt_id', 'label_comp_id', 'label_asym_id',
+                 'label_seq_id', 'pdbx_PDB_ins_code', 'Cartn_x', 'Cartn_y', 'Cartn_z', 'occupancy', 'B_iso_or_equiv',
+                 'pdbx_formal_charge', 'auth_seq_id', 'auth_comp_id', 'auth_asym_id', 'auth_atom_id', 'pdbx_PDB_model_num']
+        with open(filename, 'w') as outfile:
+            outfile.write('data_synthetic\n#\nloop_\n')
+            for item in items:
+                outfile.write('_atom_site.'+item+'\n')
+            for i in range(atoms):
+                residue_count = i // 5
+                chain = 'C'+str(residue_count // 9999)
+                if i % 5 == 0:
+                    residue = rng.choice(residues)
+                name = names[i % 5]
+                seq = (residue_count % 9999) + 1
+                outfile.write('ATOM %d %s %s . %s %s %d ? %.3f %.3f %.3f 1.00 20.00 ? %d %s %s %s 1\n' % (
+                    i + 1, name[0], name, residue, chain, seq, coords[i, 0], coords[i, 1], coords[i, 2], seq, residue, chain, name))
+            outfile.write('#\n')
+
+    def TimeParse(self, filename):
+        '''Return the best wall clock time in seconds to parse a file'''
+        timings = []
+        for repeat in range(self.repeats):
+            pdb = PDB(filename)
+            pdb.logger.setLevel(logging.WARNING)
+            start = time()
+            pdb.parse_file()
+            timings.append(time() - start)
+        return min(timings)
+
+    def Run(self):
+        self.logger.info('Running the parser benchmark')
+        workdir = tempfile.mkdtemp(prefix='pdbbenchmark_')
+        try:
+            for fmt in self.formats:
+                for atoms in self.sizes:
+                    filename = os.path.join(workdir, 'synthetic_'+str(atoms)+'.'+fmt)
+                    if fmt == 'cif':
+                        self.WriteSyntheticCif(filename, atoms)
+                    else:
+                        self.WriteSyntheticPdb(filename, atoms)
+                    seconds = self.TimeParse(filename)
+                    self.results.append((fmt, atoms, seconds))
+                    self.logger.info('{0}: {1:>9d} atoms: {2:9.4f} s, {3:7.3f} us per atom'.format(fmt, atoms, seconds, 1e6 * seconds / atoms))
+        finally:
+            shutil.rmtree(workdir)
+        return self.results
+
+    def ScalingExponent(self):
+        '''Slope of log(time) against log(atoms) for each format, 1 for a linear parser and 2 for a quadratic one'''
+        exponents = {}
+        for fmt in self.formats:
+            results = [result for result in self.results if result[0] == fmt]
+            if len(results) < 2:
+                self.logger.error('Need at least two sizes to work out the scaling')
+                continue
+            atoms = numpy.log([float(result[1]) for result in results])
+            seconds = numpy.log([result[2] for result in results])
+            exponents[fmt] = numpy.polyfit(atoms, seconds, 1)[0]
+            self.logger.info('{0} parse time scales as atoms^{1:.2f}'.format(fmt, exponents[fmt]))
+        return exponents
+
+if __name__ == '__main__':
+
+    parser = OptionParser()
+    optional = OptionGroup(parser, "Optional Arguments")
+    optional.add_option("-s", "--sizes", action="store", type="string", dest="sizes", default="1000,10000,100000,1000000", help="Comma delimited list of atom counts to benchmark (default 1000,10000,100000,1000000)") #A STRING
+    optional.add_option("-r", "--repeats", action="store", type="int", dest="repeats", default=3, help="Number of times to parse each file, the best time is reported (default 3)") #AN INTEGER
+    optional.add_option("-f", "--formats", action="store", type="string", dest="formats", default="pdb", help="Comma delimited list of file formats to benchmark, pdb and/or cif (default pdb)") #A STRING
+    optional.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False, help="Verbose mode, set log level to debug") #A BOOLEAN
+
+    parser.add_option_group(optional)
+    (options, args) = parser.parse_args()
+
+    job = PdbBenchmark()
+    if options.verbose:
+        job.set_log_level(logging.DEBUG)
+    job.set_sizes(options.sizes)
+    job.set_repeats(options.repeats)
+    job.set_formats(options.formats)
+    job.Run()
+    job.ScalingExponent()
+
+    job.logger.info('Finished normally')
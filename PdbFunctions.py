@@ -11,13 +11,17 @@ import logging
 import os
 import re
 import copy
+import glob
+import io
+from multiprocessing import Pool
 from optparse import OptionParser
 from optparse import OptionGroup
 from subprocess import check_output
+from time import time as time
 
 import numpy
 
-from mendeleev import element
+from readwrite import PdbDict, read_pdb_file, write_pdb, rotation_matrix, affine_matrix, atom_weights
 
 class PDB():
     """Read and write pdb files
@@ -77,132 +81,36 @@ class PDB():
         self.integer_records = ['serial_no', 'residue_no']
         self.float_records = {'bfactor': 2, 'occupancy': 2, 'x': 3, 'y': 3, 'z': 3}
 
-        file = open(self.pdbfile, 'r')
-        pdblines = file.readlines()
-
-        for line in pdblines:
-            index = pdblines.index(line)
-            self.pdb_dict[index] = {}
-            record_type = line[self.pdb_definition['record_type'][0]:self.pdb_definition['record_type'][1]].rstrip()
-            if record_type == 'ATOM' or record_type == 'HETATM':
-                for record in self.pdb_definition.keys():
-                    try:
-                        if record in self.integer_records:
-                            self.pdb_dict[index][record] = int(line[self.pdb_definition[record][0]:self.pdb_definition[record][1]].strip())
-                        elif record in self.float_records.keys():
-                            self.pdb_dict[index][record] = float(line[self.pdb_definition[record][0]:self.pdb_definition[record][1]].strip())
-                        else:
-                            self.pdb_dict[index][record] = line[self.pdb_definition[record][0]:self.pdb_definition[record][1]].strip()
-                    except:
-                        pass
-            else:
-                self.pdb_dict[index]['record_type'] = line[self.pdb_definition['record_type'][0]:self.pdb_definition['record_type'][1]].rstrip()
-                self.pdb_dict[index]['string'] = line[self.pdb_definition['string'][0]:-1]+line[-1]
+        atoms, others = read_pdb_file(self.pdbfile, self.pdb_definition)
+        self.pdb_dict = PdbDict(atoms, others)
+        self.logger.info('Parsed '+str(len(atoms))+' atoms')
 
     def Write(self, justatoms=False):
         if justatoms:
             justatoms = True
             self.logger.info('Will only return the atom lines')
+        output = io.StringIO()
+        write_pdb(output, self.pdb_dict, justatoms)
+        return output.getvalue()
 
-        output_lines = []
-        #ljust_records = [ 'record_type', 'atom_name', 'string' ]
-        ljust_records = [ 'record_type', 'string' ]
-        
-        for index in sorted(self.pdb_dict.keys()):
-            try:
-                if len(self.pdb_dict[index]['atom_name']) < 4:
-                    self.pdb_dict[index]['atom_name'] = ' '+self.pdb_dict[option][index]['atom_name']
-            except:
-                pass
-            line = list(' '*80)
-            for record in self.pdb_dict[index]:
-                try:
-                    length = self.pdb_definition[record][1] - self.pdb_definition[record][0]
-                except:
-                    length = 80 - self.pdb_definition[record][0]
-                if record in self.float_records:
-                    if record in ljust_records:
-                        content = list((('%.'+str(self.float_records[record])+'f') % self.pdb_dict[index][record]).ljust(length))
-                    else:
-                        content = list((('%.'+str(self.float_records[record])+'f') % self.pdb_dict[index][record]).rjust(length))
-                        
-                else:
-                    if record in ljust_records:
-                        content = list(str(self.pdb_dict[index][record]).ljust(length))
-                    else:
-                        if record == 'atom_name':
-                            temp_string = str(self.pdb_dict[index][record]).ljust(3)
-                        else:
-                            temp_string = str(self.pdb_dict[index][record])
-                        content = list(temp_string.rjust(length))
-            
-                try:
-                    line[self.pdb_definition[record][0]:self.pdb_definition[record][1]] = content[0:]
-                except:
-                    line[self.pdb_definition[record][0]:80] = content[0:]
-            if justatoms:
-                if self.pdb_dict[index]['record_type'] == 'ATOM' or self.pdb_dict[index]['record_type'] == 'HETATM':
-                    output_lines.append(''.join(line))
-            else:
-                output_lines.append(''.join(line))
-
-
-        return '\n'.join(output_lines)+'\n'
-
+    def AtomMasses(self):
+        return atom_weights(self.pdb_dict.atoms, 'mass', self.logger)
 
     def MolecularWeight(self):
         self.logger.info('Calculating molecular weight')
-        total_mass = 0
-        for index in self.pdb_dict.keys():
-            if self.pdb_dict[index]['record_type'] == 'ATOM' or self.pdb_dict[index]['record_type'] == 'HETATM':
-                if self.pdb_dict[index]['element'] != '':
-                    atom_name = self.pdb_dict[index]['element']
-                else:
-                    atom_name = self.pdb_dict[index]['atom_name'][0]
-
-                try:
-                    mass = element(atom_name).mass
-                    total_mass += mass
-
-                except:
-                    self.logger.error('Failed to find mass for element '+str(atom_name))
-        return total_mass
+        mass, mask = self.AtomMasses()
+        return mass.sum()
         
     def CentreOnOrigin(self):
         self.logger.info('Will move centre of mass to 0,0,0')
 
         #calculate centre of mass
-        total_mass = 0
-        total_x = 0
-        total_y = 0
-        total_z = 0
-        for index in self.pdb_dict.keys():
-            if self.pdb_dict[index]['record_type'] == 'ATOM' or self.pdb_dict[index]['record_type'] == 'HETATM':
-                if self.pdb_dict[index]['element'] != '':
-                    atom_name = self.pdb_dict[index]['element']
-                else:
-                    atom_name = self.pdb_dict[index]['atom_name'][0]
-
-                try:
-                    mass = element(atom_name).mass
-                    total_mass += mass
-                    total_x += (mass * self.pdb_dict[index]['x'])
-                    total_y += (mass * self.pdb_dict[index]['y'])
-                    total_z += (mass * self.pdb_dict[index]['z'])
-
-                except:
-                    self.logger.error('Failed to find mass for element '+str(atom_name))
-
+        mass, mask = self.AtomMasses()
+        total_mass = mass.sum()
+        average_x, average_y, average_z = (numpy.dot(mass, self.pdb_dict.atoms.coords[mask]) / total_mass).tolist()
         self.logger.info('Total mass is {:.2f} KDa'.format(total_mass / 1000))
-        average_x = total_x / total_mass
-        average_y = total_y / total_mass
-        average_z = total_z / total_mass
         self.logger.info('Centre of mass is currently: {0:.2f},{1:.2f},{2:.2f}'.format(average_x,average_y,average_z))
-        for index in self.pdb_dict.keys():
-            if self.pdb_dict[index]['record_type'] == 'ATOM' or self.pdb_dict[index]['record_type'] == 'HETATM':
-                self.pdb_dict[index]['x'] -= average_x
-                self.pdb_dict[index]['y'] -= average_y
-                self.pdb_dict[index]['z'] -= average_z
+        self.pdb_dict.atoms.transform(affine_matrix(translation=(-average_x, -average_y, -average_z)))
         self.logger.info('Moved molecule to 0,0,0')
 
     def Scale(self, factor):
@@ -211,10 +119,7 @@ class PDB():
         except:
             sys.exit('Scale factor must be an integer or float')
 
-        for index in self.pdb_dict.keys():
-           if self.pdb_dict[index]['record_type'] == 'ATOM' or self.pdb_dict[index]['record_type'] == 'HETATM':
-               for axis in ['x','y','z']:
-                   self.pdb_dict[index][axis] *= factor
+        self.pdb_dict.atoms.transform(numpy.diag([factor, factor, factor, 1.0]))
 
     def DistanceBetween(self, first, second):
         try:
@@ -223,28 +128,20 @@ class PDB():
         except:
             self.logger.error('The DistanceBetween function requires two integers for the atom numbers')
             sys.exit()
-        first_index = []
-        second_index = []
-        for index in self.pdb_dict.keys():
-            try:
-                if self.pdb_dict[index]['serial_no'] == first:
-                    first_index.append(first)
-                if self.pdb_dict[index]['serial_no'] == second:
-                    second_index.append(second)
-            except:
-                pass
+        atoms = self.pdb_dict.atoms
+        index = atoms.atom_index()
+        first_row = index.serial(first)
+        second_row = index.serial(second)
 
-        if len(first_index) == 0 or len(second_index) == 0:
+        if first_row == None or second_row == None:
             self.logger.error('One of the atom numbers that you gave does not exist')
             sys.exit()
-        if len(first_index) > 1:
+        if index.serial_count(first) > 1:
             self.logger.error('There was more than one atom with the number '+str(first)+', will use first instance')
-        if len(second_index) > 1:
+        if index.serial_count(second) > 1:
             self.logger.error('There was more than one atom with the number '+str(second)+', will use first instance')
 
-        distance = numpy.sqrt( numpy.power(self.pdb_dict[first_index[0]]['x'] - self.pdb_dict[second_index[0]]['x'], 2) +\
-                               numpy.power(self.pdb_dict[first_index[0]]['y'] - self.pdb_dict[second_index[0]]['y'], 2) +\
-                               numpy.power(self.pdb_dict[first_index[0]]['z'] - self.pdb_dict[second_index[0]]['z'], 2) )
+        distance = numpy.linalg.norm(atoms.coords[first_row] - atoms.coords[second_row])
 
         return distance
 
@@ -259,26 +156,9 @@ class PDB():
         else:
             self.logger.error("Rotation axis and angle must be in form 'x10' or 'Z2.5'")
             sys.exit()
-            
-        def rotation_matrix(axis,theta):
-            theta = numpy.radians(theta)
-            if axis == 'X':
-                return numpy.array([[1,0,0],[0,numpy.cos(theta),-numpy.sin(theta)],[0,numpy.sin(theta),numpy.cos(theta)]])
-            elif axis == 'Y':
-                return numpy.array([[numpy.cos(theta),0,numpy.sin(theta)],[0,1,0],[-numpy.sin(theta),0,numpy.cos(theta)]])
-            elif axis == 'Z':
-                return numpy.array([[numpy.cos(theta),-numpy.sin(theta),0],[numpy.sin(theta),numpy.cos(theta),0],[0,0,1]])
-            else:
-                sys.exit('error matrix function, required axis is neither x,y or z!')
 
         self.logger.info('Rotating around '+str(axis)+' by '+str(theta)+' degrees')
-        for index in self.pdb_dict.keys():
-            if self.pdb_dict[index]['record_type'] == 'ATOM' or self.pdb_dict[index]['record_type'] == 'HETATM':
-                v = numpy.array([self.pdb_dict[index]['x'],self.pdb_dict[index]['y'],self.pdb_dict[index]['z']])
-                newcoords = (numpy.dot(rotation_matrix(axis, theta),v))
-                self.pdb_dict[index]['x'] = float(newcoords[0])
-                self.pdb_dict[index]['y'] = float(newcoords[1])
-                self.pdb_dict[index]['z'] = float(newcoords[2])
+        self.pdb_dict.atoms.transform(affine_matrix(rotation=rotation_matrix(axis, theta)))
 
     def Translate(self, option):
         translation = []
@@ -291,11 +171,7 @@ class PDB():
             self.logger.error("The translation matrix should be in the form i.e. '10.2,9.6,0.0'")
             sys.exit()
         self.logger.info('Translating by '+str(translation[0])+'x'+str(translation[1])+'x'+str(translation[2]))
-        for index in self.pdb_dict.keys():
-            if self.pdb_dict[index]['record_type'] == 'ATOM' or self.pdb_dict[index]['record_type'] == 'HETATM':
-                self.pdb_dict[index]['x'] = self.pdb_dict[index]['x'] + translation[0]
-                self.pdb_dict[index]['y'] = self.pdb_dict[index]['y'] + translation[1]
-                self.pdb_dict[index]['z'] = self.pdb_dict[index]['z'] + translation[2]
+        self.pdb_dict.atoms.transform(affine_matrix(translation=translation))
                               
     def ChainName(self, new):
         new = str(new).upper()
@@ -305,13 +181,213 @@ class PDB():
             self.logger.error('Chain name should be a single letter')
             sys.exit()
 
-        for index in self.pdb_dict.keys():
-            if self.pdb_dict[index]['record_type'] == 'ATOM' or self.pdb_dict[index]['record_type'] == 'HETATM':
-                self.pdb_dict[index]['chain'] = new
+        atoms = self.pdb_dict.atoms
+        atoms.assign('chain', new, atoms.atom_mask())
                 
 
+###recipe step names and the PDB methods they call
+recipe_steps = {
+    'centre': 'CentreOnOrigin',
+    'scale': 'Scale',
+    'rotate': 'Rotate',
+    'translate': 'Translate',
+    'chain': 'ChainName'}
+
+def ParseRecipe(recipe):
+    """Turn 'centre;rotate:x10;translate:1,2,3;chain:B' into a list of (method, argument) steps"""
+    steps = []
+    for step in [step.strip() for step in str(recipe).split(';') if step.strip()]:
+        name, separator, argument = step.partition(':')
+        name = name.strip().lower()
+        if not name in recipe_steps:
+            raise ValueError('Unknown recipe step "'+name+'", use one of '+', '.join(sorted(recipe_steps.keys())))
+        if name != 'centre' and argument == '':
+            raise ValueError('Recipe step "'+name+'" needs an argument i.e. '+name+':value')
+        steps.append((recipe_steps[name], argument if name != 'centre' else None))
+    return steps
+
+def TransformFile(pdbfile, steps, outfile):
+    """Apply recipe steps to one pdb file and write it to outfile
+
+    Returns (pdbfile, outfile, seconds, error) with outfile None and
+    the error message if anything failed, PDB exits included, so one
+    bad file does not stop a batch. A file with no atoms, or with
+    coordinates that are not finite after the steps, has failed.
+    """
+    start = time()
+    try:
+        job = PDB(pdbfile)
+        job.Read()
+        if len(job.pdb_dict.atoms) == 0:
+            raise ValueError('no atoms were read from '+str(pdbfile))
+        for method, argument in steps:
+            if argument == None:
+                getattr(job, method)()
+            else:
+                getattr(job, method)(argument)
+        if not numpy.isfinite(job.pdb_dict.atoms.coords).all():
+            raise ValueError('the recipe gave coordinates that are not finite')
+        if not os.path.isdir(os.path.dirname(outfile)):
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+        with open(outfile, 'w') as output:
+            write_pdb(output, job.pdb_dict)
+        return pdbfile, outfile, time() - start, None
+    except (Exception, SystemExit) as error:
+        ###a bare sys.exit() has no message, so fall back on the exception itself
+        return pdbfile, None, time() - start, str(error) or repr(error)
+
+def _QuietWorker():
+    ###each file would otherwise log several lines from every worker
+    logging.disable(logging.INFO)
+
+def _TransformTask(task):
+    return TransformFile(*task)
+
+class PdbBatch(object):
+    """Apply one transform recipe to many pdb files in one interpreter
+
+    Input files come from a glob and/or a manifest (one path per
+    line, # for comments), each file is only used once. Outputs keep
+    the directories of the inputs below the directory they have in
+    common, so poses/1/model.pdb and poses/2/model.pdb are written to
+    outdir/1/model.pdb and outdir/2/model.pdb. The recipe is a ; delimited list of steps
+    run in order, see ParseRecipe. Files are shared out over a pool of
+    worker processes and every result is logged and written to the
+    output directory as it finishes, with a timings.txt of the seconds
+    each file took.
+
+    """
+
+    '''
+    Constructor
+    '''
+    __version__ = '1.0'
+    def __init__(self, outdir='.', processes=None):
+        ###start a log file
+        self.logger = logging.getLogger('PdbBatch')
+        self.logger.setLevel(logging.INFO)
+        if len(self.logger.handlers) == 0:
+            formatter = logging.Formatter('%(asctime)s: %(levelname)s: %(module)s: %(message)s',"[%Y-%m-%d %H:%M:%S]")
+            streamhandler = logging.StreamHandler()
+            streamhandler.setFormatter(formatter)
+            self.logger.addHandler(streamhandler)
+        self.logger.info('Starting a new PdbBatch job')
+
+        self.files = []
+        self.steps = []
+        self.outdir = outdir
+        self.processes = processes
+        self.results = []
+
+    def set_files(self, pattern=None, manifest=None):
+        '''Collect input files from a glob pattern and/or a manifest file'''
+        files = []
+        if pattern:
+            files.extend(sorted(glob.glob(pattern)))
+        if manifest:
+            try:
+                with open(manifest) as manifest_file:
+                    files.extend([line.strip() for line in manifest_file if line.strip() and not line.strip().startswith('#')])
+            except IOError:
+                self.logger.error('Could not read the manifest: '+str(manifest))
+        pdbfiles = [pdbfile for pdbfile in files if pdbfile[-4:] == '.pdb']
+        if len(pdbfiles) < len(files):
+            self.logger.error('Skipping '+str(len(files) - len(pdbfiles))+' files that are not of type ".pdb"')
+        ###a file in both the glob and the manifest would be written by two workers
+        self.files = []
+        seen = set()
+        for pdbfile in pdbfiles:
+            if os.path.abspath(pdbfile) not in seen:
+                seen.add(os.path.abspath(pdbfile))
+                self.files.append(pdbfile)
+        if len(self.files) < len(pdbfiles):
+            self.logger.info('Skipping '+str(len(pdbfiles) - len(self.files))+' files that were listed more than once')
+        self.logger.info('Found '+str(len(self.files))+' pdb files')
+
+    def set_recipe(self, recipe=''):
+        '''Set the transform recipe, i.e. "centre;rotate:x10;translate:1,2,3;chain:B"'''
+        try:
+            self.steps = ParseRecipe(recipe)
+            self.logger.info('Recipe: '+' then '.join([method+('('+argument+')' if argument != None else '') for method, argument in self.steps]))
+        except ValueError as error:
+            self.logger.error(str(error))
+            sys.exit()
+
+    def set_outdir(self, outdir='.'):
+        self.outdir = outdir
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        self.logger.info('Writing transformed files to: '+str(outdir))
+
+    def set_processes(self, processes=None):
+        '''Number of worker processes, default is one per cpu'''
+        try:
+            self.processes = max(1, int(processes)) if processes else None
+        except:
+            self.logger.error('Processes must be an integer')
+
+    def set_log_level(self, level=logging.INFO):
+        if level in logging._levelToName.keys():
+            self.logger.setLevel(level)
+            self.logger.info(f'Set log level to: {logging._levelToName[level]}')
+        else:
+            self.logger.error(f'Could not set log level to: {level}')
+
+    def OutputNames(self):
+        '''Output file of every input, keeping the directories below the one they all share so equal names do not collide'''
+        if len(self.files) == 0:
+            return []
+        paths = [os.path.abspath(pdbfile) for pdbfile in self.files]
+        common = os.path.commonpath([os.path.dirname(path) for path in paths])
+        return [os.path.join(self.outdir, os.path.relpath(path, common)) for path in paths]
+
+    def Run(self):
+        self.logger.info('Transforming '+str(len(self.files))+' files')
+        start = time()
+        tasks = [(pdbfile, self.steps, outfile) for pdbfile, outfile in zip(self.files, self.OutputNames())]
+        chunksize = max(1, len(tasks) // (4 * (self.processes or os.cpu_count() or 1)))
+        self.results = []
+        with open(os.path.join(self.outdir, 'timings.txt'), 'w') as timings:
+            with Pool(self.processes, initializer=_QuietWorker) as pool:
+                for pdbfile, outfile, seconds, error in pool.imap_unordered(_TransformTask, tasks, chunksize):
+                    self.results.append((pdbfile, outfile, seconds, error))
+                    timings.write('{0}\t{1:.4f}\t{2}\n'.format(pdbfile, seconds, 'ok' if error == None else 'failed: '+error))
+                    if error == None:
+                        self.logger.debug('{0} -> {1} in {2:.4f} s'.format(pdbfile, outfile, seconds))
+                    else:
+                        self.logger.error('{0} failed after {1:.4f} s: {2}'.format(pdbfile, seconds, error))
+        failed = len([result for result in self.results if result[3] != None])
+        self.logger.info('Transformed {0} files in {1:.2f} s, {2} failed'.format(len(self.results) - failed, time() - start, failed))
+        return self.results
+
 if __name__ == '__main__':
-    job = PDB(sys.argv[1])
-    job.Read()
-    #job.Scale(0.1)
-    print job.Write()
+
+    parser = OptionParser(usage='%prog file.pdb | %prog -i "poses/*.pdb" -r "centre;rotate:x10" -o outdir')
+    batch = OptionGroup(parser, "Batch Arguments")
+    batch.add_option("-i", "--input", action="store", type="string", dest="pattern", default=None, help="Glob pattern of pdb files to transform, quote it i.e. \"poses/*.pdb\"") #A STRING
+    batch.add_option("-m", "--manifest", action="store", type="string", dest="manifest", default=None, help="A file listing one pdb file per line to transform") #A STRING
+    batch.add_option("-r", "--recipe", action="store", type="string", dest="recipe", default="", help="Transforms to apply in order, delimited by ; from centre, scale:factor, rotate:x10, translate:x,y,z and chain:B") #A STRING
+    batch.add_option("-o", "--outdir", action="store", type="string", dest="outdir", default="transformed", help="Directory to write the transformed files to (default transformed)") #A STRING
+    batch.add_option("-n", "--processes", action="store", type="int", dest="processes", default=None, help="Number of worker processes (default one per cpu)") #AN INTEGER
+    batch.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False, help="Verbose mode, log every file") #A BOOLEAN
+
+    parser.add_option_group(batch)
+    (options, args) = parser.parse_args()
+
+    if options.pattern or options.manifest:
+        job = PdbBatch()
+        if options.verbose:
+            job.set_log_level(logging.DEBUG)
+        job.set_files(options.pattern, options.manifest)
+        job.set_recipe(options.recipe)
+        job.set_outdir(options.outdir)
+        job.set_processes(options.processes)
+        job.Run()
+        job.logger.info('Finished normally')
+    elif len(args) > 0:
+        job = PDB(args[0])
+        job.Read()
+        #job.Scale(0.1)
+        print(job.Write())
+    else:
+        parser.print_help()
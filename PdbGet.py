@@ -1,35 +1,259 @@
-#!/anaconda/bin/python
+#!/opt/anaconda3/bin/python
+'''
+Created on Oct 18, 2026
+
+'''
 
-import urllib2
 import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
 import sys
-import StringIO
+import tempfile
+import urllib.request
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+from optparse import OptionGroup
+from time import sleep
+from time import time as time
+
+class PdbGet(object):
+    """Download structures from the PDB, or a mirror, into a local cache
+
+    Codes are fetched concurrently by a bounded pool of threads. Each
+    response is decompressed as it streams in and written to a
+    temporary file in the cache while its sha256 is worked out, then
+    moved to objects/<sha256[:2]>/<sha256> in the cache. index.json in
+    the cache maps each code and format to its hash, so a code that has
+    been fetched before is copied from the cache without touching the
+    network. The base URL can be a URL or template with {code},
+    {lower}, {middle} and {format} fields, or a local mirror directory.
+
+    """
+
+    '''
+    Constructor
+    '''
+    __version__ = '2.0'
+    base_url = 'https://files.rcsb.org/download/'
+    filename = '{code}.{format}.gz'
+    chunk = 1 << 16
+    def __init__(self):
+        ###start a log file
+        self.logger = logging.getLogger('PdbGet')
+        self.logger.setLevel(logging.INFO)
+        if len(self.logger.handlers) == 0:
+            formatter = logging.Formatter('%(asctime)s: %(levelname)s: %(module)s: %(message)s',"[%Y-%m-%d %H:%M:%S]")
+            streamhandler = logging.StreamHandler()
+            streamhandler.setFormatter(formatter)
+            self.logger.addHandler(streamhandler)
+        self.logger.info('Starting a new PdbGet job')
+
+        self.codes = []
+        self.url = self.base_url + self.filename
+        self.cache = os.path.join(os.path.expanduser('~'), '.pdbget')
+        self.outdir = os.getcwd()
+        self.threads = 8
+        self.retries = 3
+        self.timeout = 60
+        self.format = 'pdb'
+        self.results = []
+
+    def set_codes(self, codes=[], listfile=None):
+        '''Set the four character codes to fetch from a list and/or a file with one or more codes per line'''
+        codes = list(codes)
+        if listfile:
+            try:
+                with open(listfile) as infile:
+                    codes.extend(infile.read().replace(',', ' ').split())
+            except IOError:
+                self.logger.error('Could not read the list of codes in '+str(listfile))
+                return False
+        self.codes = []
+        for code in codes:
+            if len(code) == 4 and code.isalnum():
+                if code.upper() not in self.codes:
+                    self.codes.append(code.upper())
+            else:
+                self.logger.error('PDB codes have 4 characters, skipping '+str(code))
+        self.logger.info('Will fetch '+str(len(self.codes))+' structures')
+        return len(self.codes) > 0
+
+    def set_url(self, url=None):
+        '''Set the URL, URL template or mirror directory the files are fetched from'''
+        if url == None:
+            url = self.base_url
+        if os.path.isdir(url):
+            url = 'file://' + urllib.request.pathname2url(os.path.abspath(url)) + '/'
+        if '{' not in url:
+            url = url.rstrip('/') + '/' + self.filename
+        try:
+            url.format(code='1ABC', lower='1abc', middle='ab', format='pdb')
+        except (KeyError, IndexError, ValueError):
+            self.logger.error('The URL template can only use the {code}, {lower}, {middle} and {format} fields')
+            return False
+        self.url = url
+        self.logger.info('Fetching from '+self.url)
+        return True
+
+    def set_cache(self, cache):
+        '''Set the cache directory'''
+        self.cache = os.path.abspath(os.path.expanduser(cache))
+        self.logger.info('Using the cache in '+self.cache)
+
+    def set_outdir(self, outdir):
+        '''Set the directory the structures are written to'''
+        self.outdir = os.path.abspath(outdir)
 
-if len(sys.argv) > 1:
-    if type(sys.argv[1]) == type("string"):
-        if len(sys.argv[1]) == 4:
-            pdbcode = sys.argv[1].upper()
+    def set_threads(self, threads=8):
+        '''Set the largest number of downloads at once'''
+        try:
+            self.threads = max(1, int(threads))
+        except:
+            self.logger.error('Threads must be an integer')
+
+    def set_retries(self, retries=3):
+        '''Set how many times a failed download is retried'''
+        try:
+            self.retries = max(0, int(retries))
+        except:
+            self.logger.error('Retries must be an integer')
+
+    def set_format(self, format='pdb'):
+        '''Set the file format to fetch, pdb or cif'''
+        if format in ['pdb', 'cif']:
+            self.format = format
         else:
-            sys.exit('PDB codes have 4 characters')
-    else:
-        sys.exit('PDB code should be a string')
-else:
-    sys.exit('Useage: PdbGet.py 1ABC')
+            self.logger.error('Format must be pdb or cif')
+
+    def set_log_level(self, level=logging.INFO):
+        if level in logging._levelToName.keys():
+            self.logger.setLevel(level)
+            self.logger.info(f'Set log level to: {logging._levelToName[level]}')
+        else:
+            self.logger.error(f'Could not set log level to: {level}')
+
+    def ReturnUrl(self, code):
+        return self.url.format(code=code, lower=code.lower(), middle=code[1:3].lower(), format=self.format)
+
+    def ReturnObjectPath(self, digest):
+        return os.path.join(self.cache, 'objects', digest[:2], digest)
+
+    def ReadIndex(self):
+        try:
+            with open(os.path.join(self.cache, 'index.json')) as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return {}
+
+    def WriteIndex(self, index):
+        ###write then rename so an interrupted run never leaves a broken index
+        handle, filename = tempfile.mkstemp(dir=self.cache, suffix='.json')
+        with os.fdopen(handle, 'w') as outfile:
+            json.dump(index, outfile, indent=1, sort_keys=True)
+        os.replace(filename, os.path.join(self.cache, 'index.json'))
+
+    def Download(self, code):
+        '''Stream one code into the cache, returns (code, sha256, seconds, error)'''
+        url = self.ReturnUrl(code)
+        start = time()
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                sleep(2**(attempt - 1))
+            handle, filename = tempfile.mkstemp(dir=self.cache, suffix='.part')
+            try:
+                digest = hashlib.sha256()
+                with os.fdopen(handle, 'wb') as outfile:
+                    with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                        stream = gzip.GzipFile(fileobj=response) if url.endswith('.gz') else response
+                        while True:
+                            data = stream.read(self.chunk)
+                            if not data:
+                                break
+                            digest.update(data)
+                            outfile.write(data)
+                digest = digest.hexdigest()
+                path = self.ReturnObjectPath(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(filename, path)
+                return (code, digest, time() - start, None)
+            except Exception as exception:
+                error = str(exception)
+                os.remove(filename)
+                ###a missing entry will not turn up on a retry
+                if getattr(exception, 'code', None) == 404 or isinstance(getattr(exception, 'reason', exception), FileNotFoundError):
+                    break
+        return (code, None, time() - start, error)
 
-url = 'http://www.rcsb.org/pdb/files/'+pdbcode+'.pdb.gz'
-outfile_name = pdbcode+'.pdb'
+    def Run(self):
+        '''Fetch every code that is not already in the cache and copy them all to the output directory'''
+        os.makedirs(self.cache, exist_ok=True)
+        os.makedirs(self.outdir, exist_ok=True)
+        index = self.ReadIndex()
+        key = lambda code: code+'.'+self.format
+        wanted = [code for code in self.codes if key(code) not in index or not os.path.isfile(self.ReturnObjectPath(index[key(code)]))]
+        self.logger.info(str(len(self.codes) - len(wanted))+' structures in the cache, downloading '+str(len(wanted)))
+        self.results = []
+        if len(wanted) > 0:
+            pool = ThreadPool(min(self.threads, len(wanted)))
+            try:
+                for code, digest, seconds, error in pool.imap_unordered(self.Download, wanted):
+                    self.results.append((code, digest, seconds, error))
+                    if error == None:
+                        index[key(code)] = digest
+                        self.logger.debug('Fetched '+code+' in '+'%.2f' % seconds+' s')
+                    else:
+                        self.logger.error('Could not fetch '+code+': '+error)
+                    ###keep the index up to date so an interrupted batch keeps what it has fetched
+                    if len(self.results) % 50 == 0:
+                        self.WriteIndex(index)
+            finally:
+                pool.close()
+                pool.join()
+                self.WriteIndex(index)
+        saved = []
+        for code in self.codes:
+            if key(code) in index and os.path.isfile(self.ReturnObjectPath(index[key(code)])):
+                outfile_name = os.path.join(self.outdir, code+'.'+self.format)
+                shutil.copyfile(self.ReturnObjectPath(index[key(code)]), outfile_name)
+                saved.append(outfile_name)
+        failed = len([result for result in self.results if result[3] != None])
+        self.logger.info('Saved '+str(len(saved))+' structures to '+self.outdir+', '+str(failed)+' failed')
+        return saved
 
-try:
-    page = urllib2.urlopen(url)
-except:
-    sys.exit('Cannot access PDB entry, perhaps code is invalid?')
+if __name__ == '__main__':
 
-zipped = StringIO.StringIO(page.read())
-unzipped = gzip.GzipFile(fileobj=zipped)
+    parser = OptionParser(usage='%prog [options] 1ABC [2DEF ...]')
+    optional = OptionGroup(parser, "Optional Arguments")
+    optional.add_option("-l", "--list", action="store", type="string", dest="listfile", help="A file of PDB codes to fetch, separated by spaces, commas or new lines") #A STRING
+    optional.add_option("-o", "--outdir", action="store", type="string", dest="outdir", default=os.getcwd(), help="The directory to save the structures in (default is the current directory)") #A STRING
+    optional.add_option("-c", "--cache", action="store", type="string", dest="cache", default=os.path.join('~', '.pdbget'), help="The cache directory (default ~/.pdbget)") #A STRING
+    optional.add_option("-u", "--url", action="store", type="string", dest="url", default=PdbGet.base_url, help="The URL, URL template using {code}, {lower}, {middle} and {format}, or local mirror directory to fetch from (default "+PdbGet.base_url+")") #A STRING
+    optional.add_option("-f", "--format", action="store", type="string", dest="format", default='pdb', help="The file format to fetch, pdb or cif (default pdb)") #A STRING
+    optional.add_option("-n", "--threads", action="store", type="int", dest="threads", default=8, help="The largest number of downloads at once (default 8)") #AN INTEGER
+    optional.add_option("-r", "--retries", action="store", type="int", dest="retries", default=3, help="The number of times to retry a failed download (default 3)") #AN INTEGER
+    optional.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False, help="Verbose mode, set log level to debug") #A BOOLEAN
 
-with open(outfile_name, 'w') as outfile:
-    outfile.write(unzipped.read())
+    parser.add_option_group(optional)
+    (options, args) = parser.parse_args()
 
-print 'Normal completion. Saved '+outfile_name+'.'
-    
+    job = PdbGet()
+    if options.verbose:
+        job.set_log_level(logging.DEBUG)
+    if not job.set_codes(args, options.listfile):
+        sys.exit('Useage: PdbGet.py 1ABC')
+    if not job.set_url(options.url):
+        sys.exit()
+    job.set_format(options.format)
+    job.set_cache(options.cache)
+    job.set_outdir(options.outdir)
+    job.set_threads(options.threads)
+    job.set_retries(options.retries)
+    saved = job.Run()
+    if len(saved) < len(job.codes):
+        sys.exit('Cannot access some PDB entries, perhaps the codes are invalid?')
 
+    job.logger.info('Finished normally')
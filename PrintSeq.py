@@ -1,60 +1,25 @@
 #!/opt/anaconda3/bin/python
 
 import sys, os
+import logging
+
+from readwrite import PDB
 
 if len(sys.argv) < 2:
     sys.exit('useage: PrintSeq.py XXX.pdb')
 else:
-    if os.path.isfile(sys.argv[1]) and sys.argv[1][-3:] == 'pdb':
+    if os.path.isfile(sys.argv[1]) and sys.argv[1][-3:] in ['pdb', 'cif']:
         pass
     else:
         sys.exit(str(sys.argv[1])+' is not a valid pdb file')
 
-file = open(sys.argv[1], 'r')
-data = file.readlines()
-
-translator={'ALA': 'A',\
-            'CYS': 'C',\
-            'ASP': 'D',\
-            'GLU': 'E',\
-            'PHE': 'F',\
-            'GLY': 'G',\
-            'HIS': 'H',\
-            'ILE': 'I',\
-            'LYS': 'K',\
-            'LEU': 'L',\
-            'MET': 'M',\
-            'ASN': 'N',\
-            'PRO': 'P',\
-            'GLN': 'Q',\
-            'ARG': 'R',\
-            'SER': 'S',\
-            'THR': 'T',\
-            'VAL': 'V',\
-            'TRP': 'W',\
-            'TYR': 'Y',\
-            'DA': 'A',\
-            'DT': 'T',\
-            'DC': 'C',\
-            'DG': 'G'}
-
-sequence = []
-is_seqres = False
-for line in data:
-    line = line.split()
-    if line[0] == 'SEQRES':
-        is_seqres = True
-        for part in line:
-            if part in translator.keys():
-                sequence.append(translator[part])
-    elif line[0] == 'ATOM' and line[2] == 'CA' and is_seqres == False:
-        if line[3] in translator.keys():
-            sequence.append(translator[line[3]])
-    elif line[0] == 'ATOM' and line[2] == 'P' and is_seqres == False:
-        if line[3] in translator.keys():
-            sequence.append(translator[line[3]])
-    else:
-        pass
+###quieten the PDB logger before it is made so its start up line stays out of the plain text output
+logging.getLogger('readwrite.PDB').setLevel(logging.WARNING)
+pdb = PDB(sys.argv[1])
+pdb.parse_file()
+###SEQRES records are used if there are any, otherwise the CA and P atoms
+composition = pdb.composition()
+sequence = composition['total']['sequence']
 
 window_size = 50
 window = 0
@@ -69,6 +34,11 @@ while [ 1 ]:
         print(''.join(sequence[window_start:window_end]))
         window = window + window_size
 
-print(f'{len(sequence)} residues')                
-
-
+print(f'{len(sequence)} residues')
+for chain in sorted(composition['chains'].keys()):
+    values = composition['chains'][chain]
+    print(f"chain {chain}: {values['residues']} residues, MW {values['mw']:.1f} Da, e280 {values['extinction']:.0f} M^-1 cm^-1, vbar {values['vbar']:.3f} ml/g")
+total = composition['total']
+print(f"total: MW {total['mw']:.1f} Da, e280 {total['extinction']:.0f} M^-1 cm^-1, vbar {total['vbar']:.3f} ml/g")
+print(f"X-ray SLD {total['xray_sld']:.3E} cm^-2, contrast {total['xray_contrast']:.3E} cm^-2")
+print(f"neutron SLD {total['neutron_sld']:.3E} cm^-2, contrast in H2O {total['neutron_contrast']:.3E} cm^-2")
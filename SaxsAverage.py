@@ -10,11 +10,12 @@ import os
 import logging
 import numpy as np
 
+from readwrite import read_curve, write_curve
 
 if len(sys.argv) < 2:
-    print 'Useage: SaxsAverage.py file1.dat file2.dat ... fileN.dat'
-    print 'SaxsAdd.py will average together all pdb files in the list'
-    print 'and write to standard out.'
+    print('Useage: SaxsAverage.py file1.dat file2.dat ... fileN.dat')
+    print('SaxsAdd.py will average together all pdb files in the list')
+    print('and write to standard out.')
     sys.exit()
 
 filelist = sys.argv[1:]
@@ -57,30 +58,16 @@ class SaxsAdd():
         
         for file in self.filelist:
             if os.path.splitext(file)[-1] == '.dat':
-                qdata = []
-                idata = []
-                edata = []
-                datafile = open(file, "r")
-                saxsdata = datafile.readlines()
-                lo_q = []
-                hi_q = []
-                no_datapoints = len(saxsdata)
-                for index, row in enumerate(saxsdata):
-                    try:
-                        qdata.append(float(row.split()[0]))
-                        idata.append(float(row.split()[1]))
-                        edata.append(float(row.split()[2]))
-                        if no_datapoints*0.9 < index < no_datapoints*0.95:
-                            hi_q.append( float(row.split()[1]) )
-                        elif no_datapoints*0.015 < index < no_datapoints*0.05:
-                            lo_q.append( float(row.split()[1]) )
-                        else:
-                            pass
-                    except:pass
-                self.imagedict[os.path.splitext(file)[0]] = {'Q': qdata, 'I': idata, 'E': edata, 'lo_q': sum(lo_q), 'hi_q': sum(hi_q), 'outlier': False}
-                self.logger.info('Parsed '+str(os.path.splitext(file)[0])+' with '+str(len(qdata))+' data points.')
-                testset = set(self.imagedict[self.imagedict.keys()[0]]['Q'])
-                for file in self.imagedict.keys()[1:]:
+                data = read_curve(file, 3, ())
+                ###summed intensity in a low and a high q window to spot aggregation and air
+                no_datapoints = len(data)
+                index = np.arange(no_datapoints)
+                hi_q = data[(no_datapoints*0.9 < index) & (index < no_datapoints*0.95), 1]
+                lo_q = data[(no_datapoints*0.015 < index) & (index < no_datapoints*0.05), 1]
+                self.imagedict[os.path.splitext(file)[0]] = {'Q': data[:,0].tolist(), 'I': data[:,1].tolist(), 'E': data[:,2].tolist(), 'lo_q': lo_q.sum(), 'hi_q': hi_q.sum(), 'outlier': False}
+                self.logger.info('Parsed '+str(os.path.splitext(file)[0])+' with '+str(no_datapoints)+' data points.')
+                testset = set(self.imagedict[list(self.imagedict.keys())[0]]['Q'])
+                for file in list(self.imagedict.keys())[1:]:
                     targetset = set(self.imagedict[file]['Q'])
                     if not len(testset - targetset) == 0:
                         self.logger.error('The files do not all have the same Q range')
@@ -109,7 +96,7 @@ class SaxsAdd():
         edata = []
         n = sum([1 for x in self.imagedict.items() if not x[1]['outlier']])
         self.logger.info('n = '+str(n))
-        for index, q in enumerate(self.imagedict[self.imagedict.keys()[0]]['Q']):
+        for index, q in enumerate(self.imagedict[list(self.imagedict.keys())[0]]['Q']):
 
             i = np.array([ x[1]['I'][index] for x in self.imagedict.items() if not x[1]['outlier']]).mean()
             e = np.sqrt(np.array([ np.power(x[1]['E'][index],2) for x in self.imagedict.items() if not x[1]['outlier']]).sum()/n)
@@ -125,13 +112,9 @@ class SaxsAdd():
         #for file in filelist:
         #    string = string+file+', '
         #print string[:-2]
-        print "%-14s %-14s %-8s" % ("Q(A-1)","I(au)","Error")
-        for q in self.imagedict['outfile']['Q']:
-            index = self.imagedict['outfile']['Q'].index(q)
-            q = "{0:11.9f}".format(q)
-            i = "{0:15.9f}".format(self.imagedict['outfile']['I'][index])
-            e = "{0:15.9f}".format(self.imagedict['outfile']['E'][index])
-            print q+i+e
+        write_curve(sys.stdout, (self.imagedict['outfile']['Q'], self.imagedict['outfile']['I'], self.imagedict['outfile']['E']),
+                    "%-14s %-14s %-8s" % ("Q(A-1)","I(au)","Error"), "%11.9f%15.9f%15.9f")
+        print()
 
 
 if __name__ == '__main__':
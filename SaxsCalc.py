@@ -19,6 +19,8 @@ import re
 from subprocess import check_output, STDOUT
 import sys
 import matplotlib.pyplot as plt
+
+from readwrite import read_curve
 #import __main__
 #__main__.pymol_argv = ['pymol', '-qc']
 #sys.path.append('/usr/local/Cellar/pymol/1.7.2.1/lib/python2.7/site-packages/')
@@ -93,16 +95,7 @@ class SaxsCalc():
         #parse the dat data
         dat_data = {'Q': [], 'I': [], 'E': []}
         if self.datfile:
-            with open(self.datfile) as f:
-                filedata = f.readlines()
-            for line in filedata:
-                line = line.rsplit()
-                try:
-                    dat_data['Q'].append(float(line[0]))
-                    dat_data['I'].append(float(line[1]))
-                    dat_data['E'].append(float(line[2]))
-                except:
-                    pass
+            dat_data['Q'], dat_data['I'], dat_data['E'] = read_curve(self.datfile, 3, ()).T.tolist()
             #find out where its good from
             command = 'autorg '+self.datfile
             output = check_output(command, shell=True).split('\n'.encode('utf-8'))
@@ -241,16 +234,10 @@ class SaxsCalc():
                         fitfile = f
                         break
             if fitfile:
-                with open(fitfile) as f:
-                    filedata = f.readlines()
-                for line in filedata:
-                    line = line.rsplit()
-                    try:
-                        self.datdata['Q'].append(float(line[0]))
-                        self.datdata['DATA'].append(float(line[1]))
-                        self.datdata['FIT'].append(float(line[3]))
-                    except:
-                        pass
+                data = read_curve(fitfile, 4, ())
+                self.datdata['Q'].extend(data[:,0].tolist())
+                self.datdata['DATA'].extend(data[:,1].tolist())
+                self.datdata['FIT'].extend(data[:,3].tolist())
                 
         #TEST THE OUTPUT
         if len(self.datdata['Q']) > 0:
@@ -300,16 +287,10 @@ class SaxsCalc():
     
             #PARSE THE FIT FILE
             fitfile = [ m for m in self.created_files if m[-4:] == '.fit'][0]
-            with open(fitfile) as f:
-                filedata = f.readlines()
-            for line in filedata:
-                line = line.rsplit()
-                try:
-                    self.datdata['Q'].append(float(line[0]))
-                    self.datdata['DATA'].append(float(line[1]))
-                    self.datdata['FIT'].append(float(line[2]))
-                except:
-                    pass
+            data = read_curve(fitfile, 3, ())
+            self.datdata['Q'].extend(data[:,0].tolist())
+            self.datdata['DATA'].extend(data[:,1].tolist())
+            self.datdata['FIT'].extend(data[:,2].tolist())
     
             #REMOVE EXTRAPOLATED POINTS AT START OF FIT
             while self.datdata['DATA'][0] == self.datdata['DATA'][1]:
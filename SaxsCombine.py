@@ -10,6 +10,8 @@ from optparse import OptionParser
 from optparse import OptionGroup
 from subprocess import check_output
 
+from readwrite import read_curve, write_curve, split_frame_name
+
 
 if len(sys.argv) < 2:
     sys.argv.append('-h')
@@ -40,8 +42,10 @@ if options.secondmultiplier == 0:
 if os.path.isfile(options.firstfile) and os.path.isfile(options.secondfile):
     output_dir = os.path.split(os.path.abspath(options.firstfile))[0]
     options.outputdir = output_dir
-    first_index = re.split('[\._]', os.path.split(os.path.abspath(options.firstfile))[1])[-2]
-    second_index = re.split('[\._]', os.path.split(os.path.abspath(options.secondfile))[1])[-2]
+    prefix, frame, digits = split_frame_name(options.firstfile)
+    first_index = str(frame).zfill(digits) if frame != None else prefix
+    prefix, frame, digits = split_frame_name(options.secondfile)
+    second_index = str(frame).zfill(digits) if frame != None else prefix
     default_output = str(options.firstmultiplier).replace('.','p')+'x'+first_index+'+'+str(options.secondmultiplier).replace('.','p')+'x'+second_index+'.dat'
     if not options.outfile:
         options.outfile = default_output
@@ -78,49 +82,23 @@ class Combine():
         self.logger.info('Starting a new Combine job')        
         try:
             self._options = dict(options)
-            print self._options
+            print(self._options)
         except:
             self.logger.error('cound not read in the command line options')
             sys.exit()
 
 
     def ParseFirst(self):
-        qdata = []
-        idata = []
-        edata = []
-                
-        datafile = open(self._options.get('firstfile'), "r")
-        saxsdata = datafile.readlines()
-        for row in saxsdata:
-            try:
-                q = float(row.split()[0])
-                i = float(row.split()[1]) * self._options.get('firstmultiplier')
-                e = float(row.split()[2]) * self._options.get('firstmultiplier')
-                if q > 0:
-                    qdata.append(q)
-                    idata.append(i)
-                    edata.append(e)
-            except:pass
+        data = read_curve(self._options.get('firstfile'), 3, (0,))
+        data[:,1:] *= self._options.get('firstmultiplier')
+        qdata, idata, edata = data.T.tolist()
         self.firstdict = {'Q': qdata, 'I': idata, 'E': edata}
         self.logger.info('Parsed '+str(self._options.get('firstfile'))+' with '+str(len(qdata))+' data points.')
 
     def ParseSecond(self):
-        qdata = []
-        idata = []
-        edata = []
-                
-        datafile = open(self._options.get('secondfile'), "r")
-        saxsdata = datafile.readlines()
-        for row in saxsdata:
-            try:
-                q = float(row.split()[0])
-                i = float(row.split()[1]) * self._options.get('secondmultiplier')
-                e = float(row.split()[2]) * self._options.get('secondmultiplier')
-                if q > 0:
-                    qdata.append(q)
-                    idata.append(i)
-                    edata.append(e)
-            except:pass
+        data = read_curve(self._options.get('secondfile'), 3, (0,))
+        data[:,1:] *= self._options.get('secondmultiplier')
+        qdata, idata, edata = data.T.tolist()
         self.seconddict = {'Q': qdata, 'I': idata, 'E': edata}
         self.logger.info('Parsed '+str(self._options.get('secondfile'))+' with '+str(len(qdata))+' data points.')
 
@@ -142,18 +120,8 @@ class Combine():
         self.logger.info('Summed the two files with '+str(len(self.outputdict['Q']))+' common points')                
 
     def OutputDat(self):
-        string_list = []
-        string_list.append("%-15s %-18s %-15s" % ("Q(A-1)","I(au)","Error"))
-        for q in self.outputdict['Q']:
-            index = self.outputdict['Q'].index(q)
-            i = self.outputdict['I'][index]
-            e = self.outputdict['E'][index]
-            string_list.append("%-15s %-18s %-15s" % (q,i,e))
- 
         outfile_name = self._options.get('outputdir')+'/'+self._options.get('outfile')
-        outfile = open(outfile_name, 'w')
-        outfile.write('\n'.join(string_list))
-        outfile.close()
+        write_curve(outfile_name, (self.outputdict['Q'], self.outputdict['I'], self.outputdict['E']), "%-15s %-18s %-15s" % ("Q(A-1)","I(au)","Error"))
         self.logger.info('wrote averaged file to: '+outfile_name)
 
 if __name__ == '__main__':
@@ -4,6 +4,8 @@ import matplotlib.pyplot as plt
 from scipy import stats as stats
 from matplotlib.backends.backend_pdf import PdfPages
 
+from readwrite import read_curve, write_curve, FrameIndex, frame_range_name, CurveStack
+
 
 class SaxsPlot():
     """Plots saxs data in various ways
@@ -19,6 +21,13 @@ class SaxsPlot():
     '''
     def __init__(self):
         self.output_images = {}
+        self.frames = None
+        self.series = []
+        ###size exclusion series are read by a pool of threads, or processes, one per cpu by default
+        self.processes = None
+        self.pool = 'thread'
+        ###frame indexes are kept next to the data unless a directory is given here or in $SAXS_FRAME_INDEX
+        self.frame_index = None
         ###start a log file
         self.logger = logging.getLogger('SaxsPlot')
         self.logger.setLevel(logging.DEBUG)
@@ -63,26 +72,51 @@ class SaxsPlot():
             self.logger.error('User did not choose any images, nothing to do!')
             sys.exit()
 
+    def IndexFrames(self):
+        '''Look up the run prefix and frame number of every image once from the frame index of its directory'''
+        if self.frames != None:
+            return
+        self.frames = {}
+        pattern = '*'+os.path.splitext(self.imagelist[0])[1]
+        for directory in sorted(set([os.path.dirname(path) for path in self.imagelist])):
+            index = FrameIndex(directory, pattern, self.logger, self.frame_index)
+            index.scan()
+            for path in self.imagelist:
+                if os.path.dirname(path) == directory:
+                    record = index.lookup(path)
+                    if record == None:
+                        self.logger.error('Leaving out '+path+', it does not match '+pattern)
+                        continue
+                    self.frames[os.path.splitext(os.path.basename(path))[0]] = record
+        ###only images that were parsed, in run and frame order, files without a frame number go first
+        dropped = [name for name in self.frames.keys() if name not in self.imagedict]
+        if len(dropped) > 0:
+            self.logger.error('Leaving out '+str(len(dropped))+' frames that could not be parsed: '+', '.join(sorted(dropped)))
+        self.series = sorted([name for name in self.frames.keys() if name in self.imagedict], key=lambda name: (self.frames[name]['prefix'], self.frames[name]['frame'] if self.frames[name]['frame'] != None else -1, name))
+        self.logger.info('Indexed '+str(len(self.series))+' frames')
+
+    def FrameNumber(self, name):
+        '''Frame number of an image, or of the image a blanked output was made from, None if it has none'''
+        root = os.path.splitext(os.path.basename(name))[0]
+        if root.endswith('_blanked'):
+            root = root[:-len('_blanked')]
+        record = self.frames.get(root) if self.frames != None else None
+        return record['frame'] if record != None else None
+
     def ParseDat(self):
         self.imagedict = {}
+        if self.jobtype == 'col':
+            try:
+                ###the stack is only kept until it is copied into imagedict, so the series is never held twice
+                stack = CurveStack.from_files(self.imagelist, processes=self.processes, pool=self.pool, logger=self.logger)
+                self.imagedict = stack.imagedict([row for row, frame in enumerate(stack.frames) if 'error' not in frame])
+                self.logger.info('Parsed '+str(len(self.imagedict))+' frames with '+str(len(stack.q))+' data points.')
+                return
+            except ValueError as error:
+                self.logger.error(str(error)+', reading the files one at a time')
         for file in self.imagelist:
             fileroot = os.path.splitext(os.path.basename(file))[0]
-            qdata = []
-            idata = []
-            edata = []
-                    
-            datafile = open(file, "r")
-            saxsdata = datafile.readlines()
-            for row in saxsdata:
-                try:
-                    q = float(row.split()[0])
-                    i = float(row.split()[1])
-                    e = float(row.split()[2])
-                    if q > 0:
-                        qdata.append(q)
-                        idata.append(i)
-                        edata.append(e)
-                except:pass
+            qdata, idata, edata = read_curve(file, 3, (0,)).T.tolist()
             self.imagedict[fileroot] = {'Q': qdata, 'I': idata, 'E': edata}
             self.logger.info('Parsed '+str(fileroot)+' with '+str(len(qdata))+' data points.')
 
@@ -90,22 +124,7 @@ class SaxsPlot():
         self.imagedict = {}
         for file in self.imagelist:
             fileroot = os.path.splitext(os.path.basename(file))[0]
-            qdata = []
-            exp_data = []
-            model_data = []
-                    
-            datafile = open(file, "r")
-            saxsdata = datafile.readlines()
-            for row in saxsdata:
-                try:
-                    q = float(row.split()[0])
-                    exp = float(row.split()[1])
-                    mod = float(row.split()[2])
-                    if q > 0 and exp > 0:
-                        qdata.append(q)
-                        exp_data.append(exp)
-                        model_data.append(mod)
-                except:pass
+            qdata, exp_data, model_data = read_curve(file, 3, (0, 1)).T.tolist()
             self.imagedict[fileroot] = {'Q': qdata, 'I': exp_data, 'E': model_data}
             self.logger.info('Parsed '+str(fileroot)+' with '+str(len(qdata))+' data points.')
 
@@ -115,25 +134,8 @@ class SaxsPlot():
         self.imagedict = {}
         for file in self.imagelist:
             fileroot = os.path.splitext(os.path.basename(file))[0]
-            qdata = []
-            idata = []
-            edata = []
-
-            datafile = open(file, "r")
-            saxsdata = datafile.readlines()
             try:
-                index = [i for i, item in enumerate(saxsdata) if re.search(' *R          P\(R\)      ERROR.*', item)][-1]+2
-                index2 = [i for i, item in enumerate(saxsdata[index:]) if re.search(' *Reciprocal space: Rg =.*', item)][0] + index - 1
-                saxsdata = saxsdata[index:index2]
-                for row in saxsdata:
-                    try:
-                        q = float(row.split()[0])
-                        i = float(row.split()[1])
-                        e = float(row.split()[2])
-                        qdata.append(q)
-                        idata.append(i)
-                        edata.append(e)
-                    except:pass
+                qdata, idata, edata = read_curve(file, 3, (), after=' *R          P\\(R\\)      ERROR').T.tolist()
                 self.imagedict[fileroot] = {'Q': qdata, 'I': idata, 'E': edata}
                 self.logger.info('Parsed '+str(fileroot)+' with '+str(len(qdata))+' data points.')
 
@@ -141,17 +143,17 @@ class SaxsPlot():
                 self.logger.error('Outfile '+str(fileroot)+'.out does not seem to have the expected format for an outfile')
 
     def ScaleIntensities(self):
-	self.logger.info('Scaling intensity data')
+        self.logger.info('Scaling intensity data')
         time.sleep(5)
         if len(self.imagedict.keys()) > 0:
             highest_max = 0
             for file in self.imagedict.keys():
                 self.imagedict[file]['max'] = max(self.imagedict[file]['I'])
-	        if self.imagedict[file]['max'] > highest_max:
-	            highest_max = self.imagedict[file]['max']
-	    for file in self.imagedict.keys():
+                if self.imagedict[file]['max'] > highest_max:
+                    highest_max = self.imagedict[file]['max']
+            for file in self.imagedict.keys():
                 self.logger.info('scaling '+str(file)+' intensities by '+str(highest_max/self.imagedict[file]['max']))
-		self.imagedict[file]['I'][:] = [x*(highest_max/self.imagedict[file]['max']) for x in self.imagedict[file]['I']]
+                self.imagedict[file]['I'][:] = [x*(highest_max/self.imagedict[file]['max']) for x in self.imagedict[file]['I']]
 
     def Plot(self):
         linetypes = ['-','--','-.',':']
@@ -220,7 +222,7 @@ class SaxsPlot():
         ######################
         #save the output file#
         ######################
-        outfilename = self.output_directory+'/'+self.imagedict.keys()[0]+'.pdf'
+        outfilename = self.output_directory+'/'+list(self.imagedict.keys())[0]+'.pdf'
         pp = PdfPages(outfilename)
         pp.savefig(fig)
         pp.close()
@@ -228,14 +230,14 @@ class SaxsPlot():
 
     def PlotLowQ(self):
         self.needs_blanked = True
-	self.logger.info('the HPLC dat files need to be blanked')
+        self.logger.info('the HPLC dat files need to be blanked')
 
+        self.IndexFrames()
         filenumber_array = []
         intensity_array = []
-        for file in sorted(self.imagedict.keys()):
+        for file in self.series:
             try:
-                #filenumber = int(file.split('_')[-1])
-                filenumber = int(re.split('[-._]',file)[-1])
+                filenumber = int(self.frames[file]['frame'])
                 intensity = sum(self.imagedict[file]['I'][10:20])
                 filenumber_array.append(filenumber)
                 intensity_array.append(intensity)
@@ -288,9 +290,8 @@ class SaxsPlot():
         #AVERAGE THE FIRST WINDOW
         window_dict = {}
 
-        for file in sorted(self.imagedict.keys()):
-            #filenumber = int(file.split('_')[-1])
-            filenumber = int(re.split('[-._]',file)[-1])
+        for file in self.series:
+            filenumber = self.frames[file]['frame']
             try:
                 if int(filenumber) >= bottom_lower and int(filenumber) <= top_lower:
                     for q in self.imagedict[file]['Q']:
@@ -316,9 +317,8 @@ class SaxsPlot():
 
         #AVERAGE THE SECOND WINDOW
         window_dict = {}
-        for file in sorted(self.imagedict.keys()):
-            #filenumber = int(file.split('_')[-1])
-            filenumber = int(re.split('[-._]',file)[-1])
+        for file in self.series:
+            filenumber = self.frames[file]['frame']
             try:
                 if int(filenumber) >= bottom_upper and int(filenumber) <= top_upper:
                     for q in self.imagedict[file]['Q']:
@@ -348,10 +348,9 @@ class SaxsPlot():
         warnings.simplefilter('ignore', RuntimeWarning)
         upperslope, upperintercept, r_value, p_value, std_err = stats.linregress([lower_average,upper_average],[0,1])
         lowerslope, lowerintercept, r_value, p_value, std_err = stats.linregress([lower_average,upper_average],[1,0])
-        for file in sorted(self.imagedict.keys()):
-            #filenumber = int(file.split('_')[-1])
-            filenumber = int(re.split('[-._]',file)[-1])
-            if int(filenumber) >= bottom_region and int(filenumber) <= top_region:
+        for file in self.series:
+            filenumber = self.frames[file]['frame']
+            if filenumber != None and filenumber >= bottom_region and filenumber <= top_region:
                 fraction_upper = (filenumber * upperslope) + upperintercept
                 fraction_lower = (filenumber * lowerslope) + lowerintercept
                 qdata = []
@@ -375,45 +374,36 @@ class SaxsPlot():
     def OutputDat(self):
         try:
             if self.needs_blanked:
-	        self.logger.info('Writing out the blanked files')
-	    else:
+                self.logger.info('Writing out the blanked files')
+            else:
                 return
         except:
             pass
 
         for file in self.output_images.keys():
-            string_list = []
-            string_list.append("%-15s %-18s %-15s" % ("Q(A-1)","I(au)","Error"))
-            for q in self.output_images[file]['Q']:
-                if q > 0:
-                    index = self.output_images[file]['Q'].index(q)
-                    q = self.output_images[file]['Q'][index]
-                    i = self.output_images[file]['I'][index]
-                    e = self.output_images[file]['E'][index]
-                    string_list.append("%-15s %-18s %-15s" % (q,i,e))
-
-            outfile = open(self.output_directory+'/'+str(file)+'.dat', 'w')
-            outfile.write('\n'.join(string_list))
-            outfile.close()
+            qdata = numpy.array(self.output_images[file]['Q'], dtype=float)
+            keep = qdata > 0
+            write_curve(self.output_directory+'/'+str(file)+'.dat', (qdata[keep], numpy.array(self.output_images[file]['I'], dtype=float)[keep], numpy.array(self.output_images[file]['E'], dtype=float)[keep]),
+                        "%-15s %-18s %-15s" % ("Q(A-1)","I(au)","Error"))
             self.logger.info('wrote averaged file to: '+self.output_directory+'/'+str(file)+'.dat')
     def GetRgIo(self):
         if self.needs_blanked:
-	    filelist = self.output_images
-	else:
-	    filelist = self.imagelist
+            filelist = self.output_images
+        else:
+            filelist = self.imagelist
 
         self.filenumbers = []
         self.rgs = []
         self.ios = []
         for file in sorted(filelist):
             try:
-                filenumber = int(re.split('[_\-./]', file)[-2])
+                filenumber = int(self.FrameNumber(file))
                 self.logger.info('running autorg on file '+str(file))
                 if self.needs_blanked:
                     command = 'autorg '+str(self.output_directory)+'/'+str(file)+'.dat'
-		else:
-		    command = 'autorg '+str(file)
-                p = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+                else:
+                    command = 'autorg '+str(file)
+                p = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, universal_newlines=True)
                 data = p.stdout.readlines()
                 rg = 0
                 io = 0
@@ -437,18 +427,15 @@ class SaxsPlot():
                     self.logger.error('Could not run autoRg on the file '+str(file))
 
     def Average(self):
-        filelist = self.imagedict.keys()
-        index_list = []
-        for file in filelist:
-            index_list.append(int(file.split('_')[-1]))
-        output_name = '_'.join(filelist[0].split('_')[0:-1])+'_'+str(min(index_list)).zfill(len(filelist[0].split('_')[-1]))+'-'+str(max(index_list)).zfill(len(filelist[0].split('_')[-1]))
-
-
-
+        self.IndexFrames()
+        filelist = self.series
         if len(filelist) < 2:
             self.logger.error('Averaging requires more than one input file')
             return
-        qdata = self.imagedict[self.imagedict.keys()[0]]['Q']
+        index_list = [self.frames[file]['frame'] for file in filelist]
+        output_name = frame_range_name(self.frames[filelist[0]]['prefix'], min(index_list), max(index_list), self.frames[filelist[0]]['digits'])
+
+        qdata = self.imagedict[list(self.imagedict.keys())[0]]['Q']
         idata = []
         edata = []
 
@@ -498,16 +485,15 @@ class SaxsPlot():
         self.logger.info('A window of '+str(window)+' will be used for BoxCar averaging')
 
         
-        for file in sorted(self.imagedict.keys()):
-            index = sorted(self.imagedict.keys()).index(file)
-            half_window = ( window - 1 ) / 2
-            while min(range(index - (half_window), index + (half_window + 1))) < 0 or max(range(index - (half_window), index + (half_window + 1))) > len(self.imagedict.keys())-1:
+        self.IndexFrames()
+        for index, file in enumerate(self.series):
+            half_window = ( window - 1 ) // 2
+            while min(range(index - (half_window), index + (half_window + 1))) < 0 or max(range(index - (half_window), index + (half_window + 1))) > len(self.series)-1:
                 half_window -= 1
             averaging_range = range(index - (half_window), index + (half_window + 1))
-            filenames = []
-            for item in averaging_range:
-                filenames.append(sorted(self.imagedict.keys())[item])
-            output_name = '_'.join(re.split('[._]',filenames[0])[0:-1])+'_'+re.split('[._]',filenames[0])[-1]+'-'+re.split('[._]',filenames[-1])[-1]
+            filenames = [self.series[item] for item in averaging_range]
+            first = self.frames[filenames[0]]
+            output_name = frame_range_name(first['prefix'], first['frame'], self.frames[filenames[-1]]['frame'], first['digits'])
 
             qdata = self.imagedict[filenames[0]]['Q']
             idata = []
@@ -540,11 +526,11 @@ if __name__ == '__main__':
        plot.Plot()
     elif plot.jobtype == 'dat':
         plot.ParseDat()
-	plot.ScaleIntensities()
+        plot.ScaleIntensities()
         plot.Plot()
     elif plot.jobtype == 'out':
         plot.ParseOut()
-	plot.ScaleIntensities()
+        plot.ScaleIntensities()
         plot.Plot()
     elif plot.jobtype == 'fit':
         plot.ParseFit()
@@ -5,6 +5,8 @@ import wx.lib.agw.genericmessagedialog as GMD
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
+from readwrite import read_curve
+
 
 class SaxsPlot():
     """Plots saxs data in various ways
@@ -90,22 +92,7 @@ class SaxsPlot():
         self.imagedict = {}
         for file in self.imagelist:
             fileroot = os.path.splitext(os.path.basename(file))[0]
-            qdata = []
-            idata = []
-            edata = []
-                    
-            datafile = open(file, "r")
-            saxsdata = datafile.readlines()
-            for row in saxsdata:
-                try:
-                    q = float(row.split()[0])
-                    i = float(row.split()[1])
-                    e = float(row.split()[2])
-                    if q > 0:
-                        qdata.append(q)
-                        idata.append(i)
-                        edata.append(e)
-                except:pass
+            qdata, idata, edata = read_curve(file, 3, (0,)).T.tolist()
             self.imagedict[fileroot] = {'Q': qdata, 'I': idata, 'E': edata}
             self.logger.info('Parsed '+str(fileroot)+' with '+str(len(qdata))+' data points.')
 
@@ -113,22 +100,7 @@ class SaxsPlot():
         self.imagedict = {}
         for file in self.imagelist:
             fileroot = os.path.splitext(os.path.basename(file))[0]
-            qdata = []
-            exp_data = []
-            model_data = []
-                    
-            datafile = open(file, "r")
-            saxsdata = datafile.readlines()
-            for row in saxsdata:
-                try:
-                    q = float(row.split()[0])
-                    exp = float(row.split()[1])
-                    mod = float(row.split()[2])
-                    if q > 0 and exp > 0:
-                        qdata.append(q)
-                        exp_data.append(exp)
-                        model_data.append(mod)
-                except:pass
+            qdata, exp_data, model_data = read_curve(file, 3, (0, 1)).T.tolist()
             self.imagedict[fileroot] = {'Q': qdata, 'I': exp_data, 'E': model_data}
             self.logger.info('Parsed '+str(fileroot)+' with '+str(len(qdata))+' data points.')
 
@@ -138,26 +110,8 @@ class SaxsPlot():
         self.imagedict = {}
         for file in self.imagelist:
             fileroot = os.path.splitext(os.path.basename(file))[0]
-            qdata = []
-            idata = []
-            edata = []
-
-            datafile = open(file, "r")
-            saxsdata = datafile.readlines()
             try:
-                index = [i for i, item in enumerate(saxsdata) if re.search(' *R          P\(R\)      ERROR.*', item)][-1]+2
-                #index2 = [i for i, item in enumerate(saxsdata[index:]) if re.search(' *Reciprocal space: Rg =.*', item)][0] + index - 1
-                #saxsdata = saxsdata[index:index2]
-                saxsdata = saxsdata[index:]
-                for row in saxsdata:
-                    try:
-                        q = float(row.split()[0])
-                        i = float(row.split()[1])
-                        e = float(row.split()[2])
-                        qdata.append(q)
-                        idata.append(i)
-                        edata.append(e)
-                    except:pass
+                qdata, idata, edata = read_curve(file, 3, (), after=' *R          P\\(R\\)      ERROR').T.tolist()
                 self.imagedict[fileroot] = {'Q': qdata, 'I': idata, 'E': edata}
                 self.logger.info('Parsed '+str(fileroot)+' with '+str(len(qdata))+' data points.')
 
@@ -10,6 +10,8 @@ from optparse import OptionParser
 from optparse import OptionGroup
 from subprocess import check_output
 
+from readwrite import read_curve, write_curve
+
 
 if len(sys.argv) < 2:
     sys.argv.append('-h')
@@ -69,22 +71,7 @@ class Subtract():
         self.logger.info('Reading the dat files')
         self.imagedict = {}
         for file in ['buffer', 'sample']:
-            qdata = []
-            idata = []
-            edata = []
-                    
-            datafile = open(self._options[file], "r")
-            saxsdata = datafile.readlines()
-            for row in saxsdata:
-                try:
-                    q = float(row.split()[0])
-                    i = float(row.split()[1])
-                    e = float(row.split()[2])
-                    if q > 0:
-                        qdata.append(q)
-                        idata.append(i)
-                        edata.append(e)
-                except:pass
+            qdata, idata, edata = read_curve(self._options[file], 3, (0,)).T.tolist()
             self.imagedict[file] = {'Q': qdata, 'I': idata, 'E': edata}
             self.logger.info('Parsed '+str(file)+' with '+str(len(qdata))+' data points.')
         if len(self.imagedict['buffer']['Q']) == len(self.imagedict['sample']['Q']):
@@ -105,20 +92,15 @@ class Subtract():
             self.logger.info('will not correct sample before buffer subtraction')
 
     def Subtraction(self):
-        self.string_list = []
-        self.string_list.append("%-15s %-18s %-15s" % ("Q(A-1)","I(au)","Error"))
-        for q in self.imagedict['sample']['Q']:
-            index = self.imagedict['sample']['Q'].index(q)
-            q = self.imagedict['sample']['Q'][index]
-            i = self.imagedict['sample']['I'][index] - ( self._options['multiplier'] * self.imagedict['buffer']['I'][index] )
-            e = numpy.sqrt(numpy.power(self.imagedict['sample']['E'][index],2) + numpy.power(self._options['multiplier'] * self.imagedict['buffer']['E'][index],2))
-            self.string_list.append("%-15s %-18s %-15s" % (q,i,e))
+        sample = dict([(key, numpy.array(value, dtype=float)) for key, value in self.imagedict['sample'].items()])
+        buffer = dict([(key, numpy.array(value, dtype=float)[:len(sample['Q'])]) for key, value in self.imagedict['buffer'].items()])
+        self.subtracted = {'Q': sample['Q'],
+                           'I': sample['I'] - ( self._options['multiplier'] * buffer['I'] ),
+                           'E': numpy.sqrt(numpy.power(sample['E'],2) + numpy.power(self._options['multiplier'] * buffer['E'],2))}
 
     def OutputFile(self):
         self.logger.info('wrote output to '+str(self._options['output']))
-        outfile = open(self._options['output'], 'w')
-        outfile.write('\n'.join(self.string_list))
-        outfile.close()
+        write_curve(self._options['output'], (self.subtracted['Q'], self.subtracted['I'], self.subtracted['E']), "%-15s %-18s %-15s" % ("Q(A-1)","I(au)","Error"))
 
         
                                                        
@@ -53,7 +53,7 @@ class SymmToZ(object):
         self.is_dna = False
 
     def ParsePDB(self):
-        if isfile(self._options['pdbfile']) and self._options['pdbfile'][-4:] == '.pdb':
+        if isfile(self._options['pdbfile']) and self._options['pdbfile'][-4:] in ['.pdb', '.cif']:
 
             self.logger.info('Reading and parsing '+self._options['pdbfile'])
             self.pdb = PDB(self._options['pdbfile'])
@@ -62,16 +62,10 @@ class SymmToZ(object):
     def GetChainsAndResn(self):
             #GET ALL CHAINS FROM PDB AND WHAT RESIDUE NUMBERS ARE IN THEM
             found_chains = {}
-            for key in self.pdb.hashdata.keys():
-                if self.pdb.hashdata[key]['record_type'] == 'ATOM':
-                    if self.pdb.hashdata[key]['atom_name'] == 'CA' or self.pdb.hashdata[key]['atom_name'] == 'P':
-                        if self.pdb.hashdata[key]['chain'] in found_chains.keys():
-                            found_chains[self.pdb.hashdata[key]['chain']].append(self.pdb.hashdata[key]['residue_no'])
-
-                        else:
-                            found_chains[self.pdb.hashdata[key]['chain']] = [self.pdb.hashdata[key]['residue_no']]
-                    else:pass
-                else:pass
+            atoms = self.pdb.atoms
+            rows = numpy.flatnonzero(self.pdb.select('atom and name CA+P'))
+            for chain, residue_no in zip(atoms['chain'][rows].tolist(), atoms['residue_no'][rows].tolist()):
+                found_chains.setdefault(chain, []).append(residue_no)
 
             #IF THE USER HAS SPECIFIED WHICH CHAINS TO USE THEN REMOVE CHAINS NOT IN THE LIST
             if self._options['chains'] != '*':
@@ -82,13 +76,13 @@ class SymmToZ(object):
                     else:pass
                 except:
                     sys.exit('The chains option must be a string in the form A,B,C')
-                for chain in found_chains.keys():
+                for chain in list(found_chains.keys()):
                     if not chain in chains:
                         found_chains.pop(chain)
             else:pass
 
             #GET A LIST OF COMMON RESIDUES FOUND IN ALL CHAINS
-            self.common_residues = set.intersection(*map(set, list(found_chains.viewvalues())))
+            self.common_residues = set.intersection(*map(set, list(found_chains.values())))
             self.chains = found_chains.keys()
             self.logger.info('Will use chains: '+','.join(sorted(self.chains)))
             self.logger.info('There are: '+str(len(self.common_residues))+' residues common to all chains')
@@ -107,44 +101,36 @@ class SymmToZ(object):
                 except:
                     self.logger.error('Cannot parse residue range you tried to specify')
 
+    def ChainMask(self, selection):
+        ###chains are matched on the column rather than in the selection so blank chain ids work
+        mask = self.pdb.select(selection)
+        if mask is None:
+            self.logger.error('Could not select '+selection+' from '+self._options['pdbfile'])
+            sys.exit()
+        return mask & numpy.isin(self.pdb.atoms['chain'], list(self.chains))
+
     def IsDNA(self):
-        for key in self.pdb.hashdata.keys():
-            if self.pdb.hashdata[key]['record_type'] == 'ATOM':
-                if self.pdb.hashdata[key]['chain'] in self.chains:
-                    if self.pdb.hashdata[key]['atom_name'] == 'P':
-                        return True
-        return False
+        return bool(self.ChainMask('atom and name P').any())
 
     def FitLine(self):
+        atoms = self.pdb.atoms
+        mask = self.ChainMask('atom and name CA+P')
+        mask = mask & numpy.isin(atoms['residue_no'], list(self.common_residues))
         chain_sets = {}
         for chain in self.chains:
-            chain_sets[chain] = []
-        for key in self.pdb.hashdata.keys():
-            if self.pdb.hashdata[key]['record_type'] == 'ATOM':
-                if self.pdb.hashdata[key]['chain'] in self.chains:
-                    if self.pdb.hashdata[key]['atom_name'] == 'CA' or self.pdb.hashdata[key]['atom_name'] == 'P':
-                        if self.pdb.hashdata[key]['residue_no'] in self.common_residues:
-                            chain_sets[self.pdb.hashdata[key]['chain']].append( (self.pdb.hashdata[key]['x'], self.pdb.hashdata[key]['y'], self.pdb.hashdata[key]['z']) )
+            chain_sets[chain] = atoms.coords[mask & (atoms['chain'] == chain)]
         if self._options['reverse']:
             for index, chain in enumerate(sorted(chain_sets.keys())):
                 if (index % 2 == 0):
                     self.logger.info('Reversing order of chain: '+chain)
-                    chain_sets[chain] = list(reversed(chain_sets[chain]))
-        resn_sets = []
-        for index, coord in enumerate(chain_sets[chain_sets.keys()[0]]):
-            coord_set = []
-            for chain in chain_sets.keys():
-                coord_set.append(chain_sets[chain][index])
-            resn_sets.append(coord_set)
-
-        line_points = []
-        for item in resn_sets:
-            x = numpy.array([i[0] for i in item]).mean()
-            y = numpy.array([i[1] for i in item]).mean()
-            z = numpy.array([i[2] for i in item]).mean()
-            line_points.append([x, y, z])
-        
-        data = numpy.array(line_points)
+                    chain_sets[chain] = chain_sets[chain][::-1]
+
+        #AVERAGE EACH RESIDUE POSITION OVER THE CHAINS
+        lengths = [len(chain_sets[chain]) for chain in sorted(chain_sets.keys())]
+        if len(set(lengths)) > 1:
+            self.logger.error('The chains have different numbers of CA or P atoms in their common residues ('+', '.join([chain+': '+str(len(chain_sets[chain])) for chain in sorted(chain_sets.keys())])+'), check for alternate locations or missing atoms')
+            sys.exit()
+        data = numpy.mean([chain_sets[chain] for chain in chain_sets.keys()], axis=0)
         datamean = data.mean(axis=0)
         uu, dd, vv = numpy.linalg.svd(data - datamean)
         if not self._options['quiet']:
@@ -184,13 +170,7 @@ class SymmToZ(object):
         R[2,2] = 1.0 + (1.0 - ca)*(z**2 - 1.0)
 
         #APPLY THE ROTATION MATRIX
-        for key in self.pdb.hashdata.keys():
-            if self.pdb.hashdata[key]['record_type'] == 'ATOM':
-                A = numpy.array([self.pdb.hashdata[key]['x'],self.pdb.hashdata[key]['y'],self.pdb.hashdata[key]['z']])
-                A = numpy.dot(A, R.T)#Apply transpose of the rotation matrix
-                self.pdb.hashdata[key]['x'] = A.item(0)
-                self.pdb.hashdata[key]['y'] = A.item(1)
-                self.pdb.hashdata[key]['z'] = A.item(2)
+        self.pdb.Rotate(numpy.asarray(R))
 
     def WriteFile(self):
         outfile = open(self._options['outfile'], 'w')
@@ -201,7 +181,7 @@ class SymmToZ(object):
 if __name__ == '__main__':
     parser = OptionParser()
     required = OptionGroup(parser, "Required Arguments")
-    required.add_option("-p", "--pdbfile", action="store", type="string", dest="pdbfile", help="The pdb file you want to use") #A STRING
+    required.add_option("-p", "--pdbfile", action="store", type="string", dest="pdbfile", help="The pdb or mmCIF file you want to use") #A STRING
     required.add_option("-o", "--outfile", action="store", type="string", dest="outfile", help="The pdb file you want to write out") #A STRING
 
     optional = OptionGroup(parser, "Optional Arguments")
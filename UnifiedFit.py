@@ -13,6 +13,8 @@ from subprocess import check_output
  
 #import wx, sys, logging, wx.lib.dialogs, ssh, epics, urllib, ast, time, glob, re, os, subprocess, numpy, pylab, math, multiprocessing, getpass
 from scipy import optimize
+
+from readwrite import read_curve
 #from numpy import mat
 #
 #from os.path import isdir as isdir
@@ -70,20 +72,9 @@ class UnifiedFit():
             self.logger.error(self.options['datfile']+' does not exist.')
             sys.exit()
 
-        self.q = []
-        self.i = []
-                    
-        datafile = open(self.options['datfile'], "r")
-        saxsdata = datafile.readlines()
-        for row in saxsdata:
-            try:
-                q = float(row.split()[0])
-                i = float(row.split()[1])
-                e = float(row.split()[2])
-                if q > 0:
-                    self.q.append(q)
-                    self.i.append(i)
-            except:pass
+        data = read_curve(self.options['datfile'], 3, (0,))
+        self.q = data[:,0].tolist()
+        self.i = data[:,1].tolist()
         self.logger.info('Parsed with '+str(len(self.q))+' data points.')
 
 
@@ -6,6 +6,8 @@ from os.path import isfile
 import logging
 import numpy
 
+from readwrite import read_curve
+
 class autoRg():
     """Calculate Rg for a given dat file
     
@@ -44,22 +46,10 @@ class autoRg():
             
     def parseDatFile(self, datfile=None):
         self.logger.info('Reading and parsing dat file: '+str(datfile))
-        qdata = []
-        idata = []
-        edata = []
-                
-        datafile = open(datfile, "r")
-        saxsdata = datafile.readlines()
-        for row in saxsdata:
-            try:
-                q = float(row.split()[0])
-                i = float(row.split()[1])
-                e = float(row.split()[2])
-                if q > 0:
-                    self.q.append(q)
-                    self.i.append(i)
-                    self.e.append(e)
-            except:pass
+        qdata, idata, edata = read_curve(datfile, 3, (0,)).T.tolist()
+        self.q.extend(qdata)
+        self.i.extend(idata)
+        self.e.extend(edata)
         self.logger.info('Parsed with '+str(len(self.q))+' data points.')
 
     def plotData(self, x=None, y=None):
@@ -4,13 +4,24 @@ Created on Jul 31, 2014
 
 @author: nathan
 '''
-from copy import deepcopy
+from collections.abc import MutableMapping
+from fnmatch import fnmatchcase
+from itertools import chain
+from multiprocessing.pool import Pool, ThreadPool
+import hashlib
+import io
+import json
+import shutil
 import sys
 import logging
+import mmap
 import os
 import re
+import tempfile
 import numpy
 import periodictable
+from scipy.spatial import ConvexHull, cKDTree
+from scipy.spatial.distance import pdist
 
 ### A common interface contract for all readwrite classes
 class Interface(object):    
@@ -20,17 +31,1736 @@ class Interface(object):
     def return_dict(self): raise RuntimeError('Not implemented')
 
 
+class ElementTable(object):
+    """Mass, electron count and volume of every element
+
+    Properties are held in arrays indexed by atomic number, which is
+    used as the integer code of an element, so per-atom values are a
+    single fancy index with the code array of a structure. Code 0 is
+    kept for unknown elements and has zero for every property.
+    Volumes are the displaced solvent volumes (A^3) of Fraser et al.
+    (1978) for H, C, N, O, P and S and the covalent radius sphere for
+    other elements. Use element_table() to get the shared instance.
+    """
+    fraser_volumes = {'H': 5.15, 'C': 16.44, 'N': 2.49, 'O': 9.13, 'P': 5.73, 'S': 19.86}
+
+    def __init__(self):
+        elements = list(periodictable.elements)
+        size = max(element.number for element in elements) + 1
+        self.symbols = [''] * size
+        self.codes = {}
+        self.mass = numpy.zeros(size)
+        self.electrons = numpy.zeros(size)
+        self.volume = numpy.zeros(size)
+        for element in elements:
+            if element.number < 1:
+                continue
+            self.symbols[element.number] = element.symbol
+            self.codes[element.symbol.upper()] = element.number
+            self.mass[element.number] = element.mass
+            self.electrons[element.number] = element.number
+            if element.symbol in self.fraser_volumes:
+                self.volume[element.number] = self.fraser_volumes[element.symbol]
+            elif getattr(element, 'covalent_radius', None):
+                self.volume[element.number] = 4.0 / 3.0 * numpy.pi * element.covalent_radius ** 3
+
+    def code(self, symbol):
+        return self.codes.get(str(symbol).strip().upper(), 0)
+
+    def encode(self, symbols):
+        """Integer codes for an array of element symbols, 0 if unknown"""
+        names, inverse = numpy.unique(numpy.asarray(symbols), return_inverse=True)
+        lookup = numpy.array([self.code(name) for name in names.tolist()], dtype=numpy.int16)
+        return lookup[inverse.ravel()]
+
+_element_table = None
+
+def element_table():
+    """The ElementTable for this process, built on first use"""
+    global _element_table
+    if _element_table is None:
+        _element_table = ElementTable()
+    return _element_table
+
+def atom_weights(atoms, property='mass', logger=None):
+    """Per-atom mass, electrons or volume of the ATOM and HETATM records of an AtomTable
+
+    Returns the weights and the mask of the atoms they belong to.
+    Unknown elements weigh nothing and are logged once each.
+    """
+    mask = atoms.atom_mask()
+    codes = atoms.element_codes()[mask]
+    unknown = codes == 0
+    if unknown.any():
+        logger = logger or logging.getLogger('readwrite.PDB')
+        for atom_name in numpy.unique(atoms.element_symbols()[mask][unknown]).tolist():
+            logger.error('Failed to find '+str(property)+' for element '+str(atom_name))
+    return getattr(element_table(), property)[codes], mask
+
+
+class ResidueTable(object):
+    """Composition of every amino acid and nucleotide residue in a chain
+
+    Holds the one letter code, mass (Da), electrons, neutron coherent
+    scattering length (fm, all hydrogens as 1H) and volume (A^3) of
+    each residue as it is found in a chain, i.e. without the water
+    lost on polymerisation, in arrays indexed by residue code. Masses,
+    electrons and scattering lengths come from the formulas through
+    periodictable. Amino acid volumes are those of Zamyatnin (1972),
+    nucleotide volumes correspond to a partial specific volume of
+    0.55 ml/g. Code 0 is an unknown residue with the average values
+    of the amino acids. Use residue_table() to get the shared instance.
+    """
+    residues = {
+        'GLY': ('G', 'C2H3NO', 60.1),
+        'ALA': ('A', 'C3H5NO', 88.6),
+        'SER': ('S', 'C3H5NO2', 89.0),
+        'CYS': ('C', 'C3H5NOS', 108.5),
+        'ASP': ('D', 'C4H5NO3', 111.1),
+        'PRO': ('P', 'C5H7NO', 112.7),
+        'ASN': ('N', 'C4H6N2O2', 114.1),
+        'THR': ('T', 'C4H7NO2', 116.1),
+        'GLU': ('E', 'C5H7NO3', 138.4),
+        'VAL': ('V', 'C5H9NO', 140.0),
+        'GLN': ('Q', 'C5H8N2O2', 143.8),
+        'HIS': ('H', 'C6H7N3O', 153.2),
+        'MET': ('M', 'C5H9NOS', 162.9),
+        'ILE': ('I', 'C6H11NO', 166.7),
+        'LEU': ('L', 'C6H11NO', 166.7),
+        'LYS': ('K', 'C6H12N2O', 168.6),
+        'ARG': ('R', 'C6H12N4O', 173.4),
+        'PHE': ('F', 'C9H9NO', 189.9),
+        'TYR': ('Y', 'C9H9NO2', 193.6),
+        'TRP': ('W', 'C11H10N2O', 227.8),
+        'DA': ('A', 'C10H12N5O5P', None),
+        'DC': ('C', 'C9H12N3O6P', None),
+        'DG': ('G', 'C10H12N5O6P', None),
+        'DT': ('T', 'C10H13N2O7P', None),
+        'A': ('A', 'C10H12N5O6P', None),
+        'C': ('C', 'C9H12N3O7P', None),
+        'G': ('G', 'C10H12N5O7P', None),
+        'U': ('U', 'C9H11N2O8P', None)}
+    nucleic_vbar = 0.55
+    ###molar extinction coefficients at 280 nm (M^-1 cm^-1)
+    extinction = {'TRP': 5500.0, 'TYR': 1490.0, 'CYS': 125.0}
+
+    def __init__(self):
+        self.names = ['XXX'] + sorted(self.residues.keys())
+        self.codes = dict((name, code) for code, name in enumerate(self.names))
+        size = len(self.names)
+        self.letters = numpy.array(['X'] + [self.residues[name][0] for name in self.names[1:]])
+        self.mass = numpy.zeros(size)
+        self.electrons = numpy.zeros(size)
+        self.scattering_length = numpy.zeros(size)
+        self.volume = numpy.zeros(size)
+        self.extinction_coefficient = numpy.zeros(size)
+        for code, name in enumerate(self.names[1:], 1):
+            letter, formula, volume = self.residues[name]
+            formula = periodictable.formula(formula)
+            self.mass[code] = formula.mass
+            self.electrons[code] = sum([element.number * count for element, count in formula.atoms.items()])
+            self.scattering_length[code] = sum([element.neutron.b_c * count for element, count in formula.atoms.items()])
+            if volume == None:
+                volume = self.nucleic_vbar * formula.mass / 0.602214076
+            self.volume[code] = volume
+            self.extinction_coefficient[code] = self.extinction.get(name, 0.0)
+        amino = [self.codes[name] for name in self.residues if self.residues[name][2] != None]
+        for column in [self.mass, self.electrons, self.scattering_length, self.volume]:
+            column[0] = column[amino].mean()
+
+    def encode(self, names):
+        """Integer codes for an array of residue names, 0 if unknown"""
+        names, inverse = numpy.unique(numpy.asarray(names), return_inverse=True)
+        lookup = numpy.array([self.codes.get(name.strip().upper(), 0) for name in names.tolist()], dtype=numpy.int16)
+        return lookup[inverse.ravel()]
+
+_residue_table = None
+
+def residue_table():
+    """The ResidueTable for this process, built on first use"""
+    global _residue_table
+    if _residue_table is None:
+        _residue_table = ResidueTable()
+    return _residue_table
+
+avogadro = 6.02214076e23
+electron_radius = 2.8179403e-13 # in cm
+water_xray_sld = 9.469e10 # in cm^-2
+water_neutron_sld = -0.561e10 # in cm^-2
+_compositions = {}
+
+def sequence_composition(sequences):
+    """Composition of chains given as {chain: [residue names]}
+
+    Returns {'chains': {chain: values}, 'total': values} where values
+    holds the one letter 'sequence', number of 'residues', 'mw' (Da,
+    with one water per chain), 'extinction' (M^-1 cm^-1 at 280 nm),
+    'absorbance' (extinction per Da, the absorbance of 1 mg/ml),
+    'vbar' (ml/g), 'volume' (A^3), 'xray_sld' and 'neutron_sld'
+    (cm^-2) and 'xray_contrast' and 'neutron_contrast' against H2O
+    (cm^-2). All residues are looked up in one pass and summed per
+    chain with numpy.bincount. Results are cached for the process by
+    a hash of the sequences, so every model or pose of one structure
+    shares them.
+    """
+    key = hashlib.sha1(json.dumps(sorted([[str(chain), list(names)] for chain, names in sequences.items()])).encode()).hexdigest()
+    if key in _compositions:
+        return _compositions[key]
+    table = residue_table()
+    chains = list(sequences.keys())
+    lengths = numpy.array([len(sequences[chain]) for chain in chains], dtype=numpy.int64)
+    names = [name for chain in chains for name in sequences[chain]]
+    codes = table.encode(names) if len(names) > 0 else numpy.zeros(0, dtype=numpy.int16)
+    chain_number = numpy.repeat(numpy.arange(len(chains)), lengths)
+    water = periodictable.formula('H2O')
+    sums = {}
+    for column in ['mass', 'electrons', 'scattering_length', 'volume', 'extinction_coefficient']:
+        sums[column] = numpy.bincount(chain_number, getattr(table, column)[codes], len(chains))
+    ###the water lost on polymerisation is put back once per chain
+    present = lengths > 0
+    sums['mass'] += present * water.mass
+    sums['electrons'] += present * 10.0
+    sums['scattering_length'] += present * (2 * periodictable.H.neutron.b_c + periodictable.O.neutron.b_c)
+    letters = table.letters[codes]
+
+    def values(sequence, residues, mass, electrons, scattering_length, volume, extinction):
+        cm3 = volume * 1e-24
+        values = {'sequence': sequence, 'residues': int(residues), 'mw': float(mass), 'extinction': float(extinction),
+                  'absorbance': float(extinction / mass) if mass > 0 else 0.0, 'volume': float(volume),
+                  'vbar': float(avogadro * cm3 / mass) if mass > 0 else 0.0,
+                  'xray_sld': float(electrons * electron_radius / cm3) if volume > 0 else 0.0,
+                  'neutron_sld': float(scattering_length * 1e-13 / cm3) if volume > 0 else 0.0}
+        values['xray_contrast'] = values['xray_sld'] - water_xray_sld if volume > 0 else 0.0
+        values['neutron_contrast'] = values['neutron_sld'] - water_neutron_sld if volume > 0 else 0.0
+        return values
+
+    composition = {'chains': {}}
+    ends = numpy.cumsum(lengths)
+    for number, chain in enumerate(chains):
+        composition['chains'][chain] = values(''.join(letters[ends[number] - lengths[number]:ends[number]].tolist()), lengths[number],
+                                              *[sums[column][number] for column in ['mass', 'electrons', 'scattering_length', 'volume', 'extinction_coefficient']])
+    composition['total'] = values(''.join(letters.tolist()), lengths.sum(),
+                                  *[sums[column].sum() for column in ['mass', 'electrons', 'scattering_length', 'volume', 'extinction_coefficient']])
+    _compositions[key] = composition
+    return composition
+
+
+class AtomTable(object):
+    """Columnar store for the atoms of a pdb file
+
+    Every field of an ATOM or HETATM record is held in its own
+    NumPy array, with x, y and z together in a single Nx3 coords
+    array, so whole structure operations can be done with array
+    arithmetic rather than a python loop over per-atom dicts. The
+    'index' column holds the hashdata key (the line number in the
+    original file) of every atom. Arrays are over-allocated so that
+    atoms can be appended without copying the table every time.
+
+    Rigid body transforms are not applied straight away, they are
+    composed into a single pending 4x4 matrix by transform() which is
+    applied to all the coordinates in one matrix multiply the next
+    time the coordinates are read or written. Every transform is also
+    composed into 'placement' so that a SpatialIndex can tell a rigid
+    move, which it can follow, from coordinates that were replaced.
+
+    Values derived from the atoms are kept by memo() against the
+    topology and geometry counters they depend on.
+    """
+    fields = (
+        ('index', 'i8', 0),
+        ('record_type', 'U6', 'ATOM'),
+        ('serial_no', 'i8', 0),
+        ('atom_name', 'U4', ''),
+        ('alternate', 'U1', ''),
+        ('residue', 'U5', ''),
+        ('chain', 'U4', ''),
+        ('residue_no', 'i8', 0),
+        ('icode', 'U1', ''),
+        ('occupancy', 'f8', numpy.nan),
+        ('bfactor', 'f8', numpy.nan),
+        ('element', 'U2', ''),
+        ('charge', 'U2', '')
+    )
+    axes = {'x': 0, 'y': 1, 'z': 2}
+
+    def __init__(self, size=0):
+        self.size = 0
+        self.capacity = 0
+        self.data = {}
+        for name, dtype, default in self.fields:
+            self.data[name] = numpy.full(0, default, dtype=dtype)
+        self.data['coords'] = numpy.zeros((0, 3))
+        ###incremented whenever rows are added or removed
+        self.layout = 0
+        ###incremented whenever rows or any column other than coords change
+        self.topology = 0
+        ###incremented whenever coords are replaced rather than transformed
+        self.positions = 0
+        ###incremented whenever coords change in any way
+        self.geometry = 0
+        self.placement = numpy.identity(4)
+        self._derived = {}
+        self._element_codes = (None, None)
+        self._atom_index = None
+        self._spatial_index = None
+        self._selections = (None, {})
+        self.pending = None
+        if size:
+            self.append({}, size)
+
+    @classmethod
+    def from_arrays(cls, data):
+        """Make a table around full length column arrays without copying them
+
+        data must hold every field plus 'coords'. Used for memory
+        mapped columns loaded from a StructureCache.
+        """
+        table = cls()
+        for name, dtype, default in cls.fields:
+            if not name in data:
+                raise KeyError('Missing column: '+name)
+        table.data = dict(data)
+        table.size = table.capacity = len(data['coords'])
+        table.layout += 1
+        table.topology += 1
+        table.geometry += 1
+        return table
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def __setitem__(self, name, value):
+        self.assign(name, value)
+
+    def column(self, name):
+        """Read only view of a column, write with assign() so the counters follow every change"""
+        if name in self.axes:
+            return self.coords[:, self.axes[name]]
+        view = self.data[name][:self.size]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def coords(self):
+        """Read only Nx3 view of the coordinates with any pending transform applied"""
+        self.flush()
+        view = self.data['coords'][:self.size]
+        view.flags.writeable = False
+        return view
+
+    def assign(self, name, value, rows=slice(None)):
+        """Write value into the given rows of a column, x, y, z or coords, and bump the counters that depend on it"""
+        if name == 'coords' or name in self.axes:
+            self.flush()
+            coords = self.data['coords'][:self.size]
+            if name == 'coords':
+                coords[rows] = value
+            else:
+                coords[rows, self.axes[name]] = value
+            self.moved()
+        else:
+            self.data[name][:self.size][rows] = value
+            self.touch()
+
+    def transform(self, matrix):
+        """Queue a 4x4 affine transform to be applied to all atoms"""
+        matrix = numpy.asarray(matrix, dtype=float)
+        self.placement = numpy.dot(matrix, self.placement)
+        self.geometry += 1
+        if self.pending is None:
+            self.pending = matrix.copy()
+        else:
+            self.pending = numpy.dot(matrix, self.pending)
+
+    def flush(self):
+        """Apply any pending transform to the coordinate array"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            coords = self.data['coords'][:self.size]
+            coords[:] = numpy.dot(coords, pending[:3, :3].T) + pending[:3, 3]
+
+    @property
+    def dtypes(self):
+        return dict((name, dtype) for name, dtype, default in self.fields)
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        self.flush()
+        capacity = max(capacity, 2 * self.capacity, 16)
+        for name, dtype, default in self.fields:
+            grown = numpy.full(capacity, default, dtype=dtype)
+            grown[:self.size] = self.data[name][:self.size]
+            self.data[name] = grown
+        grown = numpy.zeros((capacity, 3))
+        grown[:self.size] = self.data['coords'][:self.size]
+        self.data['coords'] = grown
+        self.capacity = capacity
+
+    def append(self, columns, count=None):
+        """Append rows given as a dict of column name to array
+
+        Columns that are not given take their default value, x, y
+        and z may be given separately or together as 'coords'.
+        Returns the slice of the new rows.
+        """
+        if count == None:
+            lengths = [len(value) for value in columns.values()]
+            count = lengths[0] if len(lengths) > 0 else 0
+        self.flush()
+        start = self.size
+        self.reserve(start + count)
+        new = slice(start, start + count)
+        for name, dtype, default in self.fields:
+            if name in columns:
+                self.data[name][new] = columns[name]
+            else:
+                self.data[name][new] = default
+        if 'coords' in columns:
+            self.data['coords'][new] = columns['coords']
+        else:
+            self.data['coords'][new] = 0.0
+        for axis in self.axes:
+            if axis in columns:
+                self.data['coords'][new, self.axes[axis]] = columns[axis]
+        self.size = start + count
+        self.layout += 1
+        self.topology += 1
+        self.geometry += 1
+        return new
+
+    def delete(self, rows):
+        self.flush()
+        keep = numpy.ones(self.size, dtype=bool)
+        keep[rows] = False
+        count = int(keep.sum())
+        for name in self.data:
+            self.data[name][:count] = self.data[name][:self.size][keep]
+        self.size = count
+        self.layout += 1
+        self.topology += 1
+        self.geometry += 1
+
+    def touch(self):
+        """Record that a column other than coords was changed in place"""
+        self.topology += 1
+
+    def moved(self):
+        """Record that coords were overwritten in place rather than by transform()"""
+        self.positions += 1
+        self.geometry += 1
+
+    def memo(self, name, depends, compute):
+        """Value of compute(), recomputed only when the counters named in depends have changed
+
+        depends is a tuple of counter names, 'topology' for values that
+        only depend on which atoms there are and what they are called,
+        'geometry' as well for anything that depends on coordinates.
+        """
+        generation = tuple([getattr(self, counter) for counter in depends])
+        if name in self._derived and self._derived[name][0] == generation:
+            return self._derived[name][1]
+        value = compute()
+        self._derived[name] = (generation, value)
+        return value
+
+    def atom_mask(self):
+        record_type = self.column('record_type')
+        return (record_type == 'ATOM') | (record_type == 'HETATM')
+
+    def get(self, row, name):
+        value = self.column(name)[row]
+        if isinstance(value, numpy.str_):
+            return str(value)
+        return value.item()
+
+    def set(self, row, name, value):
+        self.assign(name, value, row)
+
+    def element_symbols(self):
+        """Element column, falling back to the first letter of the atom name"""
+        element = self.column('element')
+        initial = numpy.char.lstrip(self.column('atom_name'), '0123456789').astype('U1')
+        return numpy.where(element != '', element, initial)
+
+    def element_codes(self):
+        """Atomic number of every atom (0 if unknown), cached until the topology changes"""
+        generation, codes = self._element_codes
+        if generation != self.topology:
+            codes = element_table().encode(self.element_symbols())
+            self._element_codes = (self.topology, codes)
+        return codes
+
+    def atom_index(self):
+        """AtomIndex of the table, rebuilt on first use after the topology changes"""
+        if self._atom_index is None or self._atom_index.generation != self.topology:
+            self._atom_index = AtomIndex(self)
+        return self._atom_index
+
+    def select(self, text):
+        """Read only boolean mask of the rows matched by a selection string, cached until the topology changes"""
+        generation, masks = self._selections
+        if generation != self.topology:
+            masks = {}
+            self._selections = (self.topology, masks)
+        if not text in masks:
+            mask = compile_selection(text).mask(self)
+            mask.flags.writeable = False
+            masks[text] = mask
+        return masks[text]
+
+    def spatial_index(self):
+        """SpatialIndex of the ATOM and HETATM rows, kept up to date by the index itself"""
+        if self._spatial_index is None or self._spatial_index.layout != self.layout:
+            self._spatial_index = SpatialIndex(self)
+        return self._spatial_index
+
+
+class AtomIndex(object):
+    """Chain, residue and atom lookups for the rows of an AtomTable
+
+    Maps (chain, residue_no, icode, atom_name) and serial_no to a row,
+    residue_no to the residues that carry it, and every chain to its
+    residues in file order, so that per-residue lookups are O(1)
+    rather than a scan of every atom. Where keys repeat (alternate
+    locations, duplicate serial numbers) the first atom is used. The
+    index records the topology generation it was built from and is
+    rebuilt by AtomTable.atom_index() once that changes.
+    """
+    def __init__(self, atoms):
+        self.generation = atoms.topology
+        chain = atoms['chain'].tolist()
+        residue_no = atoms['residue_no'].tolist()
+        icode = atoms['icode'].tolist()
+        atom_name = atoms['atom_name'].tolist()
+        serial_no = atoms['serial_no']
+        rows = range(len(atoms) - 1, -1, -1)
+        ###built in reverse so the first of any repeated key wins
+        self.atoms = dict(zip(zip(chain[::-1], residue_no[::-1], icode[::-1], atom_name[::-1]), rows))
+        self.serials = dict(zip(serial_no[::-1].tolist(), rows))
+        serials, counts = numpy.unique(serial_no, return_counts=True)
+        self.repeated_serials = dict(zip(serials[counts > 1].tolist(), counts[counts > 1].tolist()))
+
+        residue_keys = list(zip(chain, residue_no, icode))
+        self.chains = {}
+        self.numbers = {}
+        seen = set()
+        for key in residue_keys:
+            if not key in seen:
+                seen.add(key)
+                self.chains.setdefault(key[0], []).append(key)
+                self.numbers.setdefault(key[1], []).append(key)
+
+    def atom(self, chain, residue_no, atom_name, icode=''):
+        """Row of an atom or None"""
+        return self.atoms.get((chain, residue_no, icode, atom_name))
+
+    def serial(self, serial_no):
+        """Row of the first atom with this serial number or None"""
+        return self.serials.get(serial_no)
+
+    def serial_count(self, serial_no):
+        if serial_no in self.repeated_serials:
+            return self.repeated_serials[serial_no]
+        return 1 if serial_no in self.serials else 0
+
+    def residues(self, chain=None):
+        """(chain, residue_no, icode) of every residue, or those of one chain, in file order"""
+        if chain != None:
+            return list(self.chains.get(chain, []))
+        return [residue for residues in self.chains.values() for residue in residues]
+
+    def residues_numbered(self, residue_no):
+        return list(self.numbers.get(residue_no, []))
+
+    def residue_atoms(self, atom_names, chain=None):
+        """Rows of the first of atom_names found in each residue, skipping residues with none of them"""
+        rows = []
+        for residue in self.residues(chain):
+            for atom_name in atom_names:
+                row = self.atoms.get(residue + (atom_name,))
+                if row != None:
+                    rows.append(row)
+                    break
+        return numpy.array(rows, dtype=numpy.int64)
+
+
+class SpatialIndex(object):
+    """KD-tree over the coordinates of some rows of an AtomTable
+
+    Answers radius, nearest neighbour, contact and clash queries in
+    O(log N) per atom rather than a scan over every pair. Results are
+    given as rows of the AtomTable. The tree is built in the frame the
+    coordinates had at the time and remembers the table placement then,
+    so after a rigid transform (rotation, translation or inversion)
+    query points are mapped back into that frame instead of rebuilding
+    the tree. It is rebuilt when atoms are added or removed, when the
+    coordinates are replaced, or after a transform that does not keep
+    distances such as a scaling.
+    """
+    def __init__(self, atoms, rows=None):
+        self.atoms = atoms
+        if rows is None:
+            rows = numpy.flatnonzero(atoms.atom_mask())
+        self.rows = numpy.asarray(rows, dtype=numpy.int64)
+        self.rebuilds = 0
+        self.build()
+
+    def build(self):
+        self.tree = cKDTree(self.atoms.coords[self.rows])
+        self.layout = self.atoms.layout
+        self.positions = self.atoms.positions
+        self.placement = self.atoms.placement.copy()
+        self.rebuilds += 1
+
+    def update(self):
+        """Rebuild the tree if needed and return the rigid move of the atoms since it was built, or None"""
+        atoms = self.atoms
+        if atoms.layout != self.layout:
+            raise RuntimeError('Atoms were added or removed since the SpatialIndex was built')
+        if atoms.positions != self.positions:
+            self.build()
+        elif not numpy.array_equal(atoms.placement, self.placement):
+            relative = numpy.dot(atoms.placement, numpy.linalg.inv(self.placement))
+            rotation = relative[:3, :3]
+            if numpy.allclose(numpy.dot(rotation.T, rotation), numpy.identity(3)):
+                return relative
+            self.build()
+        return None
+
+    def _local(self, points):
+        """Map points from the current frame of the atoms into the frame of the tree"""
+        points = numpy.asarray(points, dtype=float)
+        relative = self.update()
+        if relative is None:
+            return points
+        ###p = R x + t so x = R^T (p - t), written for row vectors
+        return numpy.dot(points - relative[:3, 3], relative[:3, :3])
+
+    def within(self, points, radius):
+        """Rows within radius of a point, or a list of row arrays for an Nx3 array of points"""
+        points = numpy.asarray(points, dtype=float)
+        local = self._local(points.reshape(-1, 3))
+        found = self.tree.query_ball_point(local, radius)
+        found = [self.rows[numpy.sort(numpy.array(hits, dtype=numpy.int64))] for hits in found]
+        if points.ndim == 1:
+            return found[0]
+        return found
+
+    def nearest(self, points, k=1):
+        """Distances and rows of the k nearest atoms to every point, row -1 where there are fewer than k atoms"""
+        local = self._local(numpy.atleast_2d(points))
+        distances, hits = self.tree.query(local, k=k)
+        rows = numpy.append(self.rows, -1)[hits]
+        return distances, rows
+
+    def pairs(self, radius):
+        """Mx2 array of the rows of every pair of atoms within radius of each other"""
+        self.update()
+        hits = self.tree.query_pairs(radius, output_type='ndarray')
+        return numpy.sort(self.rows[hits], axis=1)
+
+    def cross(self, other, radius):
+        """Mx2 array of (row, other row) within radius of each other
+
+        other is another SpatialIndex, for instance over a symmetry mate
+        or a second structure, or an Nx3 array of points in which case
+        the second column is the point number.
+        """
+        if isinstance(other, SpatialIndex):
+            points, other_rows = other.atoms.coords[other.rows], other.rows
+        else:
+            points = numpy.atleast_2d(numpy.asarray(other, dtype=float))
+            other_rows = numpy.arange(len(points))
+        local = cKDTree(self._local(points))
+        hits = self.tree.sparse_distance_matrix(local, radius, output_type='ndarray')
+        return numpy.column_stack((self.rows[hits['i']], other_rows[hits['j']]))
+
+    def contacts(self, radius=4.0):
+        """Pairs of rows within radius of each other that are in different chains"""
+        pairs = self.pairs(radius)
+        chain = self.atoms['chain']
+        return pairs[chain[pairs[:, 0]] != chain[pairs[:, 1]]]
+
+    def clashes(self, cutoff=2.0, other=None):
+        """Pairs of rows closer than cutoff
+
+        Within a structure, atoms of the same residue and of sequence
+        neighbours in the same chain are bonded and are not counted.
+        With other (a SpatialIndex or points) every close pair between
+        the two is a clash.
+        """
+        if other is not None:
+            return self.cross(other, cutoff)
+        pairs = self.pairs(cutoff)
+        chain = self.atoms['chain']
+        residue_no = self.atoms['residue_no']
+        bonded = (chain[pairs[:, 0]] == chain[pairs[:, 1]]) & (numpy.abs(residue_no[pairs[:, 0]] - residue_no[pairs[:, 1]]) <= 1)
+        return pairs[~bonded]
+
+
+class Selection(object):
+    """Atom selection compiled from a string such as 'chain A+B and name CA and resid 10-250'
+
+    Terms are a keyword followed by one or more values separated by
+    '+' or spaces and are combined with and, or, not and brackets.
+    String keywords (chain, name, resname, altloc, icode, element,
+    record) accept * and ? wildcards, numeric keywords (resid, serial)
+    accept ranges such as 10-250 or -5:10, and bfactor and occupancy
+    are compared with <, <=, >, >=, == or !=. all, none, atom and
+    hetatm select on their own. The string is parsed once into a tree
+    that is evaluated as whole column NumPy comparisons, string terms
+    being matched against the distinct values of a column only.
+    """
+    keywords = {
+        'chain': 'chain',
+        'name': 'atom_name',
+        'resname': 'residue',
+        'altloc': 'alternate',
+        'icode': 'icode',
+        'element': 'element',
+        'record': 'record_type',
+        'resid': 'residue_no',
+        'serial': 'serial_no'}
+    numeric = ('residue_no', 'serial_no')
+    comparisons = {'bfactor': 'bfactor', 'occupancy': 'occupancy'}
+    flags = ('all', 'none', 'atom', 'hetatm')
+    operators = ('and', 'or', 'not', '(', ')')
+    _token = re.compile(r'\(|\)|[<>!=]=|[<>]|[^\s()<>=!]+')
+    _range = re.compile(r'^(-?\d+)(?:[-:](-?\d+))?$')
+
+    def __init__(self, text):
+        self.text = str(text)
+        self.tokens = self._token.findall(self.text)
+        self.position = 0
+        if len(self.tokens) == 0:
+            raise ValueError('Empty selection')
+        self.tree = self._or()
+        if self.position < len(self.tokens):
+            self._fail('Unexpected "'+self.tokens[self.position]+'"')
+
+    def _fail(self, message):
+        raise ValueError(message+' in selection: '+self.text)
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token == None:
+            self._fail('Unexpected end')
+        self.position += 1
+        return token
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == 'or':
+            self.position += 1
+            node = ('or', node, self._and())
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self._peek() == 'and':
+            self.position += 1
+            node = ('and', node, self._not())
+        return node
+
+    def _not(self):
+        if self._peek() == 'not':
+            self.position += 1
+            return ('not', self._not())
+        return self._term()
+
+    def _values(self):
+        values = []
+        while self._peek() != None and not self._peek() in self.operators:
+            values.extend([value for value in self._next().split('+') if value != ''])
+        return values
+
+    def _term(self):
+        token = self._next()
+        if token == '(':
+            node = self._or()
+            if self._next() != ')':
+                self._fail('Missing ")"')
+            return node
+        if token in self.flags:
+            return ('flag', token)
+        if token in self.comparisons:
+            operator = self._next()
+            if not operator in ('<', '<=', '>', '>=', '==', '!='):
+                self._fail('Expected a comparison after '+token)
+            try:
+                value = float(self._next())
+            except ValueError:
+                self._fail(token+' must be compared with a number')
+            return ('compare', self.comparisons[token], operator, value)
+        if token in self.keywords:
+            column = self.keywords[token]
+            values = self._values()
+            if len(values) == 0:
+                self._fail('No values given for '+token)
+            if column in self.numeric:
+                ranges = []
+                for value in values:
+                    match = self._range.match(value)
+                    if match == None:
+                        self._fail('Expected a number or range for '+token+' not "'+value+'"')
+                    low = int(match.group(1))
+                    high = int(match.group(2)) if match.group(2) != None else low
+                    ranges.append((low, high))
+                return ('range', column, ranges)
+            return ('match', column, values)
+        self._fail('Unknown keyword "'+token+'"')
+
+    def mask(self, atoms):
+        """Boolean mask over the rows of an AtomTable"""
+        return self._evaluate(self.tree, atoms)
+
+    def _evaluate(self, node, atoms):
+        kind = node[0]
+        if kind == 'or':
+            return self._evaluate(node[1], atoms) | self._evaluate(node[2], atoms)
+        if kind == 'and':
+            return self._evaluate(node[1], atoms) & self._evaluate(node[2], atoms)
+        if kind == 'not':
+            return ~self._evaluate(node[1], atoms)
+        if kind == 'flag':
+            if node[1] == 'all':
+                return numpy.ones(len(atoms), dtype=bool)
+            if node[1] == 'none':
+                return numpy.zeros(len(atoms), dtype=bool)
+            return atoms['record_type'] == node[1].upper()
+        if kind == 'compare':
+            values = atoms[node[1]]
+            return {'<': numpy.less, '<=': numpy.less_equal, '>': numpy.greater, '>=': numpy.greater_equal,
+                    '==': numpy.equal, '!=': numpy.not_equal}[node[2]](values, node[3])
+        if kind == 'range':
+            values = atoms[node[1]]
+            mask = numpy.zeros(len(atoms), dtype=bool)
+            for low, high in node[2]:
+                mask |= (values >= low) & (values <= high)
+            return mask
+        ###match patterns against the distinct values of the column only
+        if node[1] == 'element':
+            distinct, inverse = numpy.unique(numpy.char.upper(atoms.element_symbols()), return_inverse=True)
+            patterns = [value.upper() for value in node[2]]
+        else:
+            distinct, inverse = numpy.unique(atoms[node[1]], return_inverse=True)
+            patterns = node[2]
+        hits = numpy.array([any([fnmatchcase(value, pattern) for pattern in patterns]) for value in distinct.tolist()], dtype=bool)
+        return hits[inverse.reshape(-1)] if len(distinct) > 0 else numpy.zeros(len(atoms), dtype=bool)
+
+_compiled_selections = {}
+
+def compile_selection(text):
+    """Selection for a string, compiled once per process"""
+    if not text in _compiled_selections:
+        _compiled_selections[text] = Selection(text)
+    return _compiled_selections[text]
+
+
+class AtomRecord(MutableMapping):
+    """Dictionary view of one row of an AtomTable
+
+    Reading and writing keys goes straight through to the columns of
+    the table. As with the dictionaries that used to be built by the
+    parser, float fields that could not be read are left out.
+    """
+    keys_order = ('record_type', 'serial_no', 'atom_name', 'alternate', 'residue', 'chain', 'residue_no',
+                  'icode', 'x', 'y', 'z', 'occupancy', 'bfactor', 'element', 'charge')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def _present(self, key):
+        if not key in self.keys_order:
+            return False
+        value = self.table.column(key)[self.row]
+        return not (isinstance(value, numpy.floating) and numpy.isnan(value))
+
+    def __getitem__(self, key):
+        if not self._present(key):
+            raise KeyError(key)
+        return self.table.get(self.row, key)
+
+    def __setitem__(self, key, value):
+        if not key in self.keys_order:
+            raise KeyError('Atom records have no property: '+str(key))
+        self.table.set(self.row, key, value)
+
+    def __delitem__(self, key):
+        if not self._present(key):
+            raise KeyError(key)
+        self.table.set(self.row, key, dict((name, default) for name, dtype, default in self.table.fields).get(key, numpy.nan))
+
+    def __iter__(self):
+        return (key for key in self.keys_order if self._present(key))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __contains__(self, key):
+        return self._present(key)
+
+    def copy(self):
+        return dict(self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class PdbDict(MutableMapping):
+    """Dictionary compatible view of a parsed pdb file
+
+    Keys are line numbers as before. ATOM and HETATM lines are held
+    in an AtomTable and returned as AtomRecord views, all other lines
+    are kept as plain {'record_type': ..., 'string': ...} dicts.
+    """
+    def __init__(self, atoms=None, others=None):
+        if atoms == None:
+            atoms = AtomTable()
+        if others == None:
+            others = {}
+        self.atoms = atoms
+        self.others = others
+        self._rows = None
+        self._rows_layout = None
+
+    @classmethod
+    def from_dict(cls, input_dict):
+        atoms = AtomTable()
+        others = {}
+        columns = {}
+        for key in AtomRecord.keys_order:
+            columns[key] = []
+        indexes = []
+        for index in sorted(input_dict.keys()):
+            record = input_dict[index]
+            if record.get('record_type') in ['ATOM', 'HETATM']:
+                indexes.append(index)
+                for key in AtomRecord.keys_order:
+                    columns[key].append(record.get(key, None))
+            else:
+                others[index] = dict(record)
+        defaults = dict((name, default) for name, dtype, default in atoms.fields)
+        for key in AtomRecord.keys_order:
+            default = defaults.get(key, numpy.nan)
+            columns[key] = [default if value == None else value for value in columns[key]]
+        columns['index'] = indexes
+        atoms.append(columns, len(indexes))
+        return cls(atoms, others)
+
+    def row_map(self):
+        if self._rows_layout != self.atoms.layout:
+            self._rows = dict(zip(self.atoms['index'].tolist(), range(len(self.atoms))))
+            self._rows_layout = self.atoms.layout
+        return self._rows
+
+    def __getitem__(self, key):
+        if key in self.others:
+            return self.others[key]
+        return AtomRecord(self.atoms, self.row_map()[key])
+
+    def __setitem__(self, key, value):
+        rows = self.row_map()
+        if value.get('record_type') in ['ATOM', 'HETATM']:
+            self.others.pop(key, None)
+            if key in rows:
+                record = AtomRecord(self.atoms, rows[key])
+                for name in value:
+                    record[name] = value[name]
+            else:
+                columns = dict((name, [value[name]]) for name in value if name in AtomRecord.keys_order)
+                columns['index'] = [key]
+                new = self.atoms.append(columns, 1)
+                ###keep the row map rather than rebuilding it for every atom added
+                rows[key] = new.start
+                self._rows_layout = self.atoms.layout
+        else:
+            if key in rows:
+                self.atoms.delete([rows[key]])
+            self.others[key] = dict(value)
+
+    def next_index(self):
+        """First key after every atom and other record"""
+        atoms = self.atoms
+        last = atoms.memo('last_index', ('layout',), lambda: int(atoms['index'].max(initial=0)))
+        return max(last, max(self.others.keys(), default=0)) + 1
+
+    def extend(self, columns, count=None):
+        """Append atoms given as a dict of column arrays under new consecutive keys, returns the slice of new rows"""
+        if count == None:
+            lengths = [len(value) for value in columns.values()]
+            count = lengths[0] if len(lengths) > 0 else 0
+        rows = self.row_map()
+        start = self.next_index()
+        columns = dict(columns)
+        columns['index'] = numpy.arange(start, start + count)
+        new = self.atoms.append(columns, count)
+        rows.update(zip(range(start, start + count), range(new.start, new.stop)))
+        self._rows_layout = self.atoms.layout
+        return new
+
+    def __delitem__(self, key):
+        if key in self.others:
+            del self.others[key]
+        else:
+            self.atoms.delete([self.row_map()[key]])
+
+    def __contains__(self, key):
+        return key in self.others or key in self.row_map()
+
+    def __iter__(self):
+        keys = numpy.concatenate((self.atoms['index'], numpy.array(list(self.others.keys()), dtype='i8')))
+        return iter(numpy.sort(keys).tolist())
+
+    def __len__(self):
+        return len(self.atoms) + len(self.others)
+
+    def __repr__(self):
+        return 'PdbDict('+str(len(self.atoms))+' atoms, '+str(len(self.others))+' other records)'
+
+
+def rotation_matrix(axis, theta):
+    """3x3 matrix for a rotation of theta degrees around the X, Y or Z axis"""
+    theta = numpy.radians(theta)
+    if axis == 'X':
+        return numpy.array([[1,0,0],[0,numpy.cos(theta),-numpy.sin(theta)],[0,numpy.sin(theta),numpy.cos(theta)]])
+    elif axis == 'Y':
+        return numpy.array([[numpy.cos(theta),0,numpy.sin(theta)],[0,1,0],[-numpy.sin(theta),0,numpy.cos(theta)]])
+    elif axis == 'Z':
+        return numpy.array([[numpy.cos(theta),-numpy.sin(theta),0],[numpy.sin(theta),numpy.cos(theta),0],[0,0,1]])
+    else:
+        sys.exit('error matrix function, required axis is neither x,y or z!')
+
+def affine_matrix(rotation=None, translation=None, origin=None):
+    """4x4 matrix that rotates around origin and then translates"""
+    matrix = numpy.identity(4)
+    if rotation is not None:
+        matrix[:3, :3] = rotation
+    if origin is not None:
+        origin = numpy.asarray(origin, dtype=float)
+        matrix[:3, 3] = origin - numpy.dot(matrix[:3, :3], origin)
+    if translation is not None:
+        matrix[:3, 3] += numpy.asarray(translation, dtype=float)
+    return matrix
+
+def _centred(models, weights):
+    """Weighted centroids (N,3) and centred coordinates of a stack of models"""
+    centroids = numpy.einsum('m,nmi->ni', weights, models) / weights.sum()
+    return centroids, models - centroids[:, None, :]
+
+def _kabsch_rotations(covariance):
+    """Proper rotations maximising the overlap for a stack of 3x3 covariance matrices, and the matching trace"""
+    u, s, vt = numpy.linalg.svd(covariance)
+    ###flip the smallest axis where the best orthogonal match is a reflection
+    sign = numpy.sign(numpy.linalg.det(u) * numpy.linalg.det(vt))
+    sign[sign == 0] = 1.0
+    s[..., 2] *= sign
+    u[..., :, 2] *= sign[..., None]
+    return numpy.matmul(u, vt).swapaxes(-1, -2), s.sum(axis=-1)
+
+def kabsch(reference, models, weights=None):
+    """Superpose each of N models onto a reference structure
+
+    reference is an Mx3 array and models an NxMx3 stack (or a single
+    Mx3 model) of the same atoms in the same order. All N fits are done
+    together with one batched SVD. Returns rotations (Nx3x3),
+    translations (Nx3) and RMSDs (N) such that
+    numpy.dot(model, rotation.T) + translation is the fitted model.
+    The RMSD comes from the singular values so the models are never
+    actually moved. weights, one per atom, gives a mass weighted fit.
+    """
+    reference = numpy.asarray(reference, dtype=float)
+    models = numpy.asarray(models, dtype=float)
+    if models.ndim == 2:
+        models = models[None]
+    if weights is None:
+        weights = numpy.ones(len(reference))
+    weights = numpy.asarray(weights, dtype=float)
+    reference_centre, reference_centred = _centred(reference[None], weights)
+    centres, centred = _centred(models, weights)
+    covariance = numpy.einsum('m,nmi,mj->nij', weights, centred, reference_centred[0])
+    rotations, overlap = _kabsch_rotations(covariance)
+    translations = reference_centre - numpy.einsum('nij,nj->ni', rotations, centres)
+    ###|x - Ry|^2 = |x|^2 + |y|^2 - 2 trace(RH), and the trace is the overlap
+    spread = numpy.einsum('m,nmi,nmi->n', weights, centred, centred) + numpy.einsum('m,mi,mi->', weights, reference_centred[0], reference_centred[0])
+    rmsd = numpy.sqrt(numpy.maximum(spread - 2.0 * overlap, 0.0) / weights.sum())
+    return rotations, translations, rmsd
+
+def _determinants(m):
+    """det of a stack of 3x3 matrices written out element by element, which is faster than numpy.linalg.det for many small matrices"""
+    return (m[..., 0, 0] * (m[..., 1, 1] * m[..., 2, 2] - m[..., 1, 2] * m[..., 2, 1])
+            - m[..., 0, 1] * (m[..., 1, 0] * m[..., 2, 2] - m[..., 1, 2] * m[..., 2, 0])
+            + m[..., 0, 2] * (m[..., 1, 0] * m[..., 2, 1] - m[..., 1, 1] * m[..., 2, 0]))
+
+def _symmetric_eigenvalues(m):
+    """Eigenvalues, smallest first, of a stack of symmetric 3x3 matrices from the closed form trigonometric solution"""
+    trace = (m[..., 0, 0] + m[..., 1, 1] + m[..., 2, 2]) / 3.0
+    off = m[..., 0, 1]**2 + m[..., 0, 2]**2 + m[..., 1, 2]**2
+    scale = numpy.sqrt(((m[..., 0, 0] - trace)**2 + (m[..., 1, 1] - trace)**2 + (m[..., 2, 2] - trace)**2 + 2.0 * off) / 6.0)
+    safe = numpy.where(scale > 0, scale, 1.0)
+    shifted = (m - trace[..., None, None] * numpy.identity(3)) / safe[..., None, None]
+    angle = numpy.arccos(numpy.clip(_determinants(shifted) / 2.0, -1.0, 1.0)) / 3.0
+    largest = trace + 2.0 * scale * numpy.cos(angle)
+    smallest = trace + 2.0 * scale * numpy.cos(angle + 2.0 * numpy.pi / 3.0)
+    return numpy.stack((smallest, 3.0 * trace - largest - smallest, largest), axis=-1)
+
+def pairwise_rmsd(models, weights=None, block=512):
+    """NxN matrix of the RMSD after superposition of every pair of N models
+
+    models is an NxMx3 stack. The covariances of a block of models
+    against all of them come from one matrix multiply, and the RMSD
+    from the singular values of each covariance (the square roots of
+    the eigenvalues of H^T H, with the sign of det(H) for the smallest)
+    so no rotation or SVD is ever needed. Memory is bounded by block x N x 3 x 3.
+    """
+    models = numpy.asarray(models, dtype=float)
+    count, atoms = models.shape[:2]
+    if weights is None:
+        weights = numpy.ones(atoms)
+    weights = numpy.asarray(weights, dtype=float)
+    centres, centred = _centred(models, weights)
+    spread = numpy.einsum('m,nmi,nmi->n', weights, centred, centred)
+    ###(3N x M) and (M x 3N) so every covariance is a 3x3 block of one product
+    left = (centred * weights[None, :, None]).transpose(0, 2, 1).reshape(3 * count, atoms)
+    right = centred.transpose(1, 0, 2).reshape(atoms, 3 * count)
+    rmsd = numpy.zeros((count, count))
+    for start in range(0, count, block):
+        stop = min(start + block, count)
+        covariance = numpy.dot(left[3 * start:3 * stop], right).reshape(stop - start, 3, count, 3).transpose(0, 2, 1, 3)
+        singular = numpy.sqrt(numpy.maximum(_symmetric_eigenvalues(numpy.matmul(covariance.swapaxes(-1, -2), covariance)), 0.0))
+        singular[..., 0] *= numpy.where(_determinants(covariance) < 0, -1.0, 1.0)
+        squared = spread[start:stop, None] + spread[None, :] - 2.0 * singular.sum(axis=-1)
+        rmsd[start:stop] = numpy.sqrt(numpy.maximum(squared, 0.0) / weights.sum())
+    numpy.fill_diagonal(rmsd, 0.0)
+    return rmsd
+
+def _stack(coords):
+    """Coordinates as an NxMx3 stack and whether a single Mx3 structure was given"""
+    coords = numpy.asarray(coords, dtype=float)
+    if coords.ndim == 2:
+        return coords[None], True
+    return coords, False
+
+def radius_of_gyration(coords, weights=None):
+    """Weighted Rg of an Mx3 structure, or an array of Rg for an NxMx3 trajectory"""
+    models, single = _stack(coords)
+    if weights is None:
+        weights = numpy.ones(models.shape[1])
+    weights = numpy.asarray(weights, dtype=float)
+    centres, centred = _centred(models, weights)
+    rg = numpy.sqrt(numpy.einsum('m,nmi,nmi->n', weights, centred, centred) / weights.sum())
+    return rg[0] if single else rg
+
+def maximum_dimension(coords):
+    """Largest distance between any two atoms of an Mx3 structure, or an array for an NxMx3 trajectory
+
+    The two atoms furthest apart are always vertices of the convex
+    hull, so only the distances between the few hundred hull vertices
+    are needed rather than all M^2/2 pairs. Flat or tiny structures
+    with no 3D hull fall back to every pair.
+    """
+    models, single = _stack(coords)
+    dmax = numpy.zeros(len(models))
+    for number, model in enumerate(models):
+        if len(model) < 2:
+            continue
+        try:
+            model = model[ConvexHull(model).vertices]
+        except Exception:
+            pass
+        dmax[number] = pdist(model).max()
+    return dmax[0] if single else dmax
+
+def inertia_tensor(coords, weights=None):
+    """Weighted 3x3 inertia tensor about the centre of mass, or Nx3x3 for a trajectory"""
+    models, single = _stack(coords)
+    if weights is None:
+        weights = numpy.ones(models.shape[1])
+    weights = numpy.asarray(weights, dtype=float)
+    centres, centred = _centred(models, weights)
+    second = numpy.einsum('m,nmi,nmj->nij', weights, centred, centred)
+    tensor = numpy.trace(second, axis1=1, axis2=2)[:, None, None] * numpy.identity(3) - second
+    return tensor[0] if single else tensor
+
+def principal_axes(coords, weights=None):
+    """Principal moments (smallest first) and the matching unit axes as columns, batched like inertia_tensor"""
+    return numpy.linalg.eigh(inertia_tensor(coords, weights))
+
+###point groups as accepted by DAMMIN, DAMMIF and GASBOR
+point_groups = ['P'+str(number) for number in range(1, 20)] + ['P'+str(number)+'2' for number in range(2, 13)] + ['P23', 'P432', 'PICO']
+
+def _axis_rotation(axis, degrees):
+    """3x3 matrix for a rotation of degrees around any axis"""
+    axis = numpy.asarray(axis, dtype=float)
+    x, y, z = axis / numpy.linalg.norm(axis)
+    theta = numpy.radians(degrees)
+    cross = numpy.array([[0.0, -z, y], [z, 0.0, -x], [-y, x, 0.0]])
+    return numpy.identity(3) + numpy.sin(theta) * cross + (1.0 - numpy.cos(theta)) * numpy.dot(cross, cross)
+
+def _close_group(generators):
+    """Every product of the generators, identity first"""
+    operators = [numpy.identity(3)]
+    keys = set([tuple(numpy.round(operators[0], 6).ravel())])
+    new = list(operators)
+    while len(new) > 0:
+        found = []
+        for operator in new:
+            for generator in generators:
+                product = numpy.dot(generator, operator)
+                key = tuple(numpy.round(product, 6).ravel() + 0.0)
+                if not key in keys:
+                    keys.add(key)
+                    found.append(product)
+        operators.extend(found)
+        new = found
+    return numpy.array(operators)
+
+_symmetry_operators = {}
+
+def symmetry_operators(group):
+    """Kx3x3 rotation matrices of a point group, identity first, computed once per process
+
+    Axes follow the ATSAS convention: the main n-fold axis of Pn and
+    Pn2 is Z with the 2-fold axes of Pn2 starting along X, P23 and
+    P432 have 2-fold and 4-fold axes along X, Y and Z and 3-fold axes
+    along the cube diagonals, and PICO has 2-fold axes along X, Y and
+    Z with 5-fold axes through (0, 1, golden ratio).
+    """
+    group = str(group).upper()
+    if not group in point_groups:
+        raise ValueError('Symmetry supported are: Point groups P1, ..., P19, Pn2 (n = 2, ..., 12), P23, P432 or PICO (icosahedral)')
+    if not group in _symmetry_operators:
+        if group == 'P23':
+            generators = [_axis_rotation((0, 0, 1), 180), _axis_rotation((1, 0, 0), 180), _axis_rotation((1, 1, 1), 120)]
+        elif group == 'P432':
+            generators = [_axis_rotation((0, 0, 1), 90), _axis_rotation((1, 1, 1), 120)]
+        elif group == 'PICO':
+            generators = [_axis_rotation((0, 0, 1), 180), _axis_rotation((1, 1, 1), 120), _axis_rotation((0, 1, (1 + 5**0.5) / 2), 72)]
+        elif group.endswith('2') and len(group) > 2 and group[1:-1] in [str(number) for number in range(2, 13)] and group != 'P12':
+            generators = [_axis_rotation((0, 0, 1), 360.0 / int(group[1:-1])), _axis_rotation((1, 0, 0), 180)]
+        else:
+            generators = [_axis_rotation((0, 0, 1), 360.0 / int(group[1:]))]
+        _symmetry_operators[group] = _close_group(generators)
+    return _symmetry_operators[group]
+
+def symmetry_mates(coords, group):
+    """KxMx3 copies of an Mx3 asymmetric unit, one per operator of the group, with one broadcast matrix multiply"""
+    return numpy.matmul(numpy.asarray(coords, dtype=float)[None], symmetry_operators(group).swapaxes(1, 2))
+
+def chain_names(count):
+    """count chain ids, A-Z, a-z and 0-9 then two letters (which only fit mmCIF, see write_cif)"""
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    names = list(letters)
+    for first in letters:
+        if len(names) >= count:
+            break
+        names.extend([first + second for second in letters])
+    return names[:count]
+
+######################################
+#PDB DEFINITION FROM wwPDB GUIDLINES #
+# VERSION 3.30 31/07/14              #
+######################################
+pdb_definition = {
+    'record_type': ( 0 , 6 ),
+    'serial_no': ( 6 , 11 ),
+    'atom_name': ( 12 , 16 ),
+    'alternate': ( 16 , 17 ),
+    'residue': ( 17 , 20 ),
+    'chain': ( 21 , 22 ),
+    'residue_no': ( 22 , 26 ),
+    'icode': ( 26 , 27 ),
+    'x': ( 30 , 38 ),
+    'y': ( 38 , 46 ),
+    'z': ( 46 , 54 ),
+    'occupancy': ( 54 , 60 ),
+    'bfactor': ( 60 , 66 ),
+    'element': ( 76 , 78 ),
+    'charge': ( 78 , 80 ),
+    'string': ( 6 , '' )}
+
+def _bulk_convert(field, dtype, default):
+    """Convert a fixed width bytes column to numbers in one go
+
+    Blank fields are given the default. Only if the column still
+    cannot be converted is it done value by value, again with the
+    default for anything unreadable.
+    """
+    try:
+        return field.astype(dtype)
+    except ValueError:
+        pass
+    blank = numpy.char.strip(field) == b''
+    try:
+        values = numpy.where(blank, b'0', field).astype(dtype)
+        values[blank] = default
+        return values
+    except ValueError:
+        values = numpy.full(len(field), default, dtype=dtype)
+        for i, value in enumerate(field.tolist()):
+            try:
+                values[i] = dtype(value)
+            except ValueError:
+                pass
+        return values
+
+def _line_bounds(buf):
+    newlines = numpy.flatnonzero(buf == 10)
+    starts = numpy.concatenate(([0], newlines + 1))
+    ends = numpy.concatenate((newlines, [len(buf)]))
+    if starts[-1] == len(buf):
+        starts = starts[:-1]
+        ends = ends[:-1]
+    ###do not count a windows carriage return as part of the line
+    carriage = (ends > starts) & (buf[numpy.maximum(ends - 1, 0)] == 13)
+    return starts, ends, ends - starts - carriage
+
+def _fixed_width(buf, starts, lengths, width):
+    """Gather lines into an N x width array of bytes padded with spaces"""
+    columns = numpy.arange(width)
+    block = buf[numpy.minimum(starts[:, None] + columns, len(buf) - 1)]
+    block[columns >= lengths[:, None]] = 32
+    return block
+
+def parse_pdb_buffer(data, definition=pdb_definition, chunk=65536):
+    """Parse the ATOM and HETATM records of a pdb file held in memory
+
+    data can be bytes or anything exposing the buffer interface, for
+    example an mmap of the file. Lines are located with a single scan
+    for newlines and every atom line is sliced into its fixed width
+    columns as a block, chunk lines at a time, so the cost is linear
+    in the size of the file. Returns an AtomTable and a dictionary of
+    the other records keyed by line number, as used by PdbDict.
+    """
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    atoms = AtomTable()
+    others = {}
+    if len(buf) == 0:
+        return atoms, others
+    starts, ends, lengths = _line_bounds(buf)
+    record_types = _fixed_width(buf, starts, lengths, 6).view('S6').ravel()
+    is_atom = (record_types == b'ATOM  ') | (record_types == b'HETATM')
+
+    for index in numpy.flatnonzero(~is_atom).tolist():
+        line = bytes(buf[starts[index]:min(ends[index] + 1, len(buf))]).decode('utf-8', 'replace').replace('\r\n', '\n')
+        others[index] = {}
+        others[index]['record_type'] = line[definition['record_type'][0]:definition['record_type'][1]].rstrip()
+        others[index]['string'] = line[definition['string'][0]:]
+
+    atom_lines = numpy.flatnonzero(is_atom)
+    dtypes = atoms.dtypes
+    defaults = dict((name, default) for name, dtype, default in atoms.fields)
+    atoms.reserve(len(atom_lines))
+    for first in range(0, len(atom_lines), chunk):
+        lines = atom_lines[first:first + chunk]
+        block = _fixed_width(buf, starts[lines], lengths[lines], 80)
+        columns = {'index': lines}
+        for record in AtomRecord.keys_order:
+            start, end = definition[record]
+            field = numpy.ascontiguousarray(block[:, start:end]).view('S'+str(end - start)).ravel()
+            if record in ['x', 'y', 'z', 'occupancy', 'bfactor']:
+                columns[record] = _bulk_convert(field, float, defaults.get(record, numpy.nan))
+            elif record in ['serial_no', 'residue_no']:
+                columns[record] = _bulk_convert(field, int, defaults[record])
+            else:
+                columns[record] = numpy.char.strip(field).astype(dtypes[record])
+        atoms.append(columns, len(lines))
+    return atoms, others
+
+def _iter_model_blocks(file, chunk_size=4194304):
+    """Yield the bytes of each MODEL/ENDMDL block of an open binary file
+
+    The file is read chunk_size bytes at a time and each block is
+    yielded as soon as its ENDMDL line has been read, so only one
+    chunk and one block are ever held in memory. Anything after the
+    last ENDMDL (or the whole file if it has no models) is yielded
+    as a final block if it contains any atoms.
+    """
+    buffer = b''
+    while True:
+        chunk = file.read(chunk_size)
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b'ENDMDL', start)
+            while end > 0 and buffer[end - 1:end] != b'\n':
+                end = buffer.find(b'ENDMDL', end + 1)
+            if end < 0:
+                break
+            end = buffer.find(b'\n', end)
+            if end < 0:
+                if chunk:
+                    break
+                end = len(buffer) - 1
+            yield buffer[start:end + 1]
+            start = end + 1
+        buffer = buffer[start:]
+        if not chunk:
+            break
+    if re.search(b'(^|\n)(ATOM  |HETATM)', buffer):
+        yield buffer
+
+def _block_coords(block, definition=pdb_definition):
+    """Return the Nx3 coordinates of the atom lines in a block of pdb text"""
+    buf = numpy.frombuffer(block, dtype=numpy.uint8)
+    starts, ends, lengths = _line_bounds(buf)
+    record_types = _fixed_width(buf, starts, lengths, 6).view('S6').ravel()
+    lines = numpy.flatnonzero((record_types == b'ATOM  ') | (record_types == b'HETATM'))
+    first, last = definition['x'][0], definition['z'][1]
+    block = _fixed_width(buf, starts[lines] + first, lengths[lines] - first, last - first)
+    coords = numpy.empty((len(lines), 3))
+    for axis, record in enumerate(['x', 'y', 'z']):
+        start, end = definition[record][0] - first, definition[record][1] - first
+        field = numpy.ascontiguousarray(block[:, start:end]).view('S'+str(end - start)).ravel()
+        coords[:, axis] = _bulk_convert(field, float, numpy.nan)
+    return coords
+
+def _format_atom_rows(atoms, rows):
+    """Format the given rows of an AtomTable as 80 column pdb lines
+
+    The rows are formatted column by column into one long template
+    that is filled with a single % operation. Names shorter than four
+    characters start in column 14 and floats that could not be read
+    are left blank, as the per-record writer used to do.
+    """
+    if len(rows) == 0:
+        return ''
+    names = atoms['atom_name'][rows]
+    names = numpy.where(numpy.char.str_len(names) < 4, numpy.char.add(' ', numpy.char.ljust(names, 3)), names)
+    columns = [atoms['record_type'][rows], atoms['serial_no'][rows], names, atoms['alternate'][rows],
+               atoms['residue'][rows], atoms['chain'][rows], atoms['residue_no'][rows], atoms['icode'][rows]]
+    formats = ['%-6s', '%5d', ' %4s', '%1s', '%3s', ' %1s', '%4d', '%1s', '   ']
+    for record, width, precision in [('x', 8, 3), ('y', 8, 3), ('z', 8, 3), ('occupancy', 6, 2), ('bfactor', 6, 2)]:
+        values = atoms[record][rows]
+        missing = numpy.isnan(values)
+        if missing.any():
+            strings = numpy.char.mod('%'+str(width)+'.'+str(precision)+'f', numpy.where(missing, 0.0, values))
+            columns.append(numpy.where(missing, '', strings))
+            formats.append('%'+str(width)+'s')
+        else:
+            columns.append(values)
+            formats.append('%'+str(width)+'.'+str(precision)+'f')
+    columns.extend([atoms['element'][rows], atoms['charge'][rows]])
+    formats.extend(['          %2s', '%2s\n'])
+    template = ''.join(formats) * len(rows)
+    return template % tuple(chain.from_iterable(zip(*[column.tolist() for column in columns])))
+
+def write_pdb(outfile, pdbdict, justatoms=False, chunk=65536):
+    """Write a PdbDict to an open text file in the same layout as before
+
+    Atoms are formatted chunk rows at a time and written straight to
+    the file, interleaved with the other records in hashdata key
+    order, so the whole file is never built in memory.
+    """
+    atoms = pdbdict.atoms
+    index = atoms['index']
+    rows = numpy.argsort(index, kind='stable')
+    others = []
+    if not justatoms:
+        others = sorted(pdbdict.others.keys())
+    positions = numpy.searchsorted(index[rows], others)
+    start = 0
+    for key, position in list(zip(others, positions.tolist())) + [(None, len(rows))]:
+        for first in range(start, position, chunk):
+            outfile.write(_format_atom_rows(atoms, rows[first:min(first + chunk, position)]))
+        start = position
+        if key != None:
+            record = pdbdict.others[key]
+            line = str(record.get('record_type', '')).ljust(6) + str(record.get('string', '')).rstrip('\r\n')
+            outfile.write(line.ljust(80) + '\n')
+
+class StructureCache(object):
+    """On-disk cache of parsed structures
+
+    Each parsed file is stored as a directory of .npy files, one per
+    AtomTable column, plus the other records as json, named after the
+    sha1 of the file contents. Columns are loaded memory mapped copy
+    on write, so a warm load only touches the pages that get used and
+    changes are never written back to the cache. The hash of a path
+    is remembered against its size and modification time so that an
+    unchanged file is not read at all.
+    """
+    version = 2
+
+    def __init__(self, directory, logger=None):
+        self.directory = os.path.abspath(directory)
+        self.logger = logger or logging.getLogger('readwrite.PDB')
+        os.makedirs(os.path.join(self.directory, 'paths'), exist_ok=True)
+
+    def _path_record(self, path):
+        name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'paths', name+'.json')
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        record_file = self._path_record(path)
+        try:
+            with open(record_file, 'r') as record:
+                record = json.load(record)
+            if record['mtime'] == stat.st_mtime_ns and record['size'] == stat.st_size:
+                return record['hash']
+        except (IOError, ValueError, KeyError):
+            pass
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1048576), b''):
+                digest.update(block)
+        record = {'path': os.path.abspath(path), 'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': digest.hexdigest()}
+        with open(record_file, 'w') as outfile:
+            json.dump(record, outfile)
+        return record['hash']
+
+    def _entry(self, path):
+        return os.path.join(self.directory, self.content_hash(path)+'-v'+str(self.version))
+
+    def load(self, path):
+        """Return (atoms, others) for a file from the cache, or None if it is not there"""
+        entry = self._entry(path)
+        if not os.path.isdir(entry):
+            return None
+        try:
+            data = {}
+            for name in [field[0] for field in AtomTable.fields] + ['coords']:
+                data[name] = numpy.load(os.path.join(entry, name+'.npy'), mmap_mode='c')
+            with open(os.path.join(entry, 'others.json'), 'r') as infile:
+                others = dict((index, {'record_type': record_type, 'string': string}) for index, record_type, string in json.load(infile))
+        except Exception as error:
+            self.logger.error('Could not load cached structure for '+str(path)+': '+str(error))
+            return None
+        return AtomTable.from_arrays(data), others
+
+    def store(self, path, atoms, others):
+        entry = self._entry(path)
+        if os.path.isdir(entry):
+            return
+        staging = tempfile.mkdtemp(dir=self.directory)
+        try:
+            for name in [field[0] for field in AtomTable.fields]:
+                numpy.save(os.path.join(staging, name+'.npy'), atoms[name])
+            numpy.save(os.path.join(staging, 'coords.npy'), atoms.coords)
+            with open(os.path.join(staging, 'others.json'), 'w') as outfile:
+                json.dump([(index, record.get('record_type', ''), record.get('string', '')) for index, record in sorted(others.items())], outfile)
+            os.rename(staging, entry)
+        except OSError as error:
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isdir(entry):
+                self.logger.error('Could not cache structure for '+str(path)+': '+str(error))
+
+###mmCIF _atom_site items for each AtomTable column, the first one present is used
+cif_definition = {
+    'record_type': ['group_PDB'],
+    'serial_no': ['id'],
+    'atom_name': ['auth_atom_id', 'label_atom_id'],
+    'alternate': ['label_alt_id'],
+    'residue': ['auth_comp_id', 'label_comp_id'],
+    'chain': ['auth_asym_id', 'label_asym_id'],
+    'residue_no': ['auth_seq_id', 'label_seq_id'],
+    'icode': ['pdbx_PDB_ins_code'],
+    'x': ['Cartn_x'],
+    'y': ['Cartn_y'],
+    'z': ['Cartn_z'],
+    'occupancy': ['occupancy'],
+    'bfactor': ['B_iso_or_equiv'],
+    'element': ['type_symbol'],
+    'charge': ['pdbx_formal_charge']}
+
+_cif_token = re.compile(b'''\'(.*?)\'(?=\\s|$)|"(.*?)"(?=\\s|$)|(\\S+)''', re.S)
+_cif_text_token = re.compile(b'''^;(.*?)\n;(?=\\s|$)|\'(.*?)\'(?=\\s|$)|"(.*?)"(?=\\s|$)|(\\S+)''', re.S | re.M)
+_cif_text_field = re.compile(b'^;.*?\n;', re.S | re.M)
+
+def _cif_tokens(text):
+    """Split a run of mmCIF loop rows into tokens, honouring quoted values and ; delimited text fields"""
+    if text[:1] == b';' or b'\n;' in text:
+        return [field or single or double or bare for field, single, double, bare in _cif_text_token.findall(text)]
+    if not b"'" in text and not b'"' in text:
+        return text.split()
+    return [single or double or bare for single, double, bare in _cif_token.findall(text)]
+
+def _cif_text_fields(data):
+    """Starts and ends of the ; delimited text fields of an mmCIF file, whose lines must not be read as items or loops"""
+    if data[:1] != b';' and data.find(b'\n;') < 0:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    spans = numpy.array([match.span() for match in _cif_text_field.finditer(data)], dtype=numpy.int64).reshape(-1, 2)
+    return spans[:, 0], spans[:, 1]
+
+def _cif_after_text(position, fields):
+    """position, or the end of the text field it falls inside"""
+    starts, ends = fields
+    field = numpy.searchsorted(starts, position, side='right') - 1
+    if field >= 0 and position < ends[field]:
+        return int(ends[field])
+    return position
+
+def parse_cif_buffer(data, chunk=65536):
+    """Parse the _atom_site loop of an mmCIF file held in memory
+
+    The column names are read from the loop header and the rows are
+    tokenised chunk rows at a time and converted column by column, as
+    for parse_pdb_buffer, so memory use is bounded by the chunk size
+    rather than the number of atoms. Only the first model is read.
+    Returns an AtomTable and an empty dictionary of other records;
+    the 'index' column is the position of each atom in the loop.
+    """
+    atoms = AtomTable()
+    ###loops and items quoted inside ; text fields are not real ones
+    fields = _cif_text_fields(data)
+    header = None
+    for match in re.finditer(b'(^|\n)loop_[ \t]*\r?\n((?:[ \t]*_atom_site\.\S+[^\n]*\n)+)', data):
+        if _cif_after_text(match.start(2), fields) == match.start(2):
+            header = match
+            break
+    if header == None:
+        return atoms, {}
+    names = [line.strip().split()[0][len(b'_atom_site.'):].decode() for line in header.group(2).splitlines() if line.strip()]
+    columns = dict((name, i) for i, name in enumerate(names))
+    start = header.end()
+    marker = re.compile(b'^(#|loop_|_|data_)', re.M)
+    end = marker.search(data, start)
+    while end != None and _cif_after_text(end.start(), fields) != end.start():
+        end = marker.search(data, _cif_after_text(end.start(), fields))
+    end = len(data) if end == None else end.start()
+
+    first_model = None
+    row = 0
+    dtypes = atoms.dtypes
+    defaults = dict((name, default) for name, dtype, default in atoms.fields)
+    ###values of a row that runs on past the end of a chunk, such as one broken by a text field
+    leftover = []
+    while start < end:
+        stop = start
+        for line in range(chunk):
+            stop = data.find(b'\n', stop, end) + 1
+            if stop == 0:
+                stop = end
+                break
+        ###never split a text field between chunks
+        if len(fields[0]) > 0 and stop < end and _cif_after_text(stop - 1, fields) != stop - 1:
+            stop = data.find(b'\n', _cif_after_text(stop - 1, fields), end) + 1 or end
+        tokens = leftover + _cif_tokens(data[start:stop])
+        start = stop
+        complete = len(tokens) - len(tokens) % len(names)
+        tokens, leftover = tokens[:complete], tokens[complete:]
+        if len(tokens) == 0:
+            continue
+        table = numpy.array(tokens, dtype=bytes).reshape(-1, len(names))
+        ###'?' and '.' mark unknown and not applicable values
+        table[(table == b'?') | (table == b'.')] = b''
+        if 'pdbx_PDB_model_num' in columns:
+            models = table[:, columns['pdbx_PDB_model_num']]
+            if first_model == None:
+                first_model = models[0]
+            table = table[models == first_model]
+        block = {'index': numpy.arange(row, row + len(table))}
+        row += len(table)
+        for record, items in cif_definition.items():
+            found = [item for item in items if item in columns]
+            if len(found) == 0:
+                continue
+            field = table[:, columns[found[0]]]
+            if record in ['x', 'y', 'z', 'occupancy', 'bfactor']:
+                block[record] = _bulk_convert(field, float, defaults.get(record, numpy.nan))
+            elif record in ['serial_no', 'residue_no']:
+                block[record] = _bulk_convert(field, int, defaults[record])
+            elif record == 'charge':
+                ###formal charges are signed integers in mmCIF and digit then sign in pdb files
+                charge = _bulk_convert(field, int, 0)
+                block[record] = numpy.where(charge == 0, '', numpy.char.add(numpy.abs(charge).astype('U1'), numpy.where(charge < 0, '-', '+')))
+            else:
+                block[record] = field.astype(dtypes[record])
+        atoms.append(block, len(table))
+    if len(leftover) > 0:
+        raise ValueError('mmCIF _atom_site rows do not have '+str(len(names))+' values each')
+    return atoms, {}
+
+def _cif_strings(values, empty='?'):
+    """mmCIF tokens for an array of strings, quoted where a bare value would be misread and empty given as '?' or '.'"""
+    values = numpy.asarray(values, dtype=str)
+    if len(values) == 0:
+        return values
+    first = numpy.char.ljust(values, 1).astype('U1')
+    special = numpy.isin(first, ['_', '#', '$', "'", '"', '[', ']', ';']) | (numpy.char.find(values, ' ') >= 0)
+    single = numpy.char.find(values, "'") >= 0
+    quoted = numpy.where(single, numpy.char.add(numpy.char.add('"', values), '"'), numpy.char.add(numpy.char.add("'", values), "'"))
+    values = numpy.where(special | single, quoted, values)
+    return numpy.where(numpy.char.str_len(values) == 0, empty, values)
+
+def write_cif(outfile, atoms, name='structure', chunk=65536):
+    """Write the atoms of an AtomTable to an open text file as the _atom_site loop of an mmCIF file
+
+    Unlike the pdb format this has no limit on the number of atoms or
+    the length of chain ids, so it is the way to write large assemblies.
+    The file is read back by parse_cif_buffer with the same columns.
+    """
+    items = ['group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_alt_id', 'label_comp_id', 'label_asym_id', 'label_seq_id',
+             'pdbx_PDB_ins_code', 'Cartn_x', 'Cartn_y', 'Cartn_z', 'occupancy', 'B_iso_or_equiv', 'pdbx_formal_charge',
+             'auth_seq_id', 'auth_asym_id', 'pdbx_PDB_model_num']
+    outfile.write('data_'+re.sub(r'\s', '_', str(name))+'\n#\nloop_\n'+''.join(['_atom_site.'+item+'\n' for item in items]))
+    rows = numpy.flatnonzero(atoms.atom_mask())
+    for first in range(0, len(rows), chunk):
+        block = rows[first:first + chunk]
+        charge = atoms['charge'][block]
+        ###pdb charges are digit then sign, mmCIF wants a signed integer
+        digits = numpy.char.strip(charge, '+-')
+        charge = numpy.where(numpy.char.str_len(digits) == 0, '?', numpy.char.add(numpy.where(numpy.char.find(charge, '-') >= 0, '-', ''), digits))
+        columns = [atoms['record_type'][block], atoms['serial_no'][block], _cif_strings(atoms['element'][block]),
+                   _cif_strings(atoms['atom_name'][block]), _cif_strings(atoms['alternate'][block], '.'),
+                   _cif_strings(atoms['residue'][block]), _cif_strings(atoms['chain'][block]), atoms['residue_no'][block],
+                   _cif_strings(atoms['icode'][block])]
+        for record, precision in [('x', 3), ('y', 3), ('z', 3), ('occupancy', 2), ('bfactor', 2)]:
+            values = atoms[record][block]
+            columns.append(numpy.where(numpy.isnan(values), '?', numpy.char.mod('%.'+str(precision)+'f', numpy.nan_to_num(values))))
+        columns.extend([charge, atoms['residue_no'][block], _cif_strings(atoms['chain'][block]), numpy.ones(len(block), dtype=int)])
+        template = ' '.join(['%s'] * len(columns)) + '\n'
+        outfile.write((template * len(block)) % tuple(chain.from_iterable(zip(*[column.tolist() for column in columns]))))
+    outfile.write('#\n')
+
+def read_cif_file(ciffile):
+    """Memory map an mmCIF file and parse it with parse_cif_buffer"""
+    with open(ciffile, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return parse_cif_buffer(b'')
+        return parse_cif_buffer(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+def read_pdb_file(pdbfile, definition=pdb_definition):
+    """Memory map a pdb file and parse it with parse_pdb_buffer"""
+    with open(pdbfile, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return parse_pdb_buffer(b'', definition)
+        ###the map is released when the last array viewing it is freed
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return parse_pdb_buffer(buffer, definition)
+
+
 class PDB(Interface):
     """Read and write pdb files
     
     The pdb class contains functions for reading pdb files to
     a dictionary object where various calculations can be
     performed on it and then writing it back out again.
+
+    The atoms are held column by column in an AtomTable (self.atoms),
+    self.hashdata is a dictionary compatible view onto the same data.
+    Parsed files can be kept in a StructureCache by giving a cache
+    directory or setting the SAXS_PDB_CACHE environment variable.
+    mmCIF (.cif) files are read into the same structure, which is the
+    only way to use assemblies too big for the pdb format.
     """
-    def __init__(self, pdbfile=None):
+    def __init__(self, pdbfile=None, cache=None):
         ###start a log file
         self.logger = logging.getLogger('readwrite.PDB')
-        self.logger.setLevel(logging.DEBUG)
+        ###keep a level the calling script has already set
+        if self.logger.level == logging.NOTSET:
+            self.logger.setLevel(logging.DEBUG)
         formatter = logging.Formatter('%(asctime)s: %(levelname)s: %(name)s: %(message)s',"[%Y-%m-%d %H:%M:%S]")
         streamhandler = logging.StreamHandler()
         streamhandler.setFormatter(formatter)
@@ -64,23 +1794,7 @@ class PDB(Interface):
             'SER': ('Serine','S', 87.08),
             'THR': ('Threonine','T', 101.11)
         }
-        self.pdb_definition = {
-            'record_type': ( 0 , 6 ),
-            'serial_no': ( 6 , 11 ),
-            'atom_name': ( 12 , 16 ),
-            'alternate': ( 16 , 17 ),
-            'residue': ( 17 , 20 ),
-            'chain': ( 21 , 22 ),
-            'residue_no': ( 22 , 26 ),
-            'icode': ( 26 , 27 ),
-            'x': ( 30 , 38 ),
-            'y': ( 38 , 46 ),
-            'z': ( 46 , 54 ),
-            'occupancy': ( 54 , 60 ),
-            'bfactor': ( 60 , 66 ),
-            'element': ( 76 , 78 ),
-            'charge': ( 78 , 80 ),
-            'string': ( 6 , '' )}
+        self.pdb_definition = dict(pdb_definition)
         
         self.new_atom_values = {
             'record_type': 'ATOM',
@@ -103,24 +1817,80 @@ class PDB(Interface):
 
         self.hashdata = {}
 
+        if cache == None:
+            cache = os.environ.get('SAXS_PDB_CACHE')
+        self.cache = None
+        if cache:
+            self.cache = StructureCache(cache, self.logger)
+
         ###Check file exists and is of right type
         if pdbfile == None:
             self.pdbfile = None
             self.logger.info('Will create an empty pdb dictionary')
 
-        elif os.path.isfile(pdbfile) and pdbfile[-4:] == '.pdb':
+        elif os.path.isfile(pdbfile) and pdbfile[-4:] in ['.pdb', '.cif']:
             self.pdbfile = pdbfile
         else:
-            sys.exit(str(pdbfile)+' either does not exist or is not of type ".pdb"')
+            sys.exit(str(pdbfile)+' either does not exist or is not of type ".pdb" or ".cif"')
             
+    def iter_models(self, chunk_size=4194304):
+        """Stream the models of a multi-model pdb file one at a time
+
+        Yields (model_number, coords) for every MODEL/ENDMDL block,
+        with model numbers counted from 1 and coords an Nx3 array.
+        The first model is parsed in full and becomes the topology
+        of this object (hashdata/atoms), later models only have their
+        coordinates read. Memory use does not grow with the number
+        of models as only one block is held at a time.
+        """
+        self.logger.info('Streaming models from pdb file: '+str(self.pdbfile))
+        model_number = 0
+        with open(self.pdbfile, 'rb') as file:
+            for block in _iter_model_blocks(file, chunk_size):
+                model_number += 1
+                if model_number == 1:
+                    atoms, others = parse_pdb_buffer(block, self.pdb_definition)
+                    self.hashdata = PdbDict(atoms, others)
+                    coords = atoms.coords.copy()
+                else:
+                    coords = _block_coords(block, self.pdb_definition)
+                if len(coords) != len(self.atoms):
+                    self.logger.error('Model '+str(model_number)+' has '+str(len(coords))+' atoms, expected '+str(len(self.atoms))+', skipping it')
+                    continue
+                yield model_number, coords
+        self.logger.info('Streamed '+str(model_number)+' models')
+
+    def setCoordinates(self, coords):
+        try:
+            coords = numpy.asarray(coords, dtype=float).reshape(len(self.atoms), 3)
+        except:
+            self.logger.error('Coordinates must be an Nx3 array for the '+str(len(self.atoms))+' atoms in the structure')
+            return False
+        self.atoms['coords'] = coords
+        return True
+
     def input_dict(self, input_dict):
         self.logger.info('Reading in PDB data as a dictionary')
-        if type(input_dict) == type({}):
+        if isinstance(input_dict, (dict, PdbDict)):
             self.hashdata = input_dict
 
     def return_dict(self):
         self.logger.info('Returning PDB data as a dictionary')
         return self.hashdata
+
+    @property
+    def hashdata(self):
+        return self._hashdata
+
+    @hashdata.setter
+    def hashdata(self, value):
+        if not isinstance(value, PdbDict):
+            value = PdbDict.from_dict(value)
+        self._hashdata = value
+
+    @property
+    def atoms(self):
+        return self._hashdata.atoms
     
     def addNewAtom(self, coordinates=None, bfactor=None):
         if type(coordinates) in [type(()),type([])]:
@@ -130,11 +1900,45 @@ class PDB(Interface):
                 self.setNewAtomProperty('z', coordinates[2])
         if bfactor:
             self.setNewAtomProperty('bfactor', bfactor)
-        if len(self.hashdata.keys()) == 0:
-               index = 1
-        else:
-               index = sorted(self.hashdata.keys())[-1]+1
-        self.hashdata[index] = deepcopy(self.new_atom_values)
+        self.hashdata.extend(dict((name, [value]) for name, value in self.new_atom_values.items()), 1)
+
+    def addNewAtoms(self, coordinates, bfactor=None, element=None, chain=None, **columns):
+        """Append many atoms in one operation
+
+        coordinates is an Nx3 array. bfactor, element, chain and any
+        other column of an atom record (residue_no, atom_name, ...)
+        given as keyword arguments may be a single value or one per
+        atom, anything not given is taken from the new atom template
+        (see setNewAtomProperty). Serial numbers carry on from the
+        highest in the structure unless given. Returns the slice of
+        the new rows of the AtomTable, or None if the input is wrong.
+        """
+        try:
+            coordinates = numpy.asarray(coordinates, dtype=float).reshape(-1, 3)
+        except:
+            self.logger.error('Coordinates of new atoms must be an Nx3 array of floats')
+            return None
+        count = len(coordinates)
+        for name, value in [('bfactor', bfactor), ('element', element), ('chain', chain)]:
+            if value is not None:
+                columns[name] = value
+        for name in columns:
+            if not name in AtomRecord.keys_order or name in self.atoms.axes:
+                self.logger.error('New atoms have no property: '+str(name))
+                return None
+        values = dict((name, value) for name, value in self.new_atom_values.items() if not name in self.atoms.axes)
+        values['serial_no'] = numpy.arange(1, count + 1) + int(self.atoms['serial_no'].max(initial=0))
+        values.update(columns)
+        values['coords'] = coordinates
+        try:
+            for name, value in values.items():
+                values[name] = numpy.broadcast_to(value, (count, 3) if name == 'coords' else (count,))
+        except ValueError:
+            self.logger.error('Properties of new atoms must be a single value or one value per atom')
+            return None
+        new = self.hashdata.extend(values, count)
+        self.logger.info('Added '+str(count)+' new atoms')
+        return new
         
     def setNewAtomProperty(self, property=None, value=None):
         if property in self.new_atom_values.keys():
@@ -145,49 +1949,136 @@ class PDB(Interface):
                     self.new_atom_values[property] = float(value)
                 else:
                     self.new_atom_values[property] = str(value)
-                self.logger.info('Set: '+str(property)+' to: '+str(value))
+                self.logger.debug('Set: '+str(property)+' to: '+str(value))
             except:
                 self.logger.error('Could not set: '+str(property)+' to: '+str(value))
         else:
             self.logger.error('New atoms have no property: '+str(property))
             
+    def atomIndex(self):
+        return self.atoms.atom_index()
+
+    def spatialIndex(self):
+        return self.atoms.spatial_index()
+
+    def select(self, selection):
+        """Boolean mask of the atoms matched by a selection string such as 'chain A+B and name CA and resid 10-250'"""
+        try:
+            return self.atoms.select(selection)
+        except ValueError as error:
+            self.logger.error(str(error))
+            return None
+
+    def _fit_rows(self, selection):
+        """Rows used for superposition, every atom when selection is None"""
+        if selection == None:
+            return numpy.flatnonzero(self.atoms.atom_mask())
+        mask = self.select(selection)
+        if mask is None:
+            return None
+        return numpy.flatnonzero(mask)
+
+    def Superpose(self, reference, selection=None, mass_weighted=False):
+        """Move this structure onto a reference PDB or Mx3 array of coordinates, returns the RMSD
+
+        With selection (i.e. 'name CA') only the selected atoms are fitted,
+        they are selected from the reference too if it is a PDB.
+        """
+        rows = self._fit_rows(selection)
+        if rows is None:
+            return None
+        if isinstance(reference, PDB):
+            reference_rows = reference._fit_rows(selection)
+            if reference_rows is None:
+                return None
+            reference = reference.atoms.coords[reference_rows]
+        reference = numpy.asarray(reference, dtype=float)
+        if reference.shape != (len(rows), 3):
+            self.logger.error('Cannot superpose '+str(len(rows))+' atoms onto '+str(len(reference))+' reference atoms')
+            return None
+        weights = None
+        if mass_weighted:
+            weights = element_table().mass[self.atoms.element_codes()[rows]]
+        rotations, translations, rmsd = kabsch(reference, self.atoms.coords[rows], weights)
+        self.atoms.transform(affine_matrix(rotation=rotations[0], translation=translations[0]))
+        self.logger.info('Superposed '+str(len(rows))+' atoms with an RMSD of {0:.3f} Angstroms'.format(rmsd[0]))
+        return float(rmsd[0])
+
+    def modelRMSD(self, models, selection=None):
+        """Rotations, translations and RMSDs fitting each of a stack of models (NxAtomsx3, i.e. from iter_models) onto this structure"""
+        rows = self._fit_rows(selection)
+        if rows is None:
+            return None
+        models = numpy.asarray(models, dtype=float)
+        return kabsch(self.atoms.coords[rows], models[:, rows])
+
+    def pairwiseRMSD(self, models, selection=None):
+        """NxN RMSD matrix between a stack of models of this structure after superposition"""
+        rows = self._fit_rows(selection)
+        if rows is None:
+            return None
+        return pairwise_rmsd(numpy.asarray(models, dtype=float)[:, rows])
+
+    def Contacts(self, radius=4.0):
+        """Pairs of rows of atoms in different chains within radius Angstroms"""
+        contacts = self.atoms.spatial_index().contacts(radius)
+        self.logger.info('Found '+str(len(contacts))+' inter-chain contacts within '+str(radius)+' Angstroms')
+        return contacts
+
+    def Clashes(self, cutoff=2.0, other=None):
+        """Pairs of rows of non-bonded atoms closer than cutoff, or of atoms closer than cutoff to another PDB"""
+        if isinstance(other, PDB):
+            other = other.spatialIndex()
+        clashes = self.atoms.spatial_index().clashes(cutoff, other)
+        if len(clashes) > 0:
+            self.logger.warning('Found '+str(len(clashes))+' clashes closer than '+str(cutoff)+' Angstroms')
+        return clashes
+
     def CACObyNumber(self, residue_number=None):
         return_value = {}
-        for index in self.hashdata.keys():
-            if self.hashdata[index]['record_type'] == 'ATOM':
-                if self.hashdata[index]['residue_no'] == residue_number and self.hashdata[index]['atom_name'] in ['CA','C','O']:
-                    return_value[self.hashdata[index]['atom_name']] = (self.hashdata[index]['x'],self.hashdata[index]['y'],self.hashdata[index]['z'])
+        atoms = self.atoms
+        index = atoms.atom_index()
+        for chain, residue_no, icode in index.residues_numbered(residue_number):
+            for atom_name in ['CA','C','O']:
+                row = index.atom(chain, residue_no, atom_name, icode)
+                if row != None and atoms['record_type'][row] == 'ATOM':
+                    return_value[atom_name] = tuple(atoms.coords[row].tolist())
         if len(return_value.keys()) == 3:
             return return_value
         else:
             return False
         
-    def ReturnSeq(self, code=1):
-        seq = []
-
-        for index in self.hashdata.keys():
-            if self.hashdata[index]['record_type'] == 'ATOM' and self.hashdata[index]['atom_name'] == 'CA':
-                if self.hashdata[index]['residue'] in self.converter.keys():
-                    if code == 1:
-                        seq.append(self.converter[self.hashdata[index]['residue']][1])
-                    else:
-                        seq.append(self.hashdata[index]['residue'])
-                else:
-                    if code == 1:
-                        seq.append('X')
-                    else:
-                        seq.append('XXX')
-        if 'X' in seq:
+    def _chain_sequences(self):
+        """Three letter residue names of the CA atoms of every chain, in file order"""
+        atoms = self.atoms
+        rows = atoms.atom_index().residue_atoms(['CA'])
+        rows = rows[atoms['record_type'][rows] == 'ATOM']
+        sequences = {}
+        for chain, residue in zip(atoms['chain'][rows].tolist(), atoms['residue'][rows].tolist()):
+            if not residue in self.converter.keys():
+                residue = 'XXX'
+            sequences.setdefault(chain, []).append(residue)
+        if any(['XXX' in seq for seq in sequences.values()]):
             self.logger.info('There are unknown residue types in the structure')
-        return seq
+        return sequences
+
+    def ReturnChainSeq(self, code=1):
+        """Dictionary of chain name to its sequence as a list of one or three letter codes"""
+        sequences = self.atoms.memo('sequences', ('topology',), self._chain_sequences)
+        if code == 1:
+            return dict((chain, ['X' if residue == 'XXX' else self.converter[residue][1] for residue in seq]) for chain, seq in sequences.items())
+        return dict((chain, list(seq)) for chain, seq in sequences.items())
+
+    def ReturnSeq(self, code=1):
+        return [residue for seq in self.ReturnChainSeq(code).values() for residue in seq]
 
     def ReturnPdbFileName(self):
-        if self.pdbfile[-4:] == '.pdb':
+        if self.pdbfile[-4:] in ['.pdb', '.cif']:
             return self.pdbfile[:-4]
         else:
             return 'None'
         
-    def ReturnMolecularWeight(self, unit='Kd'):
+    def _molecular_weight(self):
         self.logger.info('Calculating molecular weight')
         mw = 0
         for aa in self.ReturnSeq(3):
@@ -195,6 +2086,10 @@ class PDB(Interface):
                 mw += self.converter[aa][2]
             else:
                 mw += 110
+        return mw
+
+    def ReturnMolecularWeight(self, unit='Kd'):
+        mw = self.atoms.memo('molecular_weight', ('topology',), self._molecular_weight)
         if unit == 'Kd':
             return round(mw / 1000, 1)
         elif unit == 'Da':
@@ -203,10 +2098,13 @@ class PDB(Interface):
             self.logger.error("ReturnMolecularWeight accepts units 'Kd' or 'Da'")
             return 0
         
-    def ReturnExtinctionCoefficient(self, unit='absorbance'):
+    def _extinction_coefficient(self):
         self.logger.info('Calculating extinction coefficient')
         myseq = self.ReturnSeq(1)
-        ec = myseq.count('W') * 5500.0 + myseq.count('Y') * 1490.0 + myseq.count('C') * 125.0
+        return myseq.count('W') * 5500.0 + myseq.count('Y') * 1490.0 + myseq.count('C') * 125.0
+
+    def ReturnExtinctionCoefficient(self, unit='absorbance'):
+        ec = self.atoms.memo('extinction_coefficient', ('topology',), self._extinction_coefficient)
         if unit == 'absorbance':
             return ec / self.ReturnMolecularWeight('Da')
         elif unit == 'extinction':
@@ -218,9 +2116,7 @@ class PDB(Interface):
 
     def Invert(self):
         self.logger.info('Inverting the structure')
-        for index in self.hashdata.keys():
-            if self.hashdata[index]['record_type'] == 'ATOM' or self.hashdata[index]['record_type'] == 'HETATM':
-                self.hashdata[index]['z'] = self.hashdata[index]['z'] * -1
+        self.atoms.transform(numpy.diag([1.0, 1.0, -1.0, 1.0]))
         
     def Rotate(self, option, origin=None):
         mytype = None
@@ -235,7 +2131,7 @@ class PDB(Interface):
             except:
                 self.logger.error("Rotation axis and angle must be in form 'x10' or 'Z2.5'")
                 sys.exit()
-        elif type(option) == type([]):
+        elif type(option) in [type([]), numpy.ndarray]:
             try:
                 for i1 in range(0,3):
                     for i2 in range(0,3):
@@ -249,60 +2145,48 @@ class PDB(Interface):
             self.logger.error("Rotation axis and angle must be in form 'x10' or 'Z2.5'")
             sys.exit()
 
-        def rotation_matrix(axis,theta):
-            theta = numpy.radians(theta)
-            if axis == 'X':
-                return numpy.array([[1,0,0],[0,numpy.cos(theta),-numpy.sin(theta)],[0,numpy.sin(theta),numpy.cos(theta)]])
-            elif axis == 'Y':
-                return numpy.array([[numpy.cos(theta),0,numpy.sin(theta)],[0,1,0],[-numpy.sin(theta),0,numpy.cos(theta)]])
-            elif axis == 'Z':
-                return numpy.array([[numpy.cos(theta),-numpy.sin(theta),0],[numpy.sin(theta),numpy.cos(theta),0],[0,0,1]])
-            else:
-                sys.exit('error matrix function, required axis is neither x,y or z!')
-        
         if mytype == 'string':
             self.logger.info('Rotating around '+str(axis)+' by '+str(theta)+' degrees')
         if mytype == 'matrix':
             self.logger.info('Rotating by a user input matrix')
+        translation = numpy.zeros(3)
         if origin:
             try:
-                translation = [
-                    -1 * float(origin[0]),
-                    -1 * float(origin[1]),
-                    -1 * float(origin[2])
-                    ]
-                self.Translate(translation)
+                translation = numpy.array([float(origin[0]), float(origin[1]), float(origin[2])])
                 self.logger.info('Rotating around origin: '+','.join([str(x) for x in origin]))
             except:
-                origin=False
+                translation = numpy.zeros(3)
                 self.logger.error('Translate origin arg should be x,y,z coords as a tuple or list')
         else:
             self.logger.info('Rotating around origin: 0,0,0')
-                                 
-            
-        for index in self.hashdata.keys():
-            if self.hashdata[index]['record_type'] == 'ATOM' or self.hashdata[index]['record_type'] == 'HETATM':
-                v = numpy.array([self.hashdata[index]['x'],self.hashdata[index]['y'],self.hashdata[index]['z']])
-                if mytype == 'string':
-                    newcoords = (numpy.dot(rotation_matrix(axis, theta),v))
-                else:
-                    newcoords = (numpy.dot(option,v))
-                self.hashdata[index]['x'] = float(newcoords[0])
-                self.hashdata[index]['y'] = float(newcoords[1])
-                self.hashdata[index]['z'] = float(newcoords[2])
-        if origin:
-            self.Translate([-1*x for x in translation])
+
+        if mytype == 'string':
+            matrix = rotation_matrix(axis, theta)
+        else:
+            matrix = option
+        self.atoms.transform(affine_matrix(rotation=matrix, origin=translation))
+
+    def Transform(self, matrix):
+        """Apply a 4x4 affine matrix (or 3x4 rotation and translation) to all atoms"""
+        try:
+            matrix = numpy.array(matrix, dtype=float)
+            if matrix.shape == (3, 4):
+                matrix = numpy.vstack((matrix, [0.0, 0.0, 0.0, 1.0]))
+            if matrix.shape != (4, 4):
+                raise IOError('wrong shape for Transform matrix')
+        except:
+            self.logger.error('Transform matrix must be a 4x4 or 3x4 nested array of floats')
+            return False
+        self.atoms.transform(matrix)
+        return True
             
     def RenameChain(self, old, new):
         if not len(str(new)) == 1:
             self.logger.error('Chain names should be a single character')
         else:
-            number_renamed = 0
-            for index in self.hashdata.keys():
-                if self.hashdata[index]['record_type'] == 'ATOM' or self.hashdata[index]['record_type'] == 'HETATM':
-                    if self.hashdata[index]['chain'] == str(old):
-                        self.hashdata[index]['chain'] = str(new)
-                        number_renamed += 1
+            mask = self.atoms.select('atom or hetatm') & (self.atoms['chain'] == str(old))
+            self.atoms.assign('chain', str(new), mask)
+            number_renamed = int(mask.sum())
             self.logger.info('Renamed chain on '+str(number_renamed)+' residues')
                     
     def Translate(self, option):
@@ -320,11 +2204,7 @@ class PDB(Interface):
             return False
 
         self.logger.info('Translating by '+str(translation[0])+'x'+str(translation[1])+'x'+str(translation[2]))
-        for index in self.hashdata.keys():
-            if self.hashdata[index]['record_type'] == 'ATOM' or self.hashdata[index]['record_type'] == 'HETATM':
-                self.hashdata[index]['x'] = self.hashdata[index]['x'] + translation[0]
-                self.hashdata[index]['y'] = self.hashdata[index]['y'] + translation[1]
-                self.hashdata[index]['z'] = self.hashdata[index]['z'] + translation[2]
+        self.atoms.transform(affine_matrix(translation=translation))
                 
     def setCentre(self, centre=(0,0,0)):
         try:
@@ -335,120 +2215,715 @@ class PDB(Interface):
     def returnCentre(self):
         return self.centre
     
-    def centreOfMass(self):
-        total_mass = 0
-        total_x = 0
-        total_y = 0
-        total_z = 0
-        for index in self.hashdata.keys():
-            if self.hashdata[index]['record_type'] == 'ATOM' or self.hashdata[index]['record_type'] == 'HETATM':
-                if self.hashdata[index]['element'] != '':
-                    atom_name = self.hashdata[index]['element']
-                else:
-                    atom_name = self.hashdata[index]['atom_name'][0]
-                try:
-                    mass = periodictable.elements.symbol(atom_name).mass
-                    total_mass += mass
-                    total_x += (mass * self.hashdata[index]['x'])
-                    total_y += (mass * self.hashdata[index]['y'])
-                    total_z += (mass * self.hashdata[index]['z'])
+    def atomWeights(self, property='mass'):
+        """Per-atom mass, electrons or volume for the ATOM and HETATM records"""
+        return atom_weights(self.atoms, property, self.logger)
 
-                except:
-                    self.logger.error('Failed to find mass for element '+str(atom_name))
+    def totalMass(self):
+        weights, mask = self.atomWeights('mass')
+        return weights.sum()
+
+    def totalElectrons(self):
+        weights, mask = self.atomWeights('electrons')
+        return weights.sum()
+
+    def totalVolume(self):
+        weights, mask = self.atomWeights('volume')
+        return weights.sum()
+
+    def _centre_of_mass(self):
+        mass, mask = self.atomWeights('mass')
+        total_mass = mass.sum()
 
         self.logger.info('Total mass is {:.2f} KDa'.format(total_mass / 1000))
-        average_x = total_x / total_mass
-        average_y = total_y / total_mass
-        average_z = total_z / total_mass
+        return tuple((numpy.dot(mass, self.atoms.coords[mask]) / total_mass).tolist())
+
+    def centreOfMass(self):
+        average_x, average_y, average_z = self.atoms.memo('centre_of_mass', ('topology', 'geometry'), self._centre_of_mass)
         self.logger.info('Centre of mass is currently: {0:.3f},{1:.3f},{2:.3f}'.format(average_x,average_y,average_z))
         return (average_x,average_y,average_z)
+
+    def radiusOfGyration(self, weighting='mass'):
+        """Radius of gyration in Angstroms weighted by atom 'mass' or 'electrons' (for comparison with SAXS)"""
+        if not weighting in ['mass', 'electrons']:
+            self.logger.error("radiusOfGyration accepts weightings 'mass' or 'electrons'")
+            return 0
+        def compute():
+            weights, mask = self.atomWeights(weighting)
+            return float(radius_of_gyration(self.atoms.coords[mask], weights))
+        return self.atoms.memo('radius_of_gyration_'+weighting, ('topology', 'geometry'), compute)
+
+    def maximumDimension(self):
+        """Dmax in Angstroms, the largest distance between two atoms"""
+        return self.atoms.memo('maximum_dimension', ('topology', 'geometry'),
+                               lambda: float(maximum_dimension(self.atoms.coords[self.atoms.atom_mask()])))
+
+    def inertiaTensor(self):
+        """Mass weighted inertia tensor about the centre of mass"""
+        def compute():
+            mass, mask = self.atomWeights('mass')
+            return inertia_tensor(self.atoms.coords[mask], mass)
+        return self.atoms.memo('inertia_tensor', ('topology', 'geometry'), compute).copy()
+
+    def principalAxes(self):
+        """Principal moments of inertia (smallest first) and the unit axes as the columns of a 3x3 array"""
+        moments, axes = numpy.linalg.eigh(self.inertiaTensor())
+        return moments, axes
+
+    def residueGroups(self):
+        """Rows of the ATOM and HETATM records and the residue number (0, 1, ... in file order) of each
+
+        Residues are told apart by chain, residue number and insertion
+        code. Kept until the topology changes.
+        """
+        def compute():
+            atoms = self.atoms
+            rows = numpy.flatnonzero(atoms.atom_mask())
+            keys = numpy.rec.fromarrays([atoms['chain'][rows], atoms['residue_no'][rows], atoms['icode'][rows]])
+            unique, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+            rank = numpy.empty(len(first), dtype=numpy.int64)
+            rank[numpy.argsort(first)] = numpy.arange(len(first))
+            return rows, rank[inverse.reshape(-1)]
+        return self.atoms.memo('residue_groups', ('topology',), compute)
+
+    def coarseGrain(self):
+        """One bead per residue at the centroid of its atoms
+
+        Returns a dictionary of per-bead arrays: chain, residue,
+        residue_no, icode, coords (Nx3 centroids), atoms (count),
+        electrons and volume (summed over the atoms), bfactor (mean)
+        and mass, which is the residue mass from the converter table
+        where the residue is known and the summed atom masses if not.
+        The sums are group-by reductions with numpy.bincount.
+        """
+        def compute():
+            atoms = self.atoms
+            rows, group = self.residueGroups()
+            beads = int(group.max()) + 1 if len(group) > 0 else 0
+            first = numpy.zeros(beads, dtype=numpy.int64)
+            first[group[::-1]] = rows[::-1]
+            count = numpy.bincount(group, minlength=beads)
+            coords = atoms.coords[rows]
+            centroids = numpy.column_stack([numpy.bincount(group, coords[:, axis], beads) for axis in range(3)]) / count[:, None]
+            codes = atoms.element_codes()[rows]
+            table = element_table()
+            residue = atoms['residue'][first]
+            mass = numpy.bincount(group, table.mass[codes], beads)
+            known = numpy.isin(residue, list(self.converter.keys()))
+            mass[known] = [self.converter[name][2] for name in residue[known].tolist()]
+            return {
+                'chain': atoms['chain'][first],
+                'residue': residue,
+                'residue_no': atoms['residue_no'][first],
+                'icode': atoms['icode'][first],
+                'coords': centroids,
+                'atoms': count,
+                'electrons': numpy.bincount(group, table.electrons[codes], beads),
+                'volume': numpy.bincount(group, table.volume[codes], beads),
+                'bfactor': numpy.bincount(group, numpy.nan_to_num(atoms['bfactor'][rows]), beads) / count,
+                'mass': mass}
+        beads = self.atoms.memo('coarse_grain', ('topology', 'geometry'), compute)
+        self.logger.info('Coarse grained '+str(len(self.residueGroups()[0]))+' atoms into '+str(len(beads['coords']))+' residue beads')
+        return dict(beads)
+
+    def coarseGrainedPDB(self):
+        """New PDB with a CA atom at the centroid of every residue of this one"""
+        beads = self.coarseGrain()
+        coarse = PDB()
+        coarse.addNewAtoms(beads['coords'], bfactor=beads['bfactor'], element='C', chain=beads['chain'], atom_name='CA',
+                           residue=beads['residue'], residue_no=beads['residue_no'], icode=beads['icode'])
+        return coarse
+
+    def symmetryAssembly(self, group):
+        """New PDB of the assembly built by applying every operator of a point group to this structure
+
+        The structure must already sit in the symmetry frame (see
+        symmetry_operators). Each copy of each chain gets its own chain
+        id, the untransformed copy first, and serial numbers run on
+        through the assembly. Past 62 chains the ids have two letters,
+        so such an assembly can only be written to a .cif file.
+        """
+        try:
+            mates = symmetry_mates(self.atoms.coords[self.atoms.atom_mask()], group)
+        except ValueError as error:
+            self.logger.error(str(error))
+            return None
+        atoms = self.atoms
+        mask = atoms.atom_mask()
+        copies = len(mates)
+        chains, chain_number = numpy.unique(atoms['chain'][mask], return_inverse=True)
+        ###chain ids run through the chains of the first copy, then the second copy ...
+        names = numpy.array(chain_names(copies * len(chains)))
+        chain = names[(numpy.arange(copies)[:, None] * len(chains) + chain_number.reshape(-1)[None, :]).ravel()]
+        columns = dict((name, numpy.tile(atoms[name][mask], copies)) for name in AtomRecord.keys_order
+                       if not name in atoms.axes and not name in ['serial_no', 'chain'])
+        assembly = PDB()
+        assembly.addNewAtoms(mates.reshape(-1, 3), chain=chain, **columns)
+        self.logger.info('Built a '+str(group)+' assembly of '+str(copies)+' copies and '+str(len(assembly.atoms))+' atoms')
+        return assembly
+
+    def _seqres_sequences(self):
+        """Residue names of every chain from the SEQRES records, empty if there are none"""
+        sequences = {}
+        for index in sorted(self.hashdata.others.keys()):
+            record = self.hashdata.others[index]
+            if record.get('record_type') == 'SEQRES':
+                ###SEQRES columns after the record name: serial, chain, number of residues, residues
+                string = record.get('string', '')
+                chain = string[5:6].strip()
+                sequences.setdefault(chain, []).extend(string[13:].split())
+        return sequences
+
+    def _atom_sequences(self):
+        """Residue names of the CA or P atom of every residue of every chain, in file order"""
+        atoms = self.atoms
+        rows = atoms.atom_index().residue_atoms(['CA', 'P'])
+        rows = rows[atoms['record_type'][rows] == 'ATOM']
+        sequences = {}
+        for chain, residue in zip(atoms['chain'][rows].tolist(), atoms['residue'][rows].tolist()):
+            sequences.setdefault(chain, []).append(residue)
+        return sequences
+
+    def composition(self, seqres=True):
+        """Per chain and total sequence, MW, extinction coefficient, vbar and X-ray and neutron SLD
+
+        Uses the SEQRES records when there are any and seqres is True,
+        otherwise the residues with a CA or P atom. See
+        sequence_composition for the values returned.
+        """
+        def compute():
+            sequences = self._seqres_sequences() if seqres else {}
+            if len(sequences) == 0:
+                sequences = self._atom_sequences()
+            return sequence_composition(sequences)
+        composition = self.atoms.memo('composition_'+str(bool(seqres)), ('topology',), compute)
+        total = composition['total']
+        self.logger.info('Composition: {0} residues, {1:.1f} Da, vbar {2:.3f} ml/g, X-ray SLD {3:.3E} cm^-2'.format(total['residues'], total['mw'], total['vbar'], total['xray_sld']))
+        return composition
+
+    def modelDescriptors(self, models, weighting='mass'):
+        """Rg, Dmax and principal moments for every model of an NxAtomsx3 stack, i.e. from iter_models"""
+        weights, mask = self.atomWeights(weighting)
+        models = numpy.asarray(models, dtype=float)[:, mask]
+        return {
+            'rg': radius_of_gyration(models, weights),
+            'dmax': maximum_dimension(models),
+            'moments': numpy.linalg.eigvalsh(inertia_tensor(models, weights))}
+
+    def _bounding_box(self):
+        coords = self.atoms.coords[self.atoms.atom_mask()]
+        return (tuple(coords.min(axis=0).tolist()), tuple(coords.max(axis=0).tolist()))
+
+    def boundingBox(self):
+        """Lowest and highest x,y,z of the atoms as two tuples"""
+        return self.atoms.memo('bounding_box', ('topology', 'geometry'), self._bounding_box)
     
     
     def parse_file(self):
         self.logger.info('Reading and parsing pdb file: '+str(self.pdbfile))
-
-        ######################################
-        #PDB DEFINITION FROM wwPDB GUIDLINES #
-        # VERSION 3.30 31/07/14              #
-        ######################################
+        cached = None
         if self.pdbfile == None:
-            pdblines = []
-        else:
-            file = open(self.pdbfile, 'r')
-            pdblines = file.readlines()
-
-        for line in pdblines:
-            index = pdblines.index(line)
-            self.hashdata[index] = {}
-            record_type = line[self.pdb_definition['record_type'][0]:self.pdb_definition['record_type'][1]].rstrip()
-            if record_type == 'ATOM' or record_type == 'HETATM':
-                for record in self.pdb_definition.keys():
-                    try:
-                        if record in self.integer_records:
-                            self.hashdata[index][record] = int(line[self.pdb_definition[record][0]:self.pdb_definition[record][1]].strip())
-                        elif record in self.float_records.keys():
-                            self.hashdata[index][record] = float(line[self.pdb_definition[record][0]:self.pdb_definition[record][1]].strip())
-                        else:
-                            self.hashdata[index][record] = line[self.pdb_definition[record][0]:self.pdb_definition[record][1]].strip()
-                    except:
-                        pass
+            atoms, others = AtomTable(), {}
+        elif self.cache != None and self.pdb_definition == pdb_definition:
+            cached = self.cache.load(self.pdbfile)
+        if cached != None:
+            atoms, others = cached
+            self.logger.info('Loaded '+str(len(atoms))+' atoms from the structure cache')
+        elif self.pdbfile != None:
+            if self.pdbfile[-4:] == '.cif':
+                atoms, others = read_cif_file(self.pdbfile)
             else:
-                self.hashdata[index]['record_type'] = line[self.pdb_definition['record_type'][0]:self.pdb_definition['record_type'][1]].rstrip()
-                self.hashdata[index]['string'] = line[self.pdb_definition['string'][0]:-1]+line[-1]
+                atoms, others = read_pdb_file(self.pdbfile, self.pdb_definition)
+            self.logger.info('Parsed '+str(len(atoms))+' atoms')
+            if self.cache != None and self.pdb_definition == pdb_definition:
+                self.cache.store(self.pdbfile, atoms, others)
+        self.hashdata = PdbDict(atoms, others)
 
 
-    def return_file(self, justatoms=False):
+    def write_file(self, outfile, justatoms=False, chunk=65536):
+        """Stream the structure to a file name or open file, in mmCIF for a .cif file name and pdb format otherwise
+
+        A structure with serial numbers above 99999 or chain ids longer
+        than one character does not fit the pdb format, so it is not
+        written and False is returned, write it to a .cif file instead.
+        """
+        if isinstance(outfile, str) and outfile[-4:] == '.cif':
+            self.logger.info('Writing out a formatted mmCIF file')
+            with open(outfile, 'w') as handle:
+                write_cif(handle, self.atoms, os.path.splitext(os.path.basename(outfile))[0], chunk)
+            return True
         self.logger.info('Writing out a formatted PDB file')
         if justatoms:
             justatoms = True
             self.logger.info('Will only return the atom lines')
+        if len(self.atoms) > 0 and (self.atoms['serial_no'].max() > 99999 or numpy.char.str_len(self.atoms['chain']).max() > 1):
+            self.logger.error('Serial numbers above 99999 or chain names longer than one character do not fit the pdb format, write a .cif file instead')
+            return False
+        if isinstance(outfile, str):
+            with open(outfile, 'w') as handle:
+                write_pdb(handle, self.hashdata, justatoms, chunk)
+        else:
+            write_pdb(outfile, self.hashdata, justatoms, chunk)
+        return True
 
-        output_lines = []
-        #ljust_records = [ 'record_type', 'atom_name', 'string' ]
-        ljust_records = [ 'record_type', 'string' ]
-        
-        for index in sorted(self.hashdata.keys()):
-            try:
-                if len(self.hashdata[index]['atom_name']) < 4:
-                    self.hashdata[index]['atom_name'] = ' '+self.hashdata[option][index]['atom_name']
-            except:
-                pass
-            line = list(' '*80)
-            for record in self.hashdata[index]:
-                try:
-                    length = self.pdb_definition[record][1] - self.pdb_definition[record][0]
-                except:
-                    length = 80 - self.pdb_definition[record][0]
-                if record in self.float_records:
-                    if record in ljust_records:
-                        content = list((('%.'+str(self.float_records[record])+'f') % self.hashdata[index][record]).ljust(length))
-                    else:
-                        content = list((('%.'+str(self.float_records[record])+'f') % self.hashdata[index][record]).rjust(length))
-                        
+    def return_file(self, justatoms=False):
+        output = io.StringIO()
+        if not self.write_file(output, justatoms):
+            return None
+        return output.getvalue()
+
+
+_curve_number = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[-+]?(?:nan|inf)'
+_curve_rows = {}
+
+def read_curve(filename, columns=3, positive=(0,), after=None):
+    """Read the numeric block of a dat, fit, out or int file in one pass
+
+    Returns a float64 array of shape (points, columns) holding the
+    first columns of every row that starts with at least that many
+    numbers, so headers, footers and short rows are skipped as they
+    always were. Rows where any of the positive columns is not above
+    zero are dropped, i.e. positive=(0,) keeps q > 0. If after is a
+    regular expression only the lines after its last match are read.
+    The block between the first and last rows that start with a number
+    is read with numpy.loadtxt, falling back to a regular expression
+    over the whole text if there is text or a short row inside it.
+    Raises IOError if the file cannot be read and ValueError if after
+    does not match.
+    """
+    with open(filename, 'r') as infile:
+        text = infile.read()
+    if after != None:
+        matches = [match.end() for match in re.finditer(after, text, re.M)]
+        if len(matches) == 0:
+            raise ValueError(str(filename)+' does not have a line matching '+str(after))
+        text = text[text.find('\n', matches[-1]) + 1:] if text.find('\n', matches[-1]) >= 0 else ''
+    ###header and footer detection, the numeric block starts and ends with a row starting with a number
+    rows = text.splitlines()
+    numeric = lambda line: line.lstrip()[:1] in '0123456789+-.' and line.strip() != ''
+    first = next((index for index, line in enumerate(rows) if numeric(line)), len(rows))
+    last = next((index for index in range(len(rows) - 1, first - 1, -1) if numeric(rows[index])), first - 1)
+    rows = rows[first:last + 1]
+    try:
+        data = numpy.loadtxt(rows, usecols=range(columns), ndmin=2, comments=None) if len(rows) > 0 else numpy.zeros((0, columns))
+    except ValueError:
+        if columns not in _curve_rows:
+            _curve_rows[columns] = re.compile(r'^[ \t]*((?:'+_curve_number+r')(?:[ \t]+(?:'+_curve_number+r')){'+str(columns - 1)+r'})(?=\s|$)', re.M | re.I)
+        data = numpy.array(' '.join(_curve_rows[columns].findall(text)).split(), dtype=numpy.float64).reshape(-1, columns)
+    if len(positive) > 0:
+        data = data[numpy.all(data[:, list(positive)] > 0, axis=1)]
+    return data
+
+curve_format = '%-15s %-18s %-15s'
+
+def write_curve(outfile, columns, header=(), fmt=curve_format, chunk=65536):
+    """Stream the columns of a curve to a file name or open file
+
+    The columns are stacked into one float64 array and formatted a
+    chunk of rows at a time with a single % operation, so the time is
+    linear in the number of points and repeated q values are written
+    as they are. header is a line or a list of lines written first.
+    As before lines are separated by new lines with none at the end.
+    Returns the number of rows written.
+    """
+    if isinstance(outfile, str):
+        with open(outfile, 'w') as handle:
+            return write_curve(handle, columns, header, fmt, chunk)
+    data = numpy.column_stack([numpy.asarray(column, dtype=numpy.float64) for column in columns]) if len(columns) > 0 else numpy.zeros((0, 0))
+    header = [header] if isinstance(header, str) else list(header)
+    outfile.write('\n'.join(header))
+    separator = '\n' if len(header) > 0 else ''
+    for start in range(0, len(data), chunk):
+        block = data[start:start + chunk]
+        outfile.write(separator + '\n'.join([fmt] * len(block)) % tuple(block.ravel().tolist()))
+        separator = '\n'
+    return len(data)
+
+def write_curves(outfiles, q, intensities, errors, header=(curve_format % ('Q(A-1)', 'I(au)', 'Error'),), fmt=curve_format, positive=True):
+    """Write one dat file per row of stacked intensities and errors sharing one q axis
+
+    intensities and errors have shape (curves, points) and q has shape
+    (points,), as for a series of frames. With positive only points
+    with q > 0 are written. Returns the number of files written.
+    """
+    q = numpy.asarray(q, dtype=numpy.float64)
+    intensities = numpy.atleast_2d(numpy.asarray(intensities, dtype=numpy.float64))
+    errors = numpy.atleast_2d(numpy.asarray(errors, dtype=numpy.float64))
+    if intensities.shape != errors.shape or intensities.shape[1] != len(q) or intensities.shape[0] != len(outfiles):
+        raise ValueError('Need one row of intensities and errors per file and one column per q value')
+    keep = q > 0 if positive else numpy.ones(len(q), dtype=bool)
+    for outfile, i, e in zip(outfiles, intensities[:, keep], errors[:, keep]):
+        write_curve(outfile, (q[keep], i, e), header, fmt)
+    return len(outfiles)
+
+_frame_name = re.compile(r'^(.*?)[-._]?(\d+)$')
+
+def split_frame_name(filename):
+    """Split a file name into run prefix, frame number and number of digits, i.e. ('run', 25, 4) for run_0025.dat
+
+    Names that do not end in a number give (name, None, 0).
+    """
+    root = os.path.splitext(os.path.basename(filename))[0]
+    match = _frame_name.match(root)
+    if match == None:
+        return root, None, 0
+    return match.group(1), int(match.group(2)), len(match.group(2))
+
+def frame_number(filename):
+    """The number at the end of a file name without its extension, i.e. 25 for run_0025.dat, or None"""
+    return split_frame_name(filename)[1]
+
+def frame_range_name(prefix, first, last, digits=0):
+    """Name for frames first to last of a run, i.e. run_0010-0020"""
+    return prefix+'_'+str(first).zfill(digits)+'-'+str(last).zfill(digits)
+
+
+class FrameIndex(object):
+    """Persistent index of the curve files in a directory
+
+    scan() walks the directory once with os.scandir and keeps a record
+    per matching file of its run prefix, frame number, number of digits
+    in the frame number, mtime, size and a header summary (the text
+    lines before the numeric block). The index is saved as json and
+    reused on the next scan, so only files that are new or whose size
+    or mtime changed are opened, and files that have gone are dropped.
+    The index is kept next to the data unless a cache directory is
+    given or set in the SAXS_FRAME_INDEX environment variable, in
+    which case it is kept there under the sha1 of the data directory.
+    If the index cannot be written it is only kept in memory.
+    """
+    filename = '.frameindex.json'
+    version = 1
+    header_bytes = 4096
+
+    def __init__(self, directory, pattern='*.dat', logger=None, cache=None):
+        self.directory = os.path.abspath(directory)
+        self.pattern = pattern
+        self.logger = logger or logging.getLogger('readwrite.DAT')
+        if cache == None:
+            cache = os.environ.get('SAXS_FRAME_INDEX')
+        self.cache = os.path.abspath(os.path.expanduser(cache)) if cache else None
+        self.records = {}
+        self.roots = {}
+
+    def path(self):
+        """Where the index of this directory is saved"""
+        if self.cache == None:
+            return os.path.join(self.directory, self.filename)
+        return os.path.join(self.cache, hashlib.sha1(self.directory.encode()).hexdigest()+'.json')
+
+    def load(self):
+        try:
+            with open(self.path(), 'r') as infile:
+                index = json.load(infile)
+            if index.get('version') == self.version and index.get('pattern') == self.pattern:
+                return index['records']
+        except (IOError, ValueError, KeyError):
+            pass
+        return {}
+
+    def save(self):
+        try:
+            if self.cache != None:
+                os.makedirs(self.cache, exist_ok=True)
+            handle, filename = tempfile.mkstemp(dir=os.path.dirname(self.path()), suffix='.json')
+            with os.fdopen(handle, 'w') as outfile:
+                json.dump({'version': self.version, 'directory': self.directory, 'pattern': self.pattern, 'records': self.records}, outfile)
+            os.replace(filename, self.path())
+        except OSError as error:
+            ###a read only data directory is normal, the index then only lasts for this run
+            self.logger.debug('Keeping the frame index of '+self.directory+' in memory: '+str(error))
+
+    def header(self, path):
+        """The text lines before the first row that starts with a number, joined with ' | '"""
+        lines = []
+        try:
+            with open(path, 'r') as infile:
+                text = infile.read(self.header_bytes)
+        except (IOError, UnicodeDecodeError):
+            return ''
+        for line in text.splitlines():
+            if line.lstrip()[:1] in '0123456789+-.' and line.strip() != '':
+                break
+            if line.strip() != '':
+                lines.append(line.strip())
+        return ' | '.join(lines)
+
+    def scan(self):
+        """Bring the index up to date with the directory, returns the number of files that were opened"""
+        previous = self.load()
+        records = {}
+        opened = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not fnmatchcase(entry.name, self.pattern) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                record = previous.get(entry.name)
+                if record == None or record['mtime'] != stat.st_mtime_ns or record['size'] != stat.st_size:
+                    prefix, frame, digits = split_frame_name(entry.name)
+                    record = {'prefix': prefix, 'frame': frame, 'digits': digits, 'mtime': stat.st_mtime_ns,
+                              'size': stat.st_size, 'header': self.header(entry.path)}
+                    opened += 1
+                records[entry.name] = record
+        self.records = records
+        self.roots = dict((os.path.splitext(name)[0], name) for name in records)
+        if opened > 0 or len(records) != len(previous):
+            self.save()
+        self.logger.debug('Indexed '+str(len(records))+' files in '+self.directory+', read '+str(opened))
+        return opened
+
+    def lookup(self, filename):
+        """The record of a file name, path or name without its extension, or None"""
+        name = os.path.basename(filename)
+        if name in self.records:
+            return self.records[name]
+        if name in self.roots:
+            return self.records[self.roots[name]]
+        return None
+
+    def runs(self):
+        """{prefix: [file names ordered by frame number]}"""
+        runs = {}
+        for name in self.series():
+            runs.setdefault(self.records[name]['prefix'], []).append(name)
+        return runs
+
+    def series(self, prefix=None):
+        """File names ordered by run prefix and frame number, only those of one run if prefix is given"""
+        names = [name for name in self.records if prefix == None or self.records[name]['prefix'] == prefix]
+        return sorted(names, key=lambda name: (self.records[name]['prefix'], self.records[name]['frame'] if self.records[name]['frame'] != None else -1, name))
+
+    def paths(self, prefix=None):
+        return [os.path.join(self.directory, name) for name in self.series(prefix)]
+
+def _read_frame(task):
+    """Read one file of a stack in a pool worker, returns (row, data, mtime, error)"""
+    row, filename = task
+    try:
+        return row, read_curve(filename, 3, (0,)), os.path.getmtime(filename), None
+    except (IOError, OSError, ValueError) as error:
+        return row, None, None, str(error)
+
+
+class CurveStack(object):
+    """A series of curves on one q axis, i.e. the frames of a SEC run
+
+    Holds one q vector, I and E matrices of shape (frames, points) and
+    a dictionary of metadata per frame ('frame', 'filename', 'mtime'
+    and anything else that is json). On disk a stack is a directory
+    of q.npy, i.npy, e.npy and frames.json. open() memory maps the
+    matrices, so slicing, averaging, blanking and Guinier fits only
+    read the frames they use. Indexing with an integer returns one
+    frame as a {'Q', 'I', 'E'} dictionary of arrays, indexing with a
+    slice or array of rows returns a CurveStack of those frames, which
+    for a slice is a view of the same memory.
+    """
+
+    def __init__(self, q, intensities, errors, frames=None, directory=None):
+        self.q = q
+        self.i = intensities
+        self.e = errors
+        self.frames = frames if frames != None else [{'frame': row} for row in range(len(intensities))]
+        self.directory = directory
+        if self.i.shape != self.e.shape or self.i.ndim != 2 or self.i.shape[1] != len(self.q) or len(self.frames) != len(self.i):
+            raise ValueError('A curve stack needs I and E of shape (frames, points) and one q and metadata entry per point and frame')
+
+    @classmethod
+    def create(cls, directory, q, count, frames=None):
+        """Preallocate a stack of count frames in a directory, to be filled in place and then flushed"""
+        os.makedirs(directory, exist_ok=True)
+        q = numpy.asarray(q, dtype=numpy.float64)
+        numpy.save(os.path.join(directory, 'q.npy'), q)
+        matrices = []
+        for name in ['i', 'e']:
+            matrix = numpy.lib.format.open_memmap(os.path.join(directory, name+'.npy'), mode='w+', dtype=numpy.float64, shape=(count, len(q)))
+            matrix[:] = numpy.nan
+            matrices.append(matrix)
+        stack = cls(q, matrices[0], matrices[1], frames, directory)
+        stack.write_frames()
+        return stack
+
+    @classmethod
+    def open(cls, directory, mode='r'):
+        """Memory map a stack saved in a directory, use mode 'r+' to change it in place or 'c' for copy on write"""
+        with open(os.path.join(directory, 'frames.json'), 'r') as infile:
+            frames = json.load(infile)
+        return cls(numpy.load(os.path.join(directory, 'q.npy')), numpy.load(os.path.join(directory, 'i.npy'), mmap_mode=mode),
+                   numpy.load(os.path.join(directory, 'e.npy'), mmap_mode=mode), frames, directory)
+
+    @classmethod
+    def from_files(cls, filenames, directory=None, processes=1, pool='thread', chunksize=16, logger=None):
+        """Read curve files that share a q axis into a stack, in memory or preallocated in a directory
+
+        The stack is allocated from the q axis of the first file. With
+        processes above 1, or None for one per cpu, the files are read
+        and parsed by a pool of threads, or of processes if pool is
+        'process', and each one is put straight into its row of the
+        stack as it arrives, so the frames are always in the order of
+        filenames whichever finishes first. Threads suit files on
+        network storage, processes suit parsing bound local reads.
+        Files that cannot be read are left as nan with an 'error' in
+        their metadata. Raises ValueError if a file has a different q
+        axis to the first.
+        """
+        logger = logger or logging.getLogger('readwrite.DAT')
+        filenames = list(filenames)
+        if len(filenames) == 0:
+            raise ValueError('Need at least one file to make a curve stack')
+        if pool not in ['thread', 'process']:
+            raise ValueError('The pool must be thread or process')
+        first = read_curve(filenames[0], 3, (0,))
+        frames = [{'frame': frame_number(filename), 'filename': os.path.abspath(filename)} for filename in filenames]
+        if directory != None:
+            stack = cls.create(directory, first[:,0], len(filenames), frames)
+        else:
+            stack = cls(first[:,0].copy(), numpy.full((len(filenames), len(first)), numpy.nan), numpy.full((len(filenames), len(first)), numpy.nan), frames)
+        tasks = list(enumerate(filenames))
+        processes = processes or os.cpu_count() or 1
+        workers = None
+        if processes > 1 and len(tasks) > 1:
+            workers = ThreadPool(processes) if pool == 'thread' else Pool(processes)
+            results = workers.imap_unordered(_read_frame, tasks, chunksize)
+        else:
+            results = map(_read_frame, tasks)
+        try:
+            for row, data, mtime, error in results:
+                if error == None:
+                    stack.fill(row, data, filenames[row])
+                    stack.frames[row]['mtime'] = mtime
                 else:
-                    if record in ljust_records:
-                        content = list(str(self.hashdata[index][record]).ljust(length))
-                    else:
-                        if record == 'atom_name':
-                            temp_string = str(self.hashdata[index][record]).ljust(3)
-                        else:
-                            temp_string = str(self.hashdata[index][record])
-                        content = list(temp_string.rjust(length))
-            
-                try:
-                    line[self.pdb_definition[record][0]:self.pdb_definition[record][1]] = content[0:]
-                except:
-                    line[self.pdb_definition[record][0]:80] = content[0:]
-            if justatoms:
-                if self.hashdata[index]['record_type'] == 'ATOM' or self.hashdata[index]['record_type'] == 'HETATM':
-                    output_lines.append(''.join(line))
-            else:
-                output_lines.append(''.join(line))
+                    stack.frames[row]['error'] = error
+                    logger.error('Could not read '+str(filenames[row])+': '+error)
+        finally:
+            if workers != None:
+                workers.terminate()
+                workers.join()
+        stack.flush()
+        return stack
+
+    def fill(self, row, data, filename=''):
+        """Put the (points, 3) q, I, E array of one file into a row, raises ValueError if its q axis differs"""
+        if len(data) != len(self.q) or not numpy.allclose(data[:,0], self.q, rtol=1e-6, atol=0):
+            raise ValueError(str(filename)+' does not have the same q values as the rest of the stack')
+        self.i[row] = data[:,1]
+        self.e[row] = data[:,2]
+
+    def write_frames(self):
+        if self.directory != None:
+            with open(os.path.join(self.directory, 'frames.json'), 'w') as outfile:
+                json.dump(self.frames, outfile)
+
+    def flush(self):
+        """Write the metadata and any changes to memory mapped matrices to disk"""
+        for matrix in [self.i, self.e]:
+            if isinstance(matrix, numpy.memmap):
+                matrix.flush()
+        self.write_frames()
+
+    def save(self, directory):
+        """Save the stack to a directory and return the memory mapped copy"""
+        os.makedirs(directory, exist_ok=True)
+        numpy.save(os.path.join(directory, 'q.npy'), numpy.asarray(self.q))
+        numpy.save(os.path.join(directory, 'i.npy'), numpy.asarray(self.i))
+        numpy.save(os.path.join(directory, 'e.npy'), numpy.asarray(self.e))
+        with open(os.path.join(directory, 'frames.json'), 'w') as outfile:
+            json.dump(self.frames, outfile)
+        return CurveStack.open(directory)
+
+    def __len__(self):
+        return len(self.i)
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, numpy.integer)):
+            return {'Q': self.q, 'I': self.i[rows], 'E': self.e[rows]}
+        if isinstance(rows, slice):
+            frames = self.frames[rows]
+        else:
+            rows = numpy.asarray(rows)
+            if rows.dtype == bool:
+                rows = numpy.flatnonzero(rows)
+            frames = [self.frames[row] for row in rows.tolist()]
+        return CurveStack(self.q, self.i[rows], self.e[rows], frames)
 
+    def frame_numbers(self):
+        return numpy.array([frame.get('frame') if frame.get('frame') != None else -1 for frame in self.frames], dtype=numpy.int64)
 
-        return '\n'.join(output_lines)+'\n'
+    def rows(self, first, last):
+        """Rows of the frames numbered first to last inclusive"""
+        numbers = self.frame_numbers()
+        return numpy.flatnonzero((numbers >= first) & (numbers <= last))
 
+    def intensity_trace(self, start=10, stop=20):
+        """Summed intensity of points start to stop of every frame, the low q trace used to pick windows"""
+        return numpy.asarray(self.i[:, start:stop]).sum(axis=1)
 
+    def average(self, rows=None):
+        """Mean I of the rows, or all frames, with errors added in quadrature, sqrt(sum E^2) / n"""
+        rows = slice(None) if rows is None else rows
+        i = numpy.asarray(self.i[rows])
+        e = numpy.asarray(self.e[rows])
+        return i.mean(axis=0), numpy.sqrt((e**2).sum(axis=0)) / len(i)
+
+    def blank(self, lower_rows, upper_rows, rows):
+        """Subtract a buffer interpolated between two windows of frames from the given rows
+
+        The buffer for each frame is a linear interpolation by frame
+        number between the averages of the lower and upper windows,
+        taking the mean frame number of each window as its centre, and
+        the errors of the buffer are added to the errors of the frame.
+        The window errors come from average(), in quadrature, so they
+        fall as a window gets wider. SaxsDisplay.PlotLowQ takes the
+        plain mean of E over a window instead, which gives a larger
+        buffer error, so its output differs from this in E (and in I
+        where its window centres are rounded to whole frames). Returns
+        a new in memory stack.
+        """
+        lower_i, lower_e = self.average(lower_rows)
+        upper_i, upper_e = self.average(upper_rows)
+        numbers = self.frame_numbers().astype(numpy.float64)
+        lower_centre = numbers[lower_rows].mean()
+        upper_centre = numbers[upper_rows].mean()
+        rows = numpy.asarray(rows)
+        fraction_upper = ((numbers[rows] - lower_centre) / (upper_centre - lower_centre))[:, None]
+        intensities = numpy.asarray(self.i[rows]) - ((1 - fraction_upper) * lower_i + fraction_upper * upper_i)
+        errors = numpy.asarray(self.e[rows]) + ((1 - fraction_upper) * lower_e + fraction_upper * upper_e)
+        return CurveStack(self.q, intensities, errors, [dict(self.frames[row], blanked=True) for row in rows.tolist()])
+
+    def guinier(self, qmin=0.0, qmax=0.05):
+        """Rg and I(0) of every frame from a straight line fit of ln I against q^2 between qmin and qmax
+
+        Points with I <= 0 are left out. Frames with fewer than three
+        points or an upturn give nan.
+        """
+        points = (self.q > qmin) & (self.q <= qmax)
+        x = (self.q[points]**2)[None, :]
+        i = numpy.asarray(self.i[:, points])
+        valid = i > 0
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            y = numpy.where(valid, numpy.log(numpy.where(valid, i, 1.0)), 0.0)
+            n = valid.sum(axis=1)
+            sx = (x * valid).sum(axis=1)
+            sy = y.sum(axis=1)
+            sxx = (x**2 * valid).sum(axis=1)
+            sxy = (x * y).sum(axis=1)
+            slope = (n * sxy - sx * sy) / (n * sxx - sx**2)
+            intercept = (sy - slope * sx) / n
+            rg = numpy.sqrt(-3 * slope)
+            rg[(n < 3) | ~(slope < 0)] = numpy.nan
+            io = numpy.exp(intercept)
+            io[numpy.isnan(rg)] = numpy.nan
+        return rg, io
+
+    def imagedict(self, rows=None):
+        """The frames as the {name: {'Q': [], 'I': [], 'E': []}} dictionary the plotting scripts use"""
+        rows = range(len(self)) if rows is None else rows
+        q = self.q.tolist()
+        output = {}
+        for row in rows:
+            name = os.path.splitext(os.path.basename(self.frames[row].get('filename', str(row))))[0]
+            output[name] = {'Q': list(q), 'I': self.i[row].tolist(), 'E': self.e[row].tolist()}
+        return output
 
 
 class DAT(Interface):
@@ -486,22 +2961,7 @@ class DAT(Interface):
         
     def parse_file(self):
         self.logger.info('Reading and parsing dat file: '+str(self.datfile))
-        qdata = []
-        idata = []
-        edata = []
-                
-        datafile = open(self.datfile, "r")
-        saxsdata = datafile.readlines()
-        for row in saxsdata:
-            try:
-                q = float(row.split()[0])
-                i = float(row.split()[1])
-                e = float(row.split()[2])
-                if q > 0:
-                    qdata.append(q)
-                    idata.append(i)
-                    edata.append(e)
-            except:pass
+        qdata, idata, edata = read_curve(self.datfile, 3, (0,)).T.tolist()
         self.hashdata = {'Q': qdata, 'I': idata, 'E': edata}
         x1 = int(round(len(self.hashdata['Q'])*self.lo_q_window_range[0]))
         x2 = int(round(len(self.hashdata['Q'])*self.lo_q_window_range[1]))
@@ -529,18 +2989,19 @@ class DAT(Interface):
             return self.hashdata[column]
         else:
             self.logger.error('ReturnDataColumn function requires you specify either Q, I or E')            
-    def return_file(self):
+
+    def write_file(self, outfile):
+        """Stream the points with q > 0 to a file name or open file in dat format"""
         self.logger.info('Writing out a formatted DAT file')
-        string_list = []
-        string_list.append("%-15s %-18s %-15s" % ("Q(A-1)","I(au)","Error"))
-        for q in self.hashdata['Q']:
-            if q > 0:
-                index = self.hashdata['Q'].index(q)
-                q = self.hashdata['Q'][index]
-                i = self.hashdata['I'][index]
-                e = self.hashdata['E'][index]
-                string_list.append("%-15s %-18s %-15s" % (q,i,e))
-        return '\n'.join(string_list)
+        q = numpy.asarray(self.hashdata['Q'], dtype=numpy.float64)
+        keep = q > 0
+        write_curve(outfile, (q[keep], numpy.asarray(self.hashdata['I'], dtype=numpy.float64)[keep], numpy.asarray(self.hashdata['E'], dtype=numpy.float64)[keep]),
+                    curve_format % ("Q(A-1)","I(au)","Error"))
+
+    def return_file(self):
+        output = io.StringIO()
+        self.write_file(output)
+        return output.getvalue()
 
 
     def input_dict(self, input_dict):
@@ -586,37 +3047,22 @@ class FIT(Interface):
 
     def parse_file(self):
         self.logger.info('Reading and parsing fit file: '+str(self.fitfile))
-        qdata = []
-        exp_data = []
-        model_data = []
-                
-        datafile = open(self.fitfile, "r")
-        saxsdata = datafile.readlines()
-        for row in saxsdata:
-            try:
-                q = float(row.split()[0])
-                exp = float(row.split()[1])
-                mod = float(row.split()[2])
-                if q > 0 and exp > 0:
-                    qdata.append(q)
-                    exp_data.append(exp)
-                    model_data.append(mod)
-            except:pass
+        qdata, exp_data, model_data = read_curve(self.fitfile, 3, (0, 1)).T.tolist()
         self.hashdata = {'Q': qdata, 'obs': exp_data, 'mod': model_data}
         self.logger.info('Parsed '+str(self.fitfile)+' with '+str(len(qdata))+' data points.')
 
-    def return_file(self):
+    def write_file(self, outfile):
+        """Stream the points with q > 0 to a file name or open file in fit format"""
         self.logger.info('Writing out a formatted FIT file')
-        string_list = []
-        string_list.append("%-15s %-18s %-15s" % ("Q(A-1)","Observed","Model"))
-        for q in self.hashdata['Q']:
-            if q > 0:
-                index = self.hashdata['Q'].index(q)
-                q = self.hashdata['Q'][index]
-                obs = self.hashdata['obs'][index]
-                mod = self.hashdata['mod'][index]
-                string_list.append("%-15s %-18s %-15s" % (q,obs,mod))
-        return '\n'.join(string_list)
+        q = numpy.asarray(self.hashdata['Q'], dtype=numpy.float64)
+        keep = q > 0
+        write_curve(outfile, (q[keep], numpy.asarray(self.hashdata['obs'], dtype=numpy.float64)[keep], numpy.asarray(self.hashdata['mod'], dtype=numpy.float64)[keep]),
+                    curve_format % ("Q(A-1)","Observed","Model"))
+
+    def return_file(self):
+        output = io.StringIO()
+        self.write_file(output)
+        return output.getvalue()
 
     def input_dict(self, input_dict):
         self.logger.info('Reading in DAT data as a dictionary')
@@ -667,6 +3113,21 @@ class OUT(Interface):
             self.logger.error('Failed to get Dmax from P(r)')
         return dmax
 
+    def Rg(self):
+        """Real space Rg from the P(r), Rg^2 = integral(r^2 P) / 2 integral(P)"""
+        try:
+            r = numpy.array(self.hashdata['R'], dtype=float)
+            pr = numpy.array(self.hashdata['PR'], dtype=float)
+            ###trapezium rule
+            widths = numpy.diff(r)
+            second = numpy.dot(widths, (r[1:]**2 * pr[1:] + r[:-1]**2 * pr[:-1]))
+            zeroth = numpy.dot(widths, (pr[1:] + pr[:-1]))
+            rg = (second / (2.0 * zeroth))**0.5
+        except:
+            rg = 0
+            self.logger.error('Failed to get Rg from P(r)')
+        return rg
+
     def numberOfBins(self):
         try:
             bins = len(self.hashdata['R'])
@@ -677,41 +3138,25 @@ class OUT(Interface):
         
     def parse_file(self):
         self.logger.info('Reading and parsing out file: '+str(self.outfile))
-        rdata = []
-        prdata = []
-        edata = []
-
-        datafile = open(self.outfile, "r")
-        saxsdata = datafile.readlines()
         try:
-            index = [i for i, item in enumerate(saxsdata) if re.search(' *R          P\(R\)      ERROR.*', item)][-1]
-        except:
+            rdata, prdata, edata = read_curve(self.outfile, 3, (), after=' *R          P\\(R\\)      ERROR').T.tolist()
+        except ValueError:
+            rdata, prdata, edata = [], [], []
             self.logger.error('Outfile '+str(self.outfile)+'.out does not seem to have the expected format for an outfile')
-        for row in saxsdata[index:]:
-            try:
-                r = float(row.split()[0])
-                pr = float(row.split()[1])
-                e = float(row.split()[2])
-                rdata.append(r)
-                prdata.append(pr)
-                edata.append(e)
-            except:pass
         self.hashdata = {'R': rdata, 'PR': prdata, 'E': edata}
         self.logger.info('Parsed '+str(self.outfile)+' with '+str(len(rdata))+' data points.')
 
 
 
-    def return_file(self):
+    def write_file(self, outfile):
+        """Stream the P(r) to a file name or open file"""
         self.logger.info('Writing out a formatted OUT file')
-        string_list = []
-        string_list.append("%-15s %-18s %-15s" % ("R(A)","P(R)","ERROR"))
-        for r in self.hashdata['R']:
-            index = self.hashdata['R'].index(r)
-            r = self.hashdata['R'][index]
-            pr = self.hashdata['PR'][index]
-            e = self.hashdata['E'][index]
-            string_list.append("%-15s %-18s %-15s" % (r,pr,e))
-        return '\n'.join(string_list)
+        write_curve(outfile, (self.hashdata['R'], self.hashdata['PR'], self.hashdata['E']), curve_format % ("R(A)","P(R)","ERROR"))
+
+    def return_file(self):
+        output = io.StringIO()
+        self.write_file(output)
+        return output.getvalue()
 
     def input_dict(self, input_dict):
         self.logger.info('Reading in OUT data as a dictionary')
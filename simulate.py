@@ -8,6 +8,8 @@ Created on Apr 03, 2014
 import sys, logging, os, re, math, numpy, random
 from subprocess import check_output
 
+from readwrite import PDB, read_curve, write_curve
+
 class Simulate():
     """Simulate SAXS data from a PDB file
     
@@ -41,38 +43,43 @@ class Simulate():
 #            self.logger.error('Q min and Q max were not defined correctly. Must# be in the format i.e. 0.01-0.55')
 #            sys.exit()
 
+    def SampleComposition(self):
+        '''Work out the contrast and partial specific volume from the pdb file unless given on the command line'''
+        pdb = PDB(self._options['file'])
+        pdb.logger.setLevel(logging.WARNING)
+        pdb.parse_file()
+        composition = pdb.composition()['total']
+        if composition['residues'] == 0:
+            self.logger.error('could not find any residues in '+str(self._options['file']))
+            sys.exit()
+        if self._options['sld'] == None:
+            self._options['sld'] = composition['xray_contrast']
+        if self._options['vbar'] == None:
+            self._options['vbar'] = composition['vbar']
+        self.logger.info('From the sequence, MW: '+'%.1f' % composition['mw']+' Da, vbar: '+'%.3f' % self._options['vbar']+' ml/g, contrast: '+'%.3E' % self._options['sld']+' cm^-2')
+
     def RunCrysol(self):
         self.logger.info('Running Crysol')
         filelist_before = os.listdir(os.getcwd())
         command = 'crysol -ns '+str(self._options['no_points'])+' -sm '+str(self.highq)+' '+str(self._options['file'])
-        self.output = check_output(command, shell=True)
+        self.output = check_output(command, shell=True).decode()
         filelist_after = os.listdir(os.getcwd())
         self.crysol_files = list(set(filelist_after) - set(filelist_before))
 
     def ParseIntFile(self):
         for file in self.crysol_files:
             if file[-4:] == '.int':
-                intfile=open(file)
-                intdata=intfile.readlines()
-                self.qdata = []
-                self.idata = []
                 if self._options['vacuum']:
                     self.logger.info('Outputting the in vacuum data')
-                for row in intdata:
-                    try:
-                        q = float(row.split()[0])
-                        if self._options['vacuum']:
-                            i = float(row.split()[2]) + ( self._options['background'] * 1E6 )
-                        else:
-                            i = float(row.split()[1]) + ( self._options['background'] * 1E6 )
-                        if q > self.lowq and q < self.highq:
-                            self.qdata.append(q)
-                            self.idata.append(i)
-                        if q == 0:
-                            self.izero = i
-                    except:
-                        pass
-                    
+                data = read_curve(file, 3, ())
+                q = data[:,0]
+                i = data[:,2 if self._options['vacuum'] else 1] + ( self._options['background'] * 1E6 )
+                keep = (q > self.lowq) & (q < self.highq)
+                self.qdata = q[keep].tolist()
+                self.idata = i[keep].tolist()
+                if (q == 0).any():
+                    self.izero = i[q == 0][-1]
+
                 self.logger.info('From crysol,     min Q: '+str(min(self.qdata))+', max Q: '+str(max(self.qdata)))
 
                 try:
@@ -246,7 +253,7 @@ class Simulate():
         for q in self.qdata:
             index = self.qdata.index(q)
             if q == 0.300068:
-                print str(q)+','+str(self.binsizes[index])
+                print(str(q)+','+str(self.binsizes[index]))
 
             i_inv_cm = self.idata[index]
             background_error = 10E-7
@@ -268,18 +275,8 @@ class Simulate():
             self.edata.append(error)
         
     def OutputDatFile(self):
-        string_list = []
-        string_list.append("Simulated data from "+self._options['file'])
-        string_list.append("%-15s %-18s %-15s" % ("Q(A-1)","I(au)","Error"))
-        for q in self.qdata:
-            index = self.qdata.index(q)
-            q = self.qdata[index]
-            i = self.noisy_i[index]
-            e = self.edata[index]
-            string_list.append("%-15s %-18s %-15s" % (q,i,e))
-        outfile = open(self._options['outfile'], 'w')
-        outfile.write('\n'.join(string_list))
-        outfile.close()
+        write_curve(self._options['outfile'], (self.qdata, self.noisy_i, self.edata),
+                    ["Simulated data from "+self._options['file'], "%-15s %-18s %-15s" % ("Q(A-1)","I(au)","Error")])
         self.logger.info('Output file '+str(self._options['outfile']))
 
                            
@@ -307,8 +304,8 @@ if __name__ == '__main__':
     optional.add_option("-c", "--concentration", action="store", type="float", dest="concentration", default=1.0, help="The concentration in mg/ml of the protein (default 1 mg/ml)")
     optional.add_option("-t", "--time", action="store", type="float", dest="time", default=10.0, help="The exposure time for the sample, (default 10 secs)")
     
-    optional.add_option("-s", "--sld", action="store", type="float", dest="sld", default=2.67E+10, help="The scattering length density of the protein (default is 2.67E+10)")
-    optional.add_option("-v", "--vbar", action="store", type="float", dest="vbar", default=0.73, help="The partial specific volume of the protein (default is 0.73)")
+    optional.add_option("-s", "--sld", action="store", type="float", dest="sld", default=None, help="The scattering length density contrast of the protein (default is worked out from the sequence)")
+    optional.add_option("-v", "--vbar", action="store", type="float", dest="vbar", default=None, help="The partial specific volume of the protein (default is worked out from the sequence)")
     
     optional.add_option("-o", "--outfile", action="store", type="string", dest="outfile", help="The name of an output file, the default name is the rootname of your pdb file with .dat at the end.")
     
@@ -344,6 +341,7 @@ if __name__ == '__main__':
 
     options = eval(str(options))
     job = Simulate(options)
+    job.SampleComposition()
     job.SimulateImage()
     job.RunCrysol()
     job.ParseIntFile()